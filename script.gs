@@ -12,6 +12,7 @@
  * @param {number} inital_investment The initial upfront investment required for the product
  * @param {number} relevant_contribution_margin_range (Optional) A percentage indicating the range of contribution margins to consider when looking for comparable products
  * @param {number} relevant_list_price_range (Optional) A percentage indicating the range of list prices to consider when looking for comparable products
+ * @param {number} nearest_comparables (Optional) Use the volumes of this many most similar products instead of the ranges above
  * @return A table containing the projected sales data and profitability calculations
  * @customfunction
  */
@@ -25,6 +26,7 @@ function FORECAST_SALES(
   inital_investment,
   relevant_contribution_margin_range = 999999999,
   relevant_list_price_range = 999999999,
+  nearest_comparables = 0,
 ) {
   var json_data = JSON.stringify({
       product_category,
@@ -36,12 +38,9 @@ function FORECAST_SALES(
       inital_investment,
       relevant_contribution_margin_range,
       relevant_list_price_range,
+      nearest_comparables,
     })
-  var arguments = {
-    'json_data': json_data,
-  }
-  var url = buildUrl_("https://cs490.mcnamee.io", arguments)
-  var response = UrlFetchApp.fetch(url, { 'muteHttpExceptions': true })
+  var response = post_(buildUrl_("https://cs490.mcnamee.io", { 'format': 'compact' }), json_data)
   if(response.getResponseCode() != '200') {
     var message = response.getContentText()
     try {
@@ -50,7 +49,197 @@ function FORECAST_SALES(
     return "Error: " + message
   }
   var deserialized = JSON.parse(response.getContentText())
-  return deserialized
+  return expandColumns_(deserialized)
+}
+
+/**
+ * Compute NPV, IRR and a recommendation for every combination of variable cost,
+ * list price, desired IRR and initial investment, in a single request.
+ *
+ * @param {string} product_category The new product's category
+ * @param {string} product_brand The brand that the new product will be sold under
+ * @param {number|Array<Array<number>>} variable_costs One or more variable costs per unit
+ * @param {Array<Array<number|string>>} list_prices One or more list prices to apply at every enabled retailer (empty cells use the prices in retailers_mapping)
+ * @param {Array<Array<string|boolean|number>>} retailers_mapping A table that maps each retailer name to a boolean (whether it's enabled or not), and a number representing the list price for that retailer
+ * @param {number} num_years The number of years to forecast out
+ * @param {number|Array<Array<number>>} desired_irrs One or more desired internal rates of return
+ * @param {number|Array<Array<number>>} inital_investments One or more initial upfront investments
+ * @param {number} relevant_contribution_margin_range (Optional) A percentage indicating the range of contribution margins to consider when looking for comparable products
+ * @param {number} relevant_list_price_range (Optional) A percentage indicating the range of list prices to consider when looking for comparable products
+ * @return A table with one row per scenario
+ * @customfunction
+ */
+function FORECAST_SWEEP(
+  product_category,
+  product_brand,
+  variable_costs,
+  list_prices,
+  retailers_mapping,
+  num_years,
+  desired_irrs,
+  inital_investments,
+  relevant_contribution_margin_range = 999999999,
+  relevant_list_price_range = 999999999,
+) {
+  var json_data = JSON.stringify({
+      product_category,
+      product_brand,
+      variable_cost: flatten_(variable_costs),
+      list_price: flatten_(list_prices).map(p => p === '' ? null : p),
+      retailers_mapping,
+      num_years,
+      desired_irr: flatten_(desired_irrs),
+      inital_investment: flatten_(inital_investments),
+      relevant_contribution_margin_range,
+      relevant_list_price_range,
+    })
+  var response = post_("https://cs490.mcnamee.io/sweep", json_data)
+  if(response.getResponseCode() != '200') {
+    var message = response.getContentText()
+    try {
+      message = JSON.parse(response.getContentText())['message']
+    } catch {}
+    return "Error: " + message
+  }
+  var sweep = JSON.parse(response.getContentText())
+  var axes = sweep['axes']
+  var table = [["Variable Cost", "List Price", "Desired IRR", "Initial Investment", "NPV", "IRR", "Recommendation"]]
+  axes['variable_cost'].forEach((variable_cost, v) => {
+    axes['list_price'].forEach((list_price, p) => {
+      axes['desired_irr'].forEach((desired_irr, i) => {
+        axes['inital_investment'].forEach((inital_investment, n) => {
+          table.push([
+            variable_cost,
+            list_price === null ? '' : list_price,
+            desired_irr,
+            inital_investment,
+            sweep['npv'][v][p][i][n],
+            sweep['irr'][v][p][i][n] === null ? 'No IRR' : sweep['irr'][v][p][i][n],
+            sweep['recommendation'][v][p][i][n],
+          ])
+        })
+      })
+    })
+  })
+  return table
+}
+
+/**
+ * Simulate a new product launch many times, sampling the sales volume at
+ * each retailer in each year from comparable products, and summarize the
+ * spread of NPV and IRR and the probability that the project is viable.
+ *
+ * @param {string} product_category The new product's category
+ * @param {string} product_brand The brand that the new product will be sold under
+ * @param {number} variable_cost The new product's variable cost per unit
+ * @param {Array<Array<string|boolean|number>>} retailers_mapping A table that maps each retailer name to a boolean (whether it's enabled or not), and a number representing the list price for that retailer
+ * @param {number} num_years The number of years to forecast out
+ * @param {number} desired_irr The desired internal rate of return for this product
+ * @param {number} inital_investment The initial upfront investment required for the product
+ * @param {number} trials (Optional) The number of trials to run
+ * @param {boolean} sample_prices (Optional) Whether to also sample the market price from the spread of PriceAPI prices
+ * @param {number} time_budget_seconds (Optional) Stop after this many seconds with the trials run so far
+ * @param {number} relevant_contribution_margin_range (Optional) A percentage indicating the range of contribution margins to consider when looking for comparable products
+ * @param {number} relevant_list_price_range (Optional) A percentage indicating the range of list prices to consider when looking for comparable products
+ * @return A table of NPV and IRR percentiles and probabilities
+ * @customfunction
+ */
+function FORECAST_SIMULATION(
+  product_category,
+  product_brand,
+  variable_cost,
+  retailers_mapping,
+  num_years,
+  desired_irr,
+  inital_investment,
+  trials = 2000,
+  sample_prices = false,
+  time_budget_seconds = 5,
+  relevant_contribution_margin_range = 999999999,
+  relevant_list_price_range = 999999999,
+) {
+  var json_data = JSON.stringify({
+      product_category,
+      product_brand,
+      variable_cost,
+      retailers_mapping,
+      num_years,
+      desired_irr,
+      inital_investment,
+      relevant_contribution_margin_range,
+      relevant_list_price_range,
+      trials,
+      sample_prices,
+      time_budget_seconds,
+    })
+  var url = buildUrl_("https://cs490.mcnamee.io/simulate", { 'json_data': json_data })
+  var response = fetch_(url)
+  if(response.getResponseCode() != '200') {
+    var message = response.getContentText()
+    try {
+      message = JSON.parse(response.getContentText())['message']
+    } catch {}
+    return "Error: " + message
+  }
+  var simulation = JSON.parse(response.getContentText())
+  var table = [["Percentile", "NPV", "IRR"]]
+  Object.keys(simulation['npv']).filter(k => k[0] === 'p').forEach(k => {
+    var irr = simulation['irr'][k]
+    table.push([k.substring(1) + "%", simulation['npv'][k], irr === null ? 'No IRR' : irr])
+  })
+  table.push(["Mean", simulation['npv']['mean'], ''])
+  table.push(['', '', ''])
+  table.push(["Probability Viable", simulation['probability_viable'], ''])
+  table.push(["Probability Meets Desired IRR", simulation['probability_meets_desired_irr'], ''])
+  table.push(["Probability No IRR", simulation['irr']['no_irr_probability'], ''])
+  table.push(["Trials", simulation['trials'] + (simulation['truncated'] ? ' (time budget reached)' : ''), ''])
+  return table
+}
+
+/**
+ * Flattens a cell or range into a list of values, skipping empty rows.
+ * @param {*|Array<Array<*>>} range A single value or a 2D range of values.
+ * @return {Array<*>} The values in the range.
+ * @private
+ */
+function flatten_(range) {
+  if(!Array.isArray(range)) return [range]
+  var values = [].concat.apply([], range)
+  var nonEmpty = values.filter(v => v !== '')
+  return nonEmpty.length > 0 ? nonEmpty : ['']
+}
+
+// expands a sheet sent in the compact, column-oriented format (see compact_sheet in api/util.py)
+function expandColumns_(payload) {
+  if(payload.format !== 'columns') return payload
+  var rows = payload.shape[0], cols = payload.shape[1]
+  var sheet = []
+  for(var i = 0; i < rows; ++i) sheet.push(new Array(cols).fill(''))
+  payload.columns.forEach((runs, j) => runs.forEach(([first, values]) => {
+    values.forEach((value, k) => sheet[first + k][j] = value)
+  }))
+  payload.text.forEach(([i, j, k]) => sheet[i][j] = payload.strings[k])
+  return sheet
+}
+
+// sends the spreadsheet's id, so a busy API takes turns between spreadsheets
+function fetch_(url, options = {}) {
+  var caller = ''
+  try {
+    caller = SpreadsheetApp.getActiveSpreadsheet().getId()
+  } catch {}
+  var headers = Object.assign({ 'X-Caller': caller }, options.headers || {})
+  return UrlFetchApp.fetch(url, Object.assign({ 'muteHttpExceptions': true }, options, { 'headers': headers }))
+}
+
+// POSTs a request gzipped, so large retailer tables and long axes don't run into URL length limits
+function post_(url, json_data) {
+  return fetch_(url, {
+    'method': 'post',
+    'contentType': 'application/json',
+    'headers': { 'Content-Encoding': 'gzip' },
+    'payload': Utilities.gzip(Utilities.newBlob(json_data, 'application/json')).getBytes(),
+  })
 }
 
 // Sourced from: https://github.com/googleworkspace/apps-script-oauth2/blob/ade8b9a8c5e8117ea18bcd14fcd1bb779a3425f8/src/Utilities.js#L27
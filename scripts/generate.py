@@ -0,0 +1,113 @@
+# Generates synthetic historical sales data at production scale, as CSV files
+# that scripts/ingest.py can load. e.g. 20000 products x 25 retailers x 8 years:
+#   python ../scripts/generate.py --out data --products 20000 --retailers 25 --years 8
+#
+# Brands and categories are skewed (a few big brands and categories hold most
+# products, Zipf-like), as are retailers (a few big chains sell most volume),
+# and not every product is sold at every retailer in every year.
+
+import argparse
+import csv
+import gzip
+import os
+import sys
+import time
+
+import numpy as np
+
+BRAND_PREFIXES = ['Crest', 'Oral-B', 'Colgate', 'Sensodyne', 'Listerine', 'Aquafresh', 'Philips', 'Arm & Hammer']
+CATEGORIES = ['Toothpaste', 'Toothbrush', 'Mouthwash', 'Floss', 'Whitening Strips', 'Electric Toothbrush', 'Denture Care', 'Tongue Scraper']
+COUNTRIES = ['Canada', 'USA']
+
+
+def zipf_weights(n, exponent):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def open_output(path, compress):
+    if compress:
+        return gzip.open(path + '.gz', 'wt', newline='')
+    return open(path, 'w', newline='')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic historical sales data')
+    parser.add_argument('--out', default='data', help='directory to write the CSV files to')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--retailers', type=int, default=20)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--brands', type=int, default=40)
+    parser.add_argument('--categories', type=int, default=len(CATEGORIES))
+    parser.add_argument('--coverage', type=float, default=0.6, help='average fraction of retailer-years each product is sold in')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of brand, category and retailer popularity')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true', help='write .csv.gz files')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    started = time.perf_counter()
+
+    retailer_ids = np.arange(1, args.retailers + 1)
+    # big chains sell more of each product and carry more of the catalogue
+    retailer_size = zipf_weights(args.retailers, args.skew) * args.retailers
+    with open_output(os.path.join(args.out, 'retailers.csv'), args.gzip) as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'name', 'shorthand', 'country'])
+        for i in retailer_ids:
+            writer.writerow([i, f'Retailer {i}', f'R{i:03d}', COUNTRIES[i % len(COUNTRIES)]])
+
+    with open_output(os.path.join(args.out, 'agreements.csv'), args.gzip) as f:
+        writer = csv.writer(f)
+        writer.writerow(['retailer_id', 'year', 'retailer_markup', 'display_costs', 'priority_shelving_costs', 'preferred_vendor_agreement_costs'])
+        for i in retailer_ids:
+            for year in range(1, args.years + 1):
+                writer.writerow([i, year, round(rng.uniform(0.05, 0.4), 4), *rng.integers(0, 50000, size=3)])
+
+    brands = [f'{BRAND_PREFIXES[b % len(BRAND_PREFIXES)]} {b // len(BRAND_PREFIXES) + 1}' for b in range(args.brands)]
+    categories = [
+        CATEGORIES[c] if c < len(CATEGORIES) else f'{CATEGORIES[c % len(CATEGORIES)]} {c // len(CATEGORIES) + 1}'
+        for c in range(args.categories)
+    ]
+    brand_of = rng.choice(args.brands, size=args.products, p=zipf_weights(args.brands, args.skew))
+    category_of = rng.choice(args.categories, size=args.products, p=zipf_weights(args.categories, args.skew))
+    category_price = rng.uniform(3, 60, size=args.categories)
+    brand_strength = rng.lognormal(0, 0.5, size=args.brands)
+
+    with open_output(os.path.join(args.out, 'products.csv'), args.gzip) as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'brand_name', 'category'])
+        for p in range(args.products):
+            writer.writerow([p + 1, brands[brand_of[p]], categories[category_of[p]]])
+
+    rows = 0
+    carried = np.clip(args.coverage * retailer_size / retailer_size.mean(), 0, 1)
+    with open_output(os.path.join(args.out, 'facts.csv'), args.gzip) as f:
+        writer = csv.writer(f)
+        writer.writerow(['product_id', 'retailer_id', 'year', 'contribution_margin', 'list_price', 'volume_sold'])
+        for p in range(args.products):
+            sold = rng.random((args.retailers, args.years)) < carried[:, np.newaxis]
+            r, y = np.nonzero(sold)
+            if not len(r):
+                continue
+            list_price = category_price[category_of[p]] * rng.lognormal(0, 0.25, size=len(r))
+            margin = rng.beta(2, 5, size=len(r))
+            volume = rng.poisson(2000 * brand_strength[brand_of[p]] * retailer_size[r] * np.exp(-0.1 * y))
+            writer.writerows(zip(
+                np.full(len(r), p + 1),
+                retailer_ids[r],
+                y + 1,
+                np.round(margin, 4),
+                np.round(list_price, 2),
+                volume,
+            ))
+            rows += len(r)
+            if (p + 1) % 1000 == 0:
+                print(f'\r{p + 1}/{args.products} products, {rows} rows', end='', file=sys.stderr)
+
+    print(f'\rwrote {args.products} products, {args.retailers} retailers and {rows} rows to {args.out} in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
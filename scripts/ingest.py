@@ -0,0 +1,140 @@
+# Bulk loads historical data from CSV or JSONL files (optionally gzipped), e.g.
+# the output of scripts/generate.py:
+#   python ../scripts/ingest.py --retailers data/retailers.csv --products data/products.csv \
+#       --agreements data/agreements.csv --facts data/facts.csv
+#
+# Files are streamed in chunks of --chunk-size rows, so memory stays bounded no
+# matter how large they are. Each chunk is one multi-row upsert: existing rows
+# (by primary key) are updated, new ones inserted. Afterwards the data version
+# is bumped and the volume buckets rebuilt, so running API servers pick it up.
+
+import argparse
+import asyncio
+import csv
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Sequence
+
+from prisma import Prisma
+
+# run from src/ (see makefile), but make the api package importable either way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from api.queries import rebuild_volume_buckets
+
+# MySQL allows at most 65535 placeholders per statement
+MAX_PLACEHOLDERS = 65535
+
+
+@dataclass
+class Table:
+    name: str
+    columns: Sequence[str]
+    types: Sequence[Callable[[Any], Any]]
+    num_keys: int  # the first num_keys columns are the primary key
+
+    def upsert_sql(self, num_rows: int) -> str:
+        row = '(' + ', '.join('?' for _ in self.columns) + ')'
+        updates = ', '.join(f'{c} = VALUES({c})' for c in self.columns[self.num_keys:])
+        return (
+            f'INSERT INTO {self.name} ({", ".join(self.columns)}) '
+            f'VALUES {", ".join(row for _ in range(num_rows))} '
+            f'ON DUPLICATE KEY UPDATE {updates}'
+        )
+
+    def parse(self, record: Dict[str, Any]) -> List[Any]:
+        try:
+            return [convert(record[c]) for c, convert in zip(self.columns, self.types)]
+        except KeyError as e:
+            raise ValueError(f'{self.name} record is missing column {e}: {record}') from e
+
+
+# in load order, so facts never reference a missing product or retailer
+TABLES = {
+    'retailers': Table('Retailer', ['id', 'name', 'shorthand', 'country'], [int, str, str, str], 1),
+    'products': Table('Product', ['id', 'brand_name', 'category'], [int, str, str], 1),
+    'agreements': Table(
+        'RetailerYear',
+        ['retailer_id', 'year', 'retailer_markup', 'display_costs', 'priority_shelving_costs', 'preferred_vendor_agreement_costs'],
+        [int, int, float, float, float, float],
+        2,
+    ),
+    'facts': Table(
+        'ProductRetailerYear',
+        ['product_id', 'retailer_id', 'year', 'contribution_margin', 'list_price', 'volume_sold'],
+        [int, int, int, float, float, float],
+        3,
+    ),
+}
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Streams records from a .csv or .jsonl/.ndjson file, optionally .gz"""
+    opener = gzip.open if path.endswith('.gz') else open
+    name = path[:-3] if path.endswith('.gz') else path
+    with opener(path, 'rt', newline='') as f:
+        if name.endswith('.csv'):
+            yield from csv.DictReader(f)
+        elif name.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Don't know how to read {path}, expected .csv or .jsonl")
+
+
+def chunks(records: Iterator[Any], size: int) -> Iterator[List[Any]]:
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def ingest(db: Prisma, table: Table, path: str, chunk_size: int) -> int:
+    chunk_size = min(chunk_size, MAX_PLACEHOLDERS // len(table.columns))
+    started = time.perf_counter()
+    rows = 0
+    for chunk in chunks(read_records(path), chunk_size):
+        values = [value for record in chunk for value in table.parse(record)]
+        await db.execute_raw(table.upsert_sql(len(chunk)), *values)
+        rows += len(chunk)
+        elapsed = time.perf_counter() - started
+        print(f'\r{table.name}: {rows} rows ({rows / elapsed:.0f} rows/s)', end='', file=sys.stderr)
+    print(f'\r{table.name}: {rows} rows in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+    return rows
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Bulk load historical data from CSV or JSONL files')
+    for kind in TABLES:
+        parser.add_argument(f'--{kind}', help=f'file of {TABLES[kind].name} rows')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='rows per upsert')
+    args = parser.parse_args()
+    files = {kind: getattr(args, kind) for kind in TABLES if getattr(args, kind)}
+    if not files:
+        parser.error('nothing to ingest')
+
+    db = Prisma()
+    await db.connect()
+    try:
+        for kind, path in files.items():
+            await ingest(db, TABLES[kind], path, args.chunk_size)
+        # lets running API servers know their in-memory copies are out of date
+        await db.dataversion.upsert(
+            where={'id': 1},
+            data={'create': {'id': 1, 'version': 1}, 'update': {'version': {'increment': 1}}},
+        )
+        print('rebuilding volume buckets...', file=sys.stderr)
+        await rebuild_volume_buckets(db)
+    finally:
+        await db.disconnect()
+    print('Done ✨')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -3,7 +3,13 @@
 from prisma import Prisma
 from prisma.types import RetailerCreateInput, ProductRetailerYearCreateInput, ProductCreateInput, RetailerYearCreateInput
 import asyncio
+import os
 import random
+import sys
+
+# run from src/ (see makefile), but make the api package importable either way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from api.queries import rebuild_volume_buckets
 
 async def main():
     print('Seeding database with mock data...')
@@ -78,6 +84,12 @@ async def main():
         for year in range(1, 8+1)],
         skip_duplicates=True
     )
+    # lets running API servers know their in-memory copies are out of date
+    await db.dataversion.upsert(
+        where={'id': 1},
+        data={'create': {'id': 1, 'version': 1}, 'update': {'version': {'increment': 1}}},
+    )
+    await rebuild_volume_buckets(db)
     print('Done ✨')
 
 asyncio.run(main())
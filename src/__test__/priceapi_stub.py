@@ -0,0 +1,72 @@
+"""
+Local stand-in for PriceAPI, for testing the price client without a token
+or network access. Jobs finish after STUB_JOB_SECONDS, every response is
+delayed by STUB_LATENCY_SECONDS, and /stats counts the jobs created.
+
+Run with `python -m uvicorn __test__.priceapi_stub:app --port 8001` and
+start the API with PRICE_API_URL=http://127.0.0.1:8001/v2
+"""
+import asyncio
+import itertools
+import os
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+JOB_SECONDS = float(os.environ.get("STUB_JOB_SECONDS", "1"))
+LATENCY_SECONDS = float(os.environ.get("STUB_LATENCY_SECONDS", "0.05"))
+
+job_ids = itertools.count(1)
+jobs = {}
+
+
+async def create_job(request: Request):
+    """POST /v2/jobs"""
+    await asyncio.sleep(LATENCY_SECONDS)
+    payload = await request.json()
+    job_id = str(next(job_ids))
+    jobs[job_id] = {"created": time.monotonic(), "values": payload["values"]}
+    return JSONResponse({"job_id": job_id, "status": "new"})
+
+
+async def job_status(request: Request):
+    """GET /v2/jobs/{job_id}"""
+    await asyncio.sleep(LATENCY_SECONDS)
+    job = jobs.get(request.path_params["job_id"])
+    if job is None:
+        return JSONResponse({"status": "cancelled"}, status_code=404)
+    finished = time.monotonic() - job["created"] >= JOB_SECONDS
+    return JSONResponse({"status": "finished" if finished else "working"})
+
+
+async def download(request: Request):
+    """GET /v2/jobs/{job_id}/download.json"""
+    await asyncio.sleep(LATENCY_SECONDS)
+    job = jobs[request.path_params["job_id"]]
+    rng = random.Random(job["values"])
+    search_results = []
+    for _ in range(20):
+        low = round(rng.uniform(2, 30), 2)
+        search_results.append({"min_price": str(low), "max_price": str(round(low * 1.2, 2))})
+    return JSONResponse(
+        {"results": [{"content": {"search_results": search_results}}]}
+    )
+
+
+async def stats(_: Request):
+    """GET /stats, the number of jobs created so far"""
+    return JSONResponse({"jobs": len(jobs)})
+
+
+app = Starlette(
+    routes=[
+        Route("/v2/jobs", create_job, methods=["POST"]),
+        Route("/v2/jobs/{job_id}", job_status, methods=["GET"]),
+        Route("/v2/jobs/{job_id}/download.json", download, methods=["GET"]),
+        Route("/stats", stats, methods=["GET"]),
+    ]
+)
@@ -0,0 +1,143 @@
+"""
+Tests of admission control: input limits, cost estimates, and the fair
+queue for expensive requests.
+"""
+import asyncio
+
+import pytest
+
+from api import admission
+from api.admission import FairQueue, Overloaded, check_limits, forecast_cost
+from api.deadline import start_deadline
+
+
+def kwargs(enabled=2, disabled=1, num_years=3, **extra):
+    """`calc_output` keyword arguments with the given numbers of retailers"""
+    mapping = {f"Retailer {i}": (i < enabled, "") for i in range(enabled + disabled)}
+    return {
+        "product_brand": "Crest",
+        "product_category": "Toothpaste",
+        "retailers_mapping": mapping,
+        "num_years": num_years,
+        **extra,
+    }
+
+
+@pytest.mark.parametrize("num_years", [0, admission.MAX_NUM_YEARS + 1, 2.0, "3"])
+def test_check_limits_rejects_years(num_years):
+    with pytest.raises(AssertionError, match="num_years"):
+        check_limits(1, num_years)
+
+
+def test_check_limits():
+    check_limits(admission.MAX_RETAILERS, admission.MAX_NUM_YEARS)
+    with pytest.raises(AssertionError, match="retailers"):
+        check_limits(admission.MAX_RETAILERS + 1, 1)
+
+
+def test_forecast_cost(monkeypatch):
+    monkeypatch.setattr(admission.product_snapshot, "current", None)
+    rows = admission.EXPECTED_COMPARABLE_ROWS
+    # only enabled retailers count
+    assert forecast_cost(kwargs()) == 2 * 3 * (rows + 1)
+    assert forecast_cost(kwargs(), scenarios=50) == 2 * 3 * (rows + 50)
+    assert forecast_cost(kwargs(nearest_comparables=10)) == 2 * 3 * (10 + 1)
+
+
+def test_admit_rejects_requests_over_the_limit():
+    async def run():
+        async with admission.admit(admission.MAX_REQUEST_COST + 1, "caller"):
+            pass
+
+    with pytest.raises(AssertionError, match="too expensive"):
+        asyncio.run(run())
+
+
+def run_queue(queue, requests):
+    """
+    Runs (caller, name) requests through the queue, the first of which
+    holds its slot until the rest are queued, and returns the order they ran in.
+    """
+    ran = []
+    queued = asyncio.Event()
+
+    async def request(caller, name, hold):
+        async with queue.slot(caller):
+            if hold:
+                await queued.wait()
+            ran.append(name)
+
+    async def run():
+        tasks = [
+            asyncio.create_task(request(caller, name, i == 0)) for i, (caller, name) in enumerate(requests)
+        ]
+        await asyncio.sleep(0)
+        queued.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    return ran, queue
+
+
+def test_callers_take_turns():
+    requests = [("a", "A0"), ("a", "A1"), ("a", "A2"), ("a", "A3"), ("b", "B0"), ("b", "B1"), ("c", "C0")]
+    ran, queue = run_queue(FairQueue(slots=1, max_per_caller=4), requests)
+    assert ran == ["A0", "A1", "B0", "C0", "A2", "B1", "A3"]
+    assert queue.stats() == {"queued": 0, "running": 0, "callers": 0}
+
+
+def test_slots_run_concurrently():
+    ran, queue = run_queue(FairQueue(slots=2), [("a", "A0"), ("a", "A1"), ("a", "A2")])
+    # A1 doesn't wait for A0, which holds the other slot, and then hands its slot to A2
+    assert ran == ["A1", "A2", "A0"]
+    assert queue.running == 0
+
+
+def test_rejects_callers_with_too_many_waiting():
+    queue = FairQueue(slots=1, max_per_caller=1)
+
+    async def run():
+        async with queue.slot("a"):
+            waiting = asyncio.create_task(queue._acquire("a"))  # pylint: disable=protected-access
+            await asyncio.sleep(0)
+            try:
+                await queue._acquire("a")  # pylint: disable=protected-access
+            finally:
+                waiting.cancel()
+
+    with pytest.raises(Overloaded) as raised:
+        asyncio.run(run())
+    assert raised.value.status_code == 429
+    assert queue.queued == 0
+
+
+def test_rejects_when_the_queue_is_full():
+    queue = FairQueue(slots=1, max_queued=1)
+
+    async def run():
+        async with queue.slot("a"):
+            waiting = asyncio.create_task(queue._acquire("a"))  # pylint: disable=protected-access
+            await asyncio.sleep(0)
+            try:
+                await queue._acquire("b")  # pylint: disable=protected-access
+            finally:
+                waiting.cancel()
+
+    with pytest.raises(Overloaded) as raised:
+        asyncio.run(run())
+    assert raised.value.status_code == 503
+
+
+def test_waiting_past_the_deadline_is_overloaded():
+    queue = FairQueue(slots=1)
+
+    async def run():
+        async with queue.slot("a"):
+            start_deadline(0.01)
+            async with queue.slot("b"):
+                pass
+
+    with pytest.raises(Overloaded) as raised:
+        asyncio.run(run())
+    assert raised.value.status_code == 503
+    assert queue.stats() == {"queued": 0, "running": 0, "callers": 0}
@@ -0,0 +1,137 @@
+"""
+Tests of batch forecasts: each group's deadline, and the fallbacks each
+result reports.
+"""
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from api import batch
+from api.deadline import PARTIAL_RESULT, STALE_PRICE, DeadlineExceeded, record_fallback, remaining
+
+
+def spec(product_category="Toothbrush", list_price=""):
+    """A parsed forecast spec, as run_batch receives it"""
+    return {
+        "product_category": product_category,
+        "product_brand": "Crest",
+        "variable_cost": 1.5,
+        "retailers_mapping": {"Retailer 1": (True, list_price)},
+        "num_years": 3,
+        "desired_irr": 0.1,
+        "inital_investment": 100000,
+        "relevant_contribution_margin_range": 0.1,
+        "relevant_list_price_range": 0.1,
+    }
+
+
+@pytest.fixture(name="deadlines")
+def fixture_deadlines(monkeypatch):
+    """
+    The time left when each group loaded its data. A list price of "late"
+    runs out of time and "stale" falls back to a stale market price.
+    """
+    seen = []
+
+    @contextlib.asynccontextmanager
+    async def session():
+        yield None
+
+    async def load_retailers(db, retailers_mapping, num_years):  # pylint: disable=unused-argument
+        seen.append(remaining())
+        return [SimpleNamespace(id=1, name="Retailer 1")], {}
+
+    async def load_comparables(*args):  # pylint: disable=unused-argument
+        return {}
+
+    async def base_list_prices(product_category, retailers, agreements, retailers_mapping, num_years):
+        # pylint: disable=unused-argument
+        list_price = retailers_mapping["Retailer 1"][1]
+        if list_price == "late":
+            raise DeadlineExceeded("Ran out of time fetching the market price")
+        if list_price == "stale":
+            record_fallback(STALE_PRICE)
+        return {}
+
+    monkeypatch.setattr(batch, "database", SimpleNamespace(session=session))
+    monkeypatch.setattr(batch, "load_retailers", load_retailers)
+    monkeypatch.setattr(batch, "load_partitions", load_comparables)
+    monkeypatch.setattr(batch, "load_comparable_columns", load_comparables)
+    monkeypatch.setattr(batch, "base_list_prices", base_list_prices)
+    monkeypatch.setattr(batch, "comparable_volumes", lambda *args: {})
+    monkeypatch.setattr(batch, "forecast_sheet", lambda *args, **kwargs: [["sheet", ""]])
+    return seen
+
+
+@pytest.fixture(name="loads")
+def fixture_loads(deadlines, monkeypatch):  # pylint: disable=unused-argument
+    """Which comparables each group loaded: indexed "partitions" or plain "columns" """
+    loads = []
+
+    async def load_partitions(*args):  # pylint: disable=unused-argument
+        loads.append("partitions")
+        return {}
+
+    async def load_comparable_columns(*args):  # pylint: disable=unused-argument
+        loads.append("columns")
+        return {}
+
+    monkeypatch.setattr(batch, "load_partitions", load_partitions)
+    monkeypatch.setattr(batch, "load_comparable_columns", load_comparable_columns)
+    monkeypatch.setattr(batch, "nearest_volumes", lambda *args: {})
+    return loads
+
+
+def run_batch(items):
+    """The results of a batch, by item id"""
+
+    async def run():
+        return {result["id"]: result async for result in batch.run_batch(items)}
+
+    return asyncio.run(run())
+
+
+def test_each_group_gets_a_deadline(deadlines):
+    results = run_batch([(0, spec("Toothbrush")), (1, spec("Toothpaste")), (2, spec("Toothbrush"))])
+    assert len(deadlines) == 2
+    assert all(left is not None and left > 0 for left in deadlines)
+    assert {result["status"] for result in results.values()} == {200}
+
+
+def test_each_result_reports_its_own_fallbacks(deadlines):  # pylint: disable=unused-argument
+    results = run_batch(
+        [(0, spec(list_price="stale")), (1, spec(list_price=5.0)), (2, spec(list_price="late"))]
+    )
+    assert results[0]["fallbacks"] == [STALE_PRICE]
+    assert results[0]["output"][-1][0] == "Note:"
+    assert results[1]["fallbacks"] == []
+    assert results[1]["output"] == [["sheet", ""]]
+    # a forecast that runs out of time is a partial result, not an error
+    assert results[2]["status"] == 200
+    assert results[2]["fallbacks"] == [PARTIAL_RESULT]
+
+
+def test_only_nearest_groups_load_partitions(loads):
+    nearest = {**spec("Toothpaste"), "nearest_comparables": 5}
+    results = run_batch([(0, spec("Toothbrush")), (1, nearest), (2, spec("Toothpaste"))])
+    assert sorted(loads) == ["columns", "partitions"]
+    assert {result["status"] for result in results.values()} == {200}
+
+
+def test_unexpected_group_errors_answer_every_member(monkeypatch):
+    async def forecast_group(members):
+        yield batch.sheet_result(members[0][0], [["sheet", ""]])
+        raise RuntimeError("group failed")
+
+    monkeypatch.setattr(batch, "forecast_group", forecast_group)
+
+    async def run():
+        results = [result async for result in batch.run_batch([(i, spec()) for i in range(3)])]
+        return {result["id"]: result for result in results}
+
+    # the stream ends instead of waiting for the members that never got a result
+    results = asyncio.run(asyncio.wait_for(run(), 5))
+    assert [results[i]["status"] for i in range(3)] == [200, 500, 500]
+    assert results[2]["message"] == "group failed"
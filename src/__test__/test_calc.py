@@ -0,0 +1,50 @@
+"""
+Tests of the forecast's list prices.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from api import calc
+
+RETAILERS = [SimpleNamespace(id=1, name="Retailer 1"), SimpleNamespace(id=2, name="Retailer 2")]
+NUM_YEARS = 3
+AGREEMENTS = {
+    (r.id, y): SimpleNamespace(retailer_markup=0.25 * r.id)
+    for r in RETAILERS
+    for y in range(1, NUM_YEARS + 1)
+}
+
+
+@pytest.fixture(name="price_lookups")
+def fixture_price_lookups(monkeypatch):
+    """Categories the market price was looked up for, which is always 100"""
+    lookups = []
+
+    async def get_average_price(product_category):
+        lookups.append(product_category)
+        return 100.0
+
+    monkeypatch.setattr(calc, "get_average_price", get_average_price)
+    return lookups
+
+
+def list_prices(retailers_mapping):
+    """The list prices of RETAILERS with the given mapping"""
+    return asyncio.run(
+        calc.base_list_prices("Toothbrush", RETAILERS, AGREEMENTS, retailers_mapping, NUM_YEARS)
+    )
+
+
+def test_market_price_is_fetched_once(price_lookups):
+    prices = list_prices({"Retailer 1": (True, ""), "Retailer 2": (True, "")})
+    assert price_lookups == ["Toothbrush"]
+    assert prices[(1, 1)] == pytest.approx(100 / 1.25)
+    assert prices[(2, NUM_YEARS)] == pytest.approx(100 / 1.5)
+
+
+def test_given_list_prices_skip_the_market_price(price_lookups):
+    prices = list_prices({"Retailer 1": (True, 4.0), "Retailer 2": (True, 5.0)})
+    assert not price_lookups
+    assert prices == {(r.id, y): 4.0 + (r.id - 1) for r in RETAILERS for y in range(1, NUM_YEARS + 1)}
@@ -0,0 +1,58 @@
+"""
+Tests of the shared database client.
+"""
+import asyncio
+
+import pytest
+
+from api import db
+from api.db import Database, pooled_url
+
+
+class FakePrisma:
+    """A Prisma client that records its connects and disconnects"""
+
+    def __init__(self, fail_disconnect=False):
+        self.connected = False
+        self.disconnects = 0
+        self.fail_disconnect = fail_disconnect
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def disconnect(self):
+        self.disconnects += 1
+        if self.fail_disconnect:
+            raise db.EngineConnectionError("the query engine is gone")
+        self.connected = False
+
+
+def test_pooled_url_keeps_configured_settings():
+    url = pooled_url("mysql://u:p@host:3306/db?connection_limit=3", 10, 5)
+    assert url == "mysql://u:p@host:3306/db?connection_limit=3&pool_timeout=5"
+
+
+@pytest.mark.parametrize("fail_disconnect", [False, True])
+def test_broken_sessions_disconnect_the_client(monkeypatch, fail_disconnect):
+    clients = []
+
+    def create_client(self):  # pylint: disable=unused-argument
+        clients.append(FakePrisma(fail_disconnect))
+        return clients[-1]
+
+    monkeypatch.setattr(Database, "_create_client", create_client)
+    database = Database()
+
+    async def run():
+        with pytest.raises(db.NotConnectedError):
+            async with database.session():
+                raise db.NotConnectedError("connection reset")
+        async with database.session() as client:
+            return client
+
+    assert asyncio.run(run()) is clients[1]
+    assert clients[0].disconnects == 1
+    assert database.is_connected
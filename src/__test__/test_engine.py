@@ -0,0 +1,82 @@
+"""
+Tests of the vectorized forecast engine against the line items computed
+one cell at a time, as calc.py used to.
+"""
+import numpy as np
+import pytest
+
+from api.engine import compute_forecast, contribution_margins, window_mask
+
+
+def cell_by_cell(volume, list_price, retailer_markup, fixed_costs, variable_cost, inital_investment):
+    """The forecast's cashflows and retailer prices, one retailer and year at a time"""
+    retailers, years = volume.shape
+    retailer_price = np.empty((retailers, years))
+    cashflows = [-inital_investment]
+    for y in range(years):
+        net_revenue = 0.0
+        for r in range(retailers):
+            retailer_price[r, y] = list_price[r, y] * (1 + retailer_markup[r, y])
+            margin = (list_price[r, y] - variable_cost) / list_price[r, y]
+            net_revenue += volume[r, y] * list_price[r, y] * margin - fixed_costs[r, y]
+        cashflows.append(net_revenue)
+    return retailer_price, np.array(cashflows)
+
+
+def random_inputs(rng, retailers=4, years=5):
+    """Random (retailers x years) volumes, list prices, markups and fixed costs"""
+    shape = (retailers, years)
+    return (
+        rng.uniform(0, 5000, shape),
+        rng.uniform(1, 20, shape),
+        rng.uniform(0, 0.5, shape),
+        rng.uniform(0, 1000, shape),
+    )
+
+
+def test_matches_cell_by_cell():
+    rng = np.random.default_rng(0)
+    volume, list_price, markup, fixed_costs = random_inputs(rng)
+    result = compute_forecast(volume, list_price, markup, fixed_costs, 2.5, 10000)
+    retailer_price, cashflows = cell_by_cell(volume, list_price, markup, fixed_costs, 2.5, 10000)
+    np.testing.assert_allclose(result.retailer_price, retailer_price)
+    np.testing.assert_allclose(result.cashflows, cashflows)
+    np.testing.assert_allclose(result.retailer_sales_revenue, volume * retailer_price)
+    assert result.year_totals(result.volume).shape == (5,)
+    assert result.retailer_totals(result.volume).shape == (4,)
+
+
+def test_scenarios_are_computed_in_one_pass():
+    rng = np.random.default_rng(1)
+    volume, list_price, markup, fixed_costs = random_inputs(rng)
+    variable_costs = np.array([1.0, 2.0, 3.0])
+    investments = np.array([5000.0, 10000.0, 20000.0])
+    volumes = np.stack([volume, volume * 2, volume / 2])
+    result = compute_forecast(volumes, list_price, markup, fixed_costs, variable_costs, investments)
+    assert result.cashflows.shape == (3, 6)
+    for s in range(3):
+        _, cashflows = cell_by_cell(
+            volumes[s], list_price, markup, fixed_costs, variable_costs[s], investments[s]
+        )
+        np.testing.assert_allclose(result.cashflows[s], cashflows)
+
+
+def test_contribution_margins():
+    assert contribution_margins(np.array([10.0, 4.0]), 2.0).tolist() == [0.8, 0.5]
+
+
+@pytest.mark.parametrize("margin_range, price_range", [(0.1, 0.2), (1.0, 0.05), (0.0, 0.0)])
+def test_window_mask_matches_each_row(margin_range, price_range):
+    rng = np.random.default_rng(2)
+    prices = rng.uniform(1, 20, 200)
+    margins = rng.uniform(0, 1, 200)
+    list_price, margin = np.array([5.0, 12.0]), np.array([0.4, 0.7])
+    mask = window_mask(prices, margins, list_price, margin, margin_range, price_range)
+    assert mask.shape == (2, 200)
+    for i in range(2):
+        expected = [
+            margin[i] - margin_range <= m <= margin[i] + margin_range
+            and list_price[i] * (1 - price_range) <= p <= list_price[i] * (1 + price_range)
+            for p, m in zip(prices, margins)
+        ]
+        assert mask[i].tolist() == expected
@@ -0,0 +1,109 @@
+"""
+Tests of the batched NPV and IRR kernels against numpy_financial, which
+they replaced.
+"""
+import numpy as np
+import numpy_financial as npf
+import pytest
+
+from api import finance
+
+
+def cashflows_with_irrs(*rates: float, scale: float = 100.0) -> np.ndarray:
+    """Cashflows whose NPV is zero at exactly the given rates"""
+    # the NPV is a polynomial in 1 / (1 + rate), with the cashflows as coefficients
+    return scale * np.poly([1 / (1 + r) for r in rates])[::-1]
+
+
+@pytest.mark.parametrize(
+    "cashflows",
+    [
+        [-100, 39, 59, 55, 20],
+        [-1000, 0, 0, 0, 2000],
+        [-100, 10, 110],
+        [-5000, 100, 100, 100, 100],
+        [-1e6, 3e5, 3e5, 3e5, 3e5, 3e5],
+        [-100, 150],
+    ],
+)
+def test_irr_matches_npf(cashflows):
+    solved = finance.irr(np.array(cashflows, dtype=float))
+    assert solved.converged and not solved.no_irr and not solved.multiple_irr
+    assert solved.irr == pytest.approx(npf.irr(cashflows), rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize(
+    "rates",
+    [(0.555, -0.573), (-0.3, 0.2), (0.1, 0.5, 2.0), (-0.9, 0.05, 30.0), (-0.2, 0.25)],
+)
+def test_multiple_irrs_report_the_one_closest_to_zero(rates):
+    cashflows = cashflows_with_irrs(*rates)
+    solved = finance.irr(cashflows)
+    closest = min(rates, key=abs)
+    assert solved.multiple_irr and solved.converged
+    assert solved.irr == pytest.approx(closest, abs=1e-9)
+    assert solved.irr == pytest.approx(npf.irr(cashflows), abs=1e-9)
+
+
+@pytest.mark.parametrize(
+    "cashflows, expected",
+    [
+        # outside the -99.9% to +99900% of the original grid
+        ([-1e9, 1, 1], -0.9999683767233943),
+        ([-100, 1e6], 9999.0),
+    ],
+)
+def test_extreme_irrs(cashflows, expected):
+    solved = finance.irr(np.array(cashflows, dtype=float))
+    assert solved.converged and not solved.no_irr
+    assert solved.irr == pytest.approx(expected, rel=1e-9)
+    assert solved.irr == pytest.approx(npf.irr(cashflows), rel=1e-9)
+
+
+@pytest.mark.parametrize("cashflows", [[100, 100, 100], [-100, -1, -1], [0, 0, 0]])
+def test_no_irr(cashflows):
+    solved = finance.irr(np.array(cashflows, dtype=float))
+    assert solved.no_irr and np.isnan(solved.irr)
+    assert np.isnan(npf.irr(cashflows))
+
+
+def test_random_cashflows_agree_with_npf():
+    """Wherever npf finds an IRR in the grid's range, the kernel finds the same one"""
+    rng = np.random.default_rng(490)
+    for _ in range(3000):
+        years = rng.integers(2, 12)
+        cashflows = rng.normal(size=years) * rng.choice([1, 10, 1e3, 1e6], size=years)
+        expected = npf.irr(cashflows)
+        if np.isnan(expected) or not -0.999999 < expected < 999999:
+            continue
+        solved = finance.irr(cashflows)
+        assert not solved.no_irr and solved.converged, cashflows
+        assert solved.irr == pytest.approx(expected, rel=1e-6, abs=1e-9), cashflows
+
+
+def test_batched_irr_matches_one_at_a_time():
+    rng = np.random.default_rng(17)
+    cashflows = np.concatenate(
+        [-rng.uniform(1e4, 1e6, (4, 50, 1)), rng.uniform(-1e4, 3e5, (4, 50, 10))], axis=-1
+    )
+    solved = finance.irr(cashflows)
+    assert solved.irr.shape == (4, 50)
+    for index in np.ndindex(4, 50):
+        one = finance.irr(cashflows[index])
+        assert solved.status[index] == one.status
+        np.testing.assert_allclose(solved.irr[index], one.irr, rtol=1e-12)
+        np.testing.assert_allclose(solved.irr[index], npf.irr(cashflows[index]), rtol=1e-6)
+
+
+def test_npv_matches_npf():
+    cashflows = np.array([[-1000, 300, 400, 500], [-10, 0, 0, 20]], dtype=float)
+    rates = np.array([0.07, -0.2])
+    expected = [npf.npv(r, c) for r, c in zip(rates, cashflows)]
+    np.testing.assert_allclose(finance.npv(rates, cashflows), expected, rtol=1e-12)
+    np.testing.assert_allclose(finance.npv(0.1, cashflows), [npf.npv(0.1, c) for c in cashflows])
+
+
+def test_recommend():
+    npv = np.array([-1.0, 5.0, 5.0, 5.0])
+    irr = np.array([0.3, 0.05, 0.3, np.nan])
+    assert finance.recommend(npv, irr, 0.1).tolist() == [0, 1, 2, 1]
@@ -0,0 +1,131 @@
+"""
+Tests of request handling shared by the Flask and ASGI apps.
+"""
+import asyncio
+import contextlib
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from api import admission, handlers, result_cache
+from api.admission import Overloaded
+from api.result_cache import ResultCache
+
+SPEC = {
+    "product_category": "Toothbrush",
+    "product_brand": "Crest",
+    "variable_cost": 1.5,
+    "retailers_mapping": [["Retailer 1", True, ""], ["Retailer 2", False, 4.99]],
+    "num_years": 3,
+    "desired_irr": 0.1,
+    "inital_investment": 100000,
+}
+
+
+@pytest.fixture(name="sheets")
+def fixture_sheets(monkeypatch):
+    """
+    Sheets computed by compute_sheet_data, with every forecast expensive
+    and the expensive queue full.
+    """
+    computed = []
+
+    async def calc_output(**kwargs):
+        computed.append(kwargs)
+        return [["sheet", kwargs["product_category"]]]
+
+    async def current():
+        return 1
+
+    @contextlib.asynccontextmanager
+    async def queue_full(cost, caller):
+        raise Overloaded(f"no room for {cost} from {caller}")
+        yield  # pylint: disable=unreachable
+
+    monkeypatch.setattr(result_cache, "data_version", SimpleNamespace(current=current))
+    monkeypatch.setattr(handlers, "sheet_cache", ResultCache(calc_output))
+    monkeypatch.setattr(handlers, "forecast_cost", lambda kwargs: 1e6)
+    monkeypatch.setattr(handlers, "admit", queue_full)
+    return computed
+
+
+def test_expensive_cached_sheet_skips_admission(sheets):
+    async def run():
+        await handlers.sheet_cache.get(**handlers.forecast_kwargs(SPEC))
+        return await handlers.compute_sheet_data(json.dumps(SPEC), "caller")
+
+    assert asyncio.run(run()) == [["sheet", "Toothbrush"]]
+    assert len(sheets) == 1
+
+
+def test_expensive_uncached_sheet_waits_for_admission(sheets):
+    with pytest.raises(Overloaded):
+        asyncio.run(handlers.compute_sheet_data(json.dumps(SPEC), "caller"))
+    assert not sheets
+
+
+def test_forecast_kwargs():
+    kwargs = handlers.forecast_kwargs(SPEC)
+    assert kwargs["retailers_mapping"] == {"Retailer 1": (True, ""), "Retailer 2": (False, 4.99)}
+    assert kwargs["inital_investment"] == 100000.0
+    assert kwargs["nearest_comparables"] == 0
+
+
+def test_caller_id():
+    assert handlers.caller_id({"x-caller": "sheet-1", "x-forwarded-for": "1.2.3.4"}, "5.6.7.8") == "sheet-1"
+    assert handlers.caller_id({"x-forwarded-for": "1.2.3.4, 10.0.0.1"}, "5.6.7.8") == "1.2.3.4"
+    assert handlers.caller_id({}, "5.6.7.8") == "5.6.7.8"
+
+
+@pytest.fixture(name="batches")
+def fixture_batches(monkeypatch):
+    """
+    The items and admitted cost of each batch run by compute_batch_data,
+    where a forecast costs its number of years and at most 10 is allowed.
+    """
+    runs = []
+
+    async def run_batch(items):
+        runs.append(items)
+        for item_id, kwargs in items:
+            if isinstance(kwargs, Exception):
+                yield {"id": item_id, "status": 400, "message": str(kwargs)}
+            else:
+                yield {"id": item_id, "status": 200}
+
+    @contextlib.asynccontextmanager
+    async def admit(cost, caller):  # pylint: disable=unused-argument
+        admission.check_cost(cost)
+        runs.append(cost)
+        yield
+
+    monkeypatch.setattr(admission, "MAX_REQUEST_COST", 10)
+    monkeypatch.setattr(handlers, "forecast_cost", lambda kwargs: kwargs["num_years"])
+    monkeypatch.setattr(handlers, "admit", admit)
+    monkeypatch.setattr(handlers, "run_batch", run_batch)
+    return runs
+
+
+def batch_results(*num_years):
+    """The results of a batch of SPEC with each number of years"""
+    body = json.dumps([{**SPEC, "id": i, "num_years": n} for i, n in enumerate(num_years)])
+
+    async def run():
+        return [json.loads(line) async for line in handlers.compute_batch_data(body.encode(), "caller")]
+
+    return asyncio.run(run())
+
+
+def test_batch_items_over_the_cost_limit_fail_on_their_own(batches):
+    results = batch_results(3, 11, 4)
+    assert [r["status"] for r in results] == [200, 400, 200]
+    assert "too expensive" in results[1]["message"]
+    # the batch is admitted at the cost of the forecasts it computes
+    assert batches[0] == 7
+
+
+def test_batch_over_the_cost_limit_is_rejected(batches):
+    with pytest.raises(AssertionError, match="too expensive"):
+        batch_results(5, 5, 5)
+    assert not batches
@@ -0,0 +1,83 @@
+"""
+Tests of the Monte Carlo kernel and of running its blocks on a pool.
+"""
+import asyncio
+import time
+
+import numpy as np
+
+from api.montecarlo import SimulationInputs, simulate_block, summarize
+from api.simulation import SIMULATION_BLOCK_SIZE, SimulationPool
+
+
+def simulation_inputs(**overrides) -> SimulationInputs:
+    """Two retailers over three years, each cell with a handful of comparables"""
+    rng = np.random.default_rng(0)
+    comparables = [
+        (rng.uniform(4, 6, 8), rng.uniform(0.2, 0.6, 8), rng.uniform(1000, 5000, 8)) for _ in range(6)
+    ]
+    inputs = dict(
+        list_price=np.full((2, 3), 5.0),
+        derived_price=np.array([True, False]),
+        retailer_markup=np.full((2, 3), 0.2),
+        fixed_costs=np.full((2, 3), 500.0),
+        comparables=comparables,
+        variable_cost=2.5,
+        inital_investment=10000.0,
+        desired_irr=0.1,
+        relevant_contribution_margin_range=np.inf,
+        relevant_list_price_range=np.inf,
+    )
+    return SimulationInputs(**{**inputs, **overrides})
+
+
+def test_blocks_are_reproducible():
+    inputs = simulation_inputs(market_price=6.0, market_price_spread=1.0)
+    seed = np.random.SeedSequence(7)
+    npv, irr = simulate_block(inputs, seed, 200)
+    again_npv, again_irr = simulate_block(inputs, seed, 200)
+    assert npv.shape == irr.shape == (200,)
+    np.testing.assert_array_equal(npv, again_npv)
+    np.testing.assert_array_equal(irr, again_irr)
+    # sampled market prices spread the NPVs
+    assert npv.std() > 0
+
+
+def test_block_past_its_stop_time_gives_up():
+    inputs = simulation_inputs()
+    assert simulate_block(inputs, np.random.SeedSequence(7), 200, stop_at=time.time() - 1) is None
+    assert simulate_block(inputs, np.random.SeedSequence(7), 200, stop_at=time.time() + 60) is not None
+
+
+def test_pool_waits_for_first_block_only_after_deadline():
+    pool = SimulationPool(workers=0)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # the deadline has already passed when the blocks start
+        return await pool.run(simulation_inputs(), 4 * SIMULATION_BLOCK_SIZE, loop.time(), seed=1)
+
+    blocks = asyncio.run(run())
+    assert len(blocks) == 1
+    assert len(blocks[0][0]) == SIMULATION_BLOCK_SIZE
+
+
+def test_pool_runs_every_block_in_time():
+    pool = SimulationPool(workers=0)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        return await pool.run(simulation_inputs(), 2 * SIMULATION_BLOCK_SIZE + 10, loop.time() + 60, seed=1)
+
+    blocks = asyncio.run(run())
+    assert [len(npv) for npv, _ in blocks] == [SIMULATION_BLOCK_SIZE, SIMULATION_BLOCK_SIZE, 10]
+
+
+def test_summarize():
+    npv = np.array([-10.0, 5.0, 20.0, 30.0])
+    irr = np.array([np.nan, 0.05, 0.2, 0.3])
+    summary = summarize(npv, irr, desired_irr=0.1)
+    assert summary["probability_viable"] == 0.75
+    assert summary["probability_meets_desired_irr"] == 0.5
+    assert summary["irr"]["no_irr_probability"] == 0.25
+    assert sum(summary["recommendations"].values()) == 1.0
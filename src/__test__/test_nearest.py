@@ -0,0 +1,43 @@
+"""
+Tests of nearest-comparables volumes.
+"""
+import numpy as np
+import pytest
+
+from api.nearest import EMPTY_PARTITION, MAX_NEAREST_COMPARABLES, nearest_volume, nearest_volumes
+from api.snapshot import Partition
+
+
+def partition(*rows):
+    """A partition of (list_price, contribution_margin, volume_sold) rows"""
+    values = np.array(rows, dtype=float).reshape(-1, 3)
+    return Partition.from_columns(values[:, 0], values[:, 1], values[:, 2])
+
+
+def test_weights_by_inverse_distance():
+    # both rows are one margin scale away, the far row two
+    rows = partition((5.0, 0.45, 100.0), (5.0, 0.55, 300.0), (5.0, 0.7, 1000.0))
+    assert nearest_volume(rows, 5.0, 0.5, 2) == pytest.approx(200.0)
+    # 1 / 1, 1 / 1 and 1 / 4
+    assert nearest_volume(rows, 5.0, 0.5, 3) == pytest.approx((100 + 300 + 1000 / 4) / 2.25)
+
+
+def test_exact_matches_outweigh_the_rest():
+    rows = partition((5.0, 0.5, 100.0), (5.0, 0.55, 300.0))
+    assert nearest_volume(rows, 5.0, 0.5, 2) == pytest.approx(100.0)
+
+
+def test_no_comparables():
+    assert nearest_volume(EMPTY_PARTITION, 5.0, 0.5, 5) == 0
+
+
+def test_nearest_volumes_use_each_cells_margin():
+    partitions = {(1, 1): partition((4.0, 0.5, 100.0), (4.0, 0.75, 300.0))}
+    # a list price of 4 and a variable cost of 1 is a margin of 0.75
+    assert nearest_volumes(partitions, {(1, 1): 4.0}, 1.0, 1) == {(1, 1): 300.0}
+
+
+@pytest.mark.parametrize("k", [0, MAX_NEAREST_COMPARABLES + 1])
+def test_k_is_bounded(k):
+    with pytest.raises(AssertionError, match="nearest_comparables"):
+        nearest_volumes({}, {}, 1.0, k)
@@ -0,0 +1,177 @@
+"""
+Tests of the PriceAPI price cache and its backends.
+"""
+import asyncio
+import time
+
+import pytest
+
+from api import price_cache
+from api.price_cache import (
+    CachedPrice,
+    MemoryPriceCacheBackend,
+    PriceCache,
+    SqlitePriceCacheBackend,
+    create_backend,
+)
+
+
+def fetcher(*results):
+    """A fetch_prices that returns (or raises) each result in turn, counting its calls"""
+    calls = []
+
+    async def fetch_prices(product_category):
+        calls.append(product_category)
+        result = results[min(len(calls), len(results)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return fetch_prices, calls
+
+
+def cache_with(entry=None, *results):
+    """A cache over a memory backend holding `entry` for "Toothpaste", if any"""
+    backend = MemoryPriceCacheBackend()
+    if entry is not None:
+        backend.entries["Toothpaste"] = entry
+    fetch_prices, calls = fetcher(*results)
+    return PriceCache(backend, fetch_prices, ttl=100, stale=100, negative_ttl=10), calls
+
+
+def test_miss_fetches_and_stores():
+    cache, calls = cache_with(None, [4.0, 6.0])
+
+    async def run():
+        return await cache.get_entry("Toothpaste"), await cache.get("Toothpaste")
+
+    entry, price = asyncio.run(run())
+    assert entry.price == price == 5.0 and entry.spread == 1.0
+    assert calls == ["Toothpaste"]
+    assert cache.stats.misses == 1 and cache.stats.hits == 1
+
+
+def test_stale_entries_are_served_while_refreshing():
+    stale = CachedPrice(price=3.0, fetched_at=time.time() - 150)
+    cache, calls = cache_with(stale, [5.0])
+
+    async def run():
+        price = await cache.get("Toothpaste")
+        # lets the background refresh finish
+        await asyncio.sleep(0.01)
+        return price, await cache.get("Toothpaste")
+
+    assert asyncio.run(run()) == (3.0, 5.0)
+    assert calls == ["Toothpaste"] and cache.stats.stale_hits == 1
+
+
+def test_expired_entries_are_refetched():
+    cache, calls = cache_with(CachedPrice(price=3.0, fetched_at=time.time() - 250), [5.0])
+    assert asyncio.run(cache.get("Toothpaste")) == 5.0
+    assert len(calls) == 1
+
+
+def test_failures_are_cached_briefly():
+    cache, calls = cache_with(None, RuntimeError("PriceAPI is down"), [5.0])
+
+    async def run():
+        return await cache.get("Toothpaste"), await cache.get("Toothpaste")
+
+    assert asyncio.run(run()) == (0, 0)
+    assert calls == ["Toothpaste"] and cache.stats.negative_hits == 1
+    cache.backend.entries["Toothpaste"].fetched_at -= 20
+    assert asyncio.run(cache.get("Toothpaste")) == 5.0
+
+
+def test_failed_refresh_keeps_the_stale_entry():
+    stale = CachedPrice(price=3.0, fetched_at=time.time() - 150)
+    cache, _ = cache_with(stale, [])
+
+    async def run():
+        await cache.get("Toothpaste")
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert cache.backend.entries["Toothpaste"] is stale
+    assert cache.stats.refresh_errors == 1
+
+
+def test_failed_refreshes_wait_out_the_negative_ttl():
+    stale = CachedPrice(price=3.0, fetched_at=time.time() - 150)
+    cache, calls = cache_with(stale, RuntimeError("PriceAPI is down"), [5.0])
+
+    async def serve(requests):
+        prices = []
+        for _ in range(requests):
+            prices.append(await cache.get("Toothpaste"))
+            await asyncio.sleep(0.01)
+        return prices
+
+    assert asyncio.run(serve(5)) == [3.0] * 5
+    assert len(calls) == 1
+    cache._failed_refreshes["Toothpaste"] -= 20  # pylint: disable=protected-access
+    assert asyncio.run(serve(2)) == [3.0, 5.0]
+    assert len(calls) == 2
+
+
+def test_background_refreshes_are_kept_referenced():
+    stale = CachedPrice(price=3.0, fetched_at=time.time() - 150)
+    cache, _ = cache_with(stale, [5.0])
+
+    async def run():
+        await cache.get("Toothpaste")
+        running = set(price_cache._background_tasks)  # pylint: disable=protected-access
+        await asyncio.sleep(0.01)
+        return running
+
+    assert len(asyncio.run(run())) == 1
+    assert not price_cache._background_tasks  # pylint: disable=protected-access
+
+
+def test_last_good_outlives_failures():
+    cache, _ = cache_with(None, [5.0], RuntimeError("PriceAPI is down"))
+
+    async def run():
+        await cache.get("Toothpaste")
+        await cache.refresh("Toothpaste")
+
+    asyncio.run(run())
+    assert not cache.backend.entries["Toothpaste"].ok
+    assert cache.last_good("Toothpaste").price == 5.0
+    assert cache.last_good("Toothbrush") is None
+
+
+def test_caller_running_out_of_time_leaves_the_fetch_filling_the_cache():
+    backend = MemoryPriceCacheBackend()
+
+    async def slow_prices(product_category):  # pylint: disable=unused-argument
+        await asyncio.sleep(0.05)
+        return [5.0]
+
+    cache = PriceCache(backend, slow_prices)
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(cache.get("Toothpaste"), 0.01)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert backend.entries["Toothpaste"].price == 5.0
+
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "prices.sqlite3")
+    entry = CachedPrice(price=5.0, fetched_at=1.0, spread=0.5)
+
+    async def run():
+        await SqlitePriceCacheBackend(path).set("Toothpaste", entry)
+        other = SqlitePriceCacheBackend(path)
+        return await other.get("Toothpaste"), await other.get("Toothbrush")
+
+    assert asyncio.run(run()) == (entry, None)
+
+
+def test_create_backend():
+    assert isinstance(create_backend("memory"), MemoryPriceCacheBackend)
+    with pytest.raises(AssertionError):
+        create_backend("redis")
@@ -0,0 +1,121 @@
+"""
+Tests of the PriceAPI client, against a mock transport.
+"""
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from api import prices
+from api.prices import PriceAPIClient, PriceAPIException
+
+SEARCH_RESULTS = [
+    {"min_price": "4.00", "max_price": "6.00"},
+    {"min_price": "3.00", "max_price": None},
+    {"min_price": None, "max_price": None},
+]
+
+
+class MockPriceAPI:
+    """
+    A PriceAPI whose jobs report each of `statuses` in turn, then the last
+    one for good. Records the requests it receives.
+    """
+
+    def __init__(self, *statuses):
+        self.statuses = statuses or ("finished",)
+        self.jobs = []
+        self.polls = 0
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        """Answers one request"""
+        path = request.url.path
+        if request.method == "POST" and path.endswith("/jobs"):
+            self.jobs.append(json.loads(request.content)["values"])
+            return httpx.Response(200, json={"job_id": str(len(self.jobs)), "status": "new"})
+        if path.endswith("/download.json"):
+            return httpx.Response(200, json={"results": [{"content": {"search_results": SEARCH_RESULTS}}]})
+        status = self.statuses[min(self.polls, len(self.statuses) - 1)]
+        self.polls += 1
+        return httpx.Response(200, json={"status": status})
+
+    def client(self, **kwargs):
+        """A PriceAPIClient that talks to this PriceAPI"""
+        kwargs = {"poll_delay": 0.001, "max_poll_delay": 0.004, **kwargs}
+        transport = httpx.MockTransport(self.handle)
+        return PriceAPIClient(base_url="https://priceapi.test/v2", transport=transport, **kwargs)
+
+
+def run(client, *categories):
+    """Looks up the categories concurrently, then closes the client"""
+
+    async def lookups():
+        try:
+            return await asyncio.gather(*(client.get_prices(c) for c in categories))
+        finally:
+            await client.aclose()
+
+    return asyncio.run(lookups())
+
+
+def test_prices_average_each_result():
+    assert run(MockPriceAPI().client(), "Toothpaste") == [[5.0, 3.0]]
+
+
+def test_concurrent_lookups_share_one_job():
+    api = MockPriceAPI("working", "working", "finished")
+    results = run(api.client(), *["Toothpaste"] * 10)
+    assert api.jobs == ["Toothpaste"]
+    assert results == [[5.0, 3.0]] * 10
+    # a later lookup starts a new job
+    run(api.client(), "Toothpaste", "Toothbrush")
+    assert sorted(api.jobs) == ["Toothbrush", "Toothpaste", "Toothpaste"]
+
+
+def test_polls_back_off(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def recording_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+        await sleep(0, *args, **kwargs)
+
+    monkeypatch.setattr(prices.asyncio, "sleep", recording_sleep)
+    api = MockPriceAPI(*["working"] * 5, "finished")
+    run(api.client(), "Toothpaste")
+    assert delays == [0.001, 0.002, 0.004, 0.004, 0.004]
+    assert api.polls == 6
+
+
+def test_stalled_jobs_give_up_at_the_deadline():
+    api = MockPriceAPI("working")
+    client = api.client(deadline=0.05)
+
+    async def lookup():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            with pytest.raises(PriceAPIException, match="didn't finish within"):
+                await client.get_prices("Toothpaste")
+        finally:
+            await client.aclose()
+        return loop.time() - start
+
+    assert asyncio.run(lookup()) < 0.5
+    assert len(api.jobs) == 1
+
+
+@pytest.mark.parametrize("status", ["cancelled", "failed"])
+def test_jobs_that_end_without_results_raise(status):
+    with pytest.raises(PriceAPIException, match=status):
+        run(MockPriceAPI("working", status).client(), "Toothpaste")
+
+
+def test_http_errors_raise():
+    client = PriceAPIClient(
+        base_url="https://priceapi.test/v2",
+        transport=httpx.MockTransport(lambda request: httpx.Response(503)),
+    )
+    with pytest.raises(httpx.HTTPStatusError):
+        run(client, "Toothpaste")
@@ -0,0 +1,150 @@
+"""
+Tests of answering comparable-product windows from VolumeBucket sums.
+"""
+import asyncio
+import math
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from api import queries
+from api.queries import (
+    MARGIN_BIN_WIDTH,
+    PRICE_BIN_WIDTH,
+    ComparableWindow,
+    average_volumes,
+    fetch_average_volumes,
+    fetch_bucket_average_volumes,
+)
+
+
+def row(retailer_id, year, list_price, contribution_margin, volume_sold=500.0):
+    """A historical row"""
+    return SimpleNamespace(
+        retailer_id=retailer_id,
+        year=year,
+        list_price=list_price,
+        contribution_margin=contribution_margin,
+        volume_sold=volume_sold,
+    )
+
+
+def history(seed=0, n=2000):
+    """
+    Random rows of one brand and category, over 2 retailers and 3 years,
+    plus rows that put buckets across the edges of the CUT windows.
+    """
+    rng = np.random.default_rng(seed)
+    straddling = [row(1, 1, 3.2, 0.5), row(1, 1, 3.8, 0.5), row(2, 2, 5.0, 0.31), row(2, 2, 5.0, 0.34)]
+    return straddling + [
+        row(
+            int(rng.integers(1, 3)),
+            int(rng.integers(1, 4)),
+            float(rng.uniform(1, 20)),
+            float(rng.uniform(0, 1)),
+            float(rng.uniform(100, 1000)),
+        )
+        for _ in range(n)
+    ]
+
+
+def volume_buckets(rows, current=True):
+    """The rows of VolumeBucket, as rebuild_volume_buckets would aggregate them"""
+    bins = {}
+    for r in rows:
+        key = (
+            r.retailer_id,
+            r.year,
+            math.floor(r.list_price / PRICE_BIN_WIDTH),
+            math.floor(r.contribution_margin / MARGIN_BIN_WIDTH),
+        )
+        bins.setdefault(key, []).append(r)
+    if not current:
+        return [{"current": 0, "retailer_id": None}]
+    return [
+        {
+            "current": 1,
+            "retailer_id": retailer_id,
+            "year": year,
+            "min_price": min(r.list_price for r in members),
+            "max_price": max(r.list_price for r in members),
+            "min_margin": min(r.contribution_margin for r in members),
+            "max_margin": max(r.contribution_margin for r in members),
+            "row_count": len(members),
+            "sum_volume": sum(r.volume_sold for r in members),
+        }
+        for (retailer_id, year, _, _), members in bins.items()
+    ]
+
+
+class BucketDatabase:  # pylint: disable=too-few-public-methods
+    """Answers the VolumeBucket query with the given bucket rows"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    async def query_raw(self, query, *args):  # pylint: disable=unused-argument
+        assert "VolumeBucket" in query
+        return self.buckets
+
+
+def window(retailer_id, year, min_price, max_price, min_margin, max_margin):
+    """A window over (retailer_id, year)"""
+    return ComparableWindow(retailer_id, year, min_margin, max_margin, min_price, max_price)
+
+
+# bin-aligned windows, e.g. a price range of 5 +- 2 and a margin range of 0.5 +- 0.25
+ALIGNED = [
+    window(1, 1, 3.0, 7.0, 0.25, 0.75),
+    window(2, 3, 0.0, 100.0, 0.0, 1.0),
+    window(1, 2, 50.0, 60.0, 0.0, 1.0),
+]
+# cut through the buckets of the straddling rows in `history`
+CUT = [window(1, 1, 3.5, 7.0, 0.25, 0.75), window(2, 2, 3.0, 7.0, 0.32, 0.75)]
+
+
+def test_bucket_averages_match_the_rows():
+    rows = history()
+    volumes, cut = asyncio.run(
+        fetch_bucket_average_volumes(BucketDatabase(volume_buckets(rows)), "Crest", "Toothpaste", ALIGNED)
+    )
+    assert not cut
+    expected = average_volumes(rows, ALIGNED)
+    assert volumes.keys() == expected.keys()
+    for key, volume in volumes.items():
+        assert volume == pytest.approx(expected[key], rel=1e-12)
+    # a window without any rows
+    assert volumes[(1, 2)] == 0
+
+
+def test_windows_cutting_through_a_bucket_fall_back():
+    db = BucketDatabase(volume_buckets(history()))
+    volumes, cut = asyncio.run(fetch_bucket_average_volumes(db, "Crest", "Toothpaste", ALIGNED + CUT))
+    assert cut == CUT
+    assert set(volumes) == {(w.retailer_id, w.year) for w in ALIGNED}
+
+
+def test_outdated_buckets_are_not_used():
+    db = BucketDatabase(volume_buckets(history(), current=False))
+    volumes, cut = asyncio.run(fetch_bucket_average_volumes(db, "Crest", "Toothpaste", ALIGNED))
+    assert volumes == {} and cut == ALIGNED
+
+
+def test_only_cut_windows_query_the_rows(monkeypatch):
+    rows = history()
+    fallbacks = []
+
+    async def fetch_row_average_volumes(db, product_brand, product_category, windows):
+        # pylint: disable=unused-argument
+        fallbacks.append(list(windows))
+        return average_volumes(rows, windows)
+
+    monkeypatch.setattr(queries, "fetch_row_average_volumes", fetch_row_average_volumes)
+    windows = ALIGNED + CUT
+    volumes = asyncio.run(
+        fetch_average_volumes(BucketDatabase(volume_buckets(rows)), "Crest", "Toothpaste", windows)
+    )
+    assert fallbacks == [CUT]
+    expected = average_volumes(rows, windows)
+    assert volumes == pytest.approx(expected, rel=1e-12)
@@ -0,0 +1,218 @@
+"""
+Tests of the result cache: canonical keys, coalescing, and which results
+it keeps for which data version.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from api import result_cache
+from api.deadline import STALE_PRICE, fallbacks, record_fallback, start_deadline
+from api.result_cache import ResultCache, cache_key, cache_report, start_cache_report
+from api.versions import record_read
+
+
+@pytest.fixture(name="version")
+def fixture_version(monkeypatch):
+    """The current data version, as seen by the result caches"""
+    version = SimpleNamespace(value=1)
+
+    async def current():
+        return version.value
+
+    monkeypatch.setattr(result_cache, "data_version", SimpleNamespace(current=current))
+    return version
+
+
+def counting(compute=None):
+    """A computation that counts its calls and, by default, returns its arguments"""
+    calls = []
+
+    async def run(**kwargs):
+        calls.append(kwargs)
+        if compute is not None:
+            return await compute(**kwargs)
+        return kwargs
+
+    return run, calls
+
+
+def test_cache_key_is_canonical():
+    assert cache_key({"a": 1.0000000000001, "b": {"y": (1, 2), "x": 0.1}}) == cache_key(
+        {"b": {"x": 0.1, "y": [1, 2]}, "a": 1.0}
+    )
+    assert cache_key({"a": 1.0}) != cache_key({"a": 1.001})
+
+
+def test_hits_and_misses(version):  # pylint: disable=unused-argument
+    compute, calls = counting()
+    cache = ResultCache(compute, name="sheet")
+
+    async def run():
+        start_cache_report()
+        first = await cache.get(a=1, b={"x": 1.0})
+        second = await cache.get(b={"x": 1.0}, a=1)
+        return first, second, cache_report()
+
+    first, second, report = asyncio.run(run())
+    assert first == second and len(calls) == 1
+    assert report == {"sheet": "miss"}
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+
+
+def test_concurrent_requests_share_one_computation(version):  # pylint: disable=unused-argument
+    async def slow(**kwargs):
+        await asyncio.sleep(0.01)
+        return kwargs
+
+    compute, calls = counting(slow)
+    cache = ResultCache(compute)
+
+    async def run():
+        return await asyncio.gather(*(cache.get(a=1) for _ in range(5)))
+
+    assert asyncio.run(run()) == [{"a": 1}] * 5
+    assert len(calls) == 1 and cache.stats.coalesced == 4
+
+
+def test_bumping_the_version_invalidates(version):
+    compute, calls = counting()
+    cache = ResultCache(compute)
+
+    async def run():
+        await cache.get(a=1)
+        version.value = 2
+        await cache.get(a=1)
+        await cache.get(a=1)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_results_read_at_another_version_are_not_cached(version):
+    async def read_stale_snapshot(**kwargs):
+        # e.g. a snapshot that hasn't been reloaded since the ingest
+        record_read(version.value - 1)
+        return kwargs
+
+    compute, calls = counting(read_stale_snapshot)
+    cache = ResultCache(compute)
+    version.value = 2
+
+    async def run():
+        await cache.get(a=1)
+        await cache.get(a=1)
+
+    asyncio.run(run())
+    assert len(calls) == 2 and cache.metrics()["entries"] == 0
+
+
+def test_stale_reads_propagate_through_stages(version):
+    async def read_stale_snapshot(**kwargs):
+        record_read(version.value - 1)
+        return kwargs
+
+    inner = ResultCache(read_stale_snapshot, name="inner")
+    outer_compute, outer_calls = counting(lambda **kwargs: inner.get(**kwargs))
+    outer = ResultCache(outer_compute, name="outer")
+    version.value = 2
+
+    async def run():
+        await outer.get(a=1)
+        await outer.get(a=1)
+
+    asyncio.run(run())
+    # the outer stage read nothing itself, but used a stale inner result
+    assert len(outer_calls) == 2 and outer.metrics()["entries"] == 0
+
+
+def test_current_reads_are_cached(version):
+    async def read_current_snapshot(**kwargs):
+        record_read(version.value)
+        return kwargs
+
+    compute, calls = counting(read_current_snapshot)
+    cache = ResultCache(compute)
+
+    async def run():
+        await cache.get(a=1)
+        await cache.get(a=1)
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_degraded_results_are_not_cached(version):  # pylint: disable=unused-argument
+    async def with_stale_price(**kwargs):
+        record_fallback(STALE_PRICE)
+        return kwargs
+
+    compute, calls = counting(with_stale_price)
+    cache = ResultCache(compute)
+
+    async def request():
+        start_deadline()
+        return await cache.get(a=1)
+
+    asyncio.run(request())
+    asyncio.run(request())
+    assert len(calls) == 2
+
+
+def test_coalesced_requests_report_the_fallbacks_used(version):  # pylint: disable=unused-argument
+    started = asyncio.Event()
+
+    async def with_stale_price(**kwargs):
+        started.set()
+        await asyncio.sleep(0.01)
+        record_fallback(STALE_PRICE)
+        return kwargs
+
+    stage = ResultCache(counting(with_stale_price)[0], name="stage")
+    compute, calls = counting(lambda **kwargs: stage.get(**kwargs))
+    sheet = ResultCache(compute, name="sheet")
+
+    async def request():
+        start_deadline()
+        await sheet.get(a=1)
+        return fallbacks()
+
+    async def joining():
+        await started.wait()
+        return await request()
+
+    async def run():
+        return await asyncio.gather(request(), joining())
+
+    assert asyncio.run(run()) == [[STALE_PRICE], [STALE_PRICE]]
+    assert len(calls) == 1
+
+
+def test_evicts_least_recently_used(version):  # pylint: disable=unused-argument
+    compute, calls = counting()
+    cache = ResultCache(compute, size=2)
+
+    async def run():
+        for a in (1, 2, 1, 3, 1, 2):
+            await cache.get(a=a)
+
+    asyncio.run(run())
+    # 2 is evicted by 3, while 1 stays recently used
+    assert [call["a"] for call in calls] == [1, 2, 3, 2]
+    assert cache.stats.evictions == 2
+
+
+def test_get_existing_never_computes(version):  # pylint: disable=unused-argument
+    compute, calls = counting()
+    cache = ResultCache(compute)
+
+    async def run():
+        missing = await cache.get_existing(a=1)
+        await cache.get(a=1)
+        return missing, await cache.get_existing(a=1)
+
+    missing, existing = asyncio.run(run())
+    assert missing == (False, None)
+    assert existing == (True, {"a": 1})
+    assert len(calls) == 1
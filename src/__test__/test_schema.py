@@ -0,0 +1,168 @@
+"""
+Tests of request validation and decoding.
+"""
+import gzip
+import json
+import zlib
+
+import pytest
+
+from api.schema import (
+    DEFAULT_RANGE,
+    MAX_REQUEST_BYTES,
+    MAX_SWEEP_SCENARIOS,
+    ForecastSpec,
+    InvalidRequest,
+    SweepSpec,
+    decode_body,
+    parse_json,
+    validate,
+)
+from api.sweep import expand_axis
+
+SPEC = {
+    "product_category": "Toothbrush",
+    "product_brand": "Crest",
+    "variable_cost": 1.5,
+    "retailers_mapping": [["Retailer 1", True, ""], ["Retailer 2", False, 4.99]],
+    "num_years": 3,
+    "desired_irr": 0.1,
+    "inital_investment": 100000,
+}
+
+
+def test_valid_forecast():
+    spec = validate(ForecastSpec, SPEC)
+    assert spec.retailers_mapping[1] == ("Retailer 2", False, 4.99)
+    assert spec.relevant_list_price_range == DEFAULT_RANGE
+    assert spec.nearest_comparables == 0
+
+
+@pytest.mark.parametrize(
+    "changes, field",
+    [
+        ({"num_years": "3"}, "num_years"),
+        ({"variable_cost": float("nan")}, "variable_cost"),
+        ({"retailers_mapping": [["Retailer 1", True, -1]]}, "retailers_mapping.0.2"),
+        ({"retailers_mapping": [["Retailer 1", "yes", ""]]}, "retailers_mapping.0.1"),
+        ({"nearest_comparables": -1}, "nearest_comparables"),
+        ({"product_brand": None}, "product_brand"),
+    ],
+)
+def test_invalid_fields_are_named(changes, field):
+    with pytest.raises(InvalidRequest) as raised:
+        validate(ForecastSpec, {**SPEC, **changes})
+    assert [error["field"] for error in raised.value.errors] == [field]
+    assert field in str(raised.value)
+
+
+def test_missing_fields_are_named():
+    data = dict(SPEC)
+    del data["desired_irr"]
+    with pytest.raises(InvalidRequest) as raised:
+        validate(ForecastSpec, data)
+    assert raised.value.errors[0]["field"] == "desired_irr"
+
+
+def test_sweep_axes():
+    axes = {"variable_cost": [1, 2], "desired_irr": {"start": 0, "stop": 1, "num": 3}}
+    spec = validate(SweepSpec, {**SPEC, **axes})
+    assert spec.variable_cost == [1, 2]
+    with pytest.raises(InvalidRequest):
+        validate(SweepSpec, {**SPEC, "variable_cost": "cheap"})
+
+
+@pytest.mark.parametrize(
+    "axis, message",
+    [
+        ({"start": 0, "step": 1}, "field required"),
+        ({"stop": 1, "step": 1}, "field required"),
+        ({"start": 0, "stop": 1}, "either step or num"),
+        ({"start": 0, "stop": 1, "step": 1, "num": 2}, "either step or num"),
+        ({"start": 2, "stop": 1, "step": 1}, "at least start"),
+        ({"start": 0, "stop": 1, "step": 0}, "greater than 0"),
+        ({"start": 0, "stop": 1, "step": 1e-9}, f"at most {MAX_SWEEP_SCENARIOS} values"),
+        ({"start": 0, "stop": 1, "num": MAX_SWEEP_SCENARIOS + 1}, f"at most {MAX_SWEEP_SCENARIOS} values"),
+        ({"start": 0, "stop": 1, "step": 0.5, "by": 2}, "extra fields"),
+        ([], "at least"),
+    ],
+)
+def test_invalid_sweep_ranges_are_named(axis, message):
+    for field in ("variable_cost", "list_price"):
+        with pytest.raises(InvalidRequest) as raised:
+            validate(SweepSpec, {**SPEC, field: axis})
+        assert raised.value.errors[0]["field"].startswith(field)
+        assert message in str(raised.value)
+
+
+@pytest.mark.parametrize(
+    "axis, expected",
+    [
+        ({"start": 0, "stop": 1, "step": 0.25}, [0, 0.25, 0.5, 0.75, 1]),
+        ({"start": 1, "stop": 1, "step": 1}, [1]),
+        ({"start": 0, "stop": 1, "num": 3}, [0, 0.5, 1]),
+        ([3, 1], [3, 1]),
+        (2, [2]),
+    ],
+)
+def test_sweep_ranges_expand(axis, expected):
+    spec = validate(SweepSpec, {**SPEC, "desired_irr": axis, "list_price": axis})
+    assert expand_axis(spec.desired_irr) == expand_axis(spec.list_price) == expected
+
+
+def test_list_price_points():
+    points = [None, "", 4.5, {"Retailer 1": 5.0, "Retailer 2": ""}]
+    assert expand_axis(validate(SweepSpec, {**SPEC, "list_price": points}).list_price) == points
+    assert expand_axis(validate(SweepSpec, SPEC).list_price) == [None]
+    with pytest.raises(InvalidRequest, match="list_price"):
+        validate(SweepSpec, {**SPEC, "list_price": [{"Retailer 1": -1}]})
+
+
+@pytest.mark.parametrize("body", [None, "", b"", "{", "[1,"])
+def test_parse_json_rejects(body):
+    with pytest.raises(InvalidRequest):
+        parse_json(body)
+
+
+def test_requests_must_be_objects():
+    with pytest.raises(InvalidRequest, match="JSON object"):
+        validate(ForecastSpec, [SPEC])
+
+
+@pytest.mark.parametrize(
+    "encoding, compress",
+    [
+        (None, lambda body: body),
+        ("identity", lambda body: body),
+        ("gzip", gzip.compress),
+        ("x-gzip", gzip.compress),
+        ("deflate", zlib.compress),
+        # raw deflate, without the zlib wrapper, as some clients send it
+        ("Deflate", lambda body: zlib.compress(body, wbits=-zlib.MAX_WBITS)),
+    ],
+)
+def test_decode_body(encoding, compress):
+    body = json.dumps(SPEC).encode()
+    assert decode_body(compress(body), encoding) == body
+
+
+@pytest.mark.parametrize(
+    "body, encoding, message",
+    [
+        (b"not gzip", "gzip", "valid gzip"),
+        (b"not deflate", "deflate", "valid deflate"),
+        (gzip.compress(b"{}")[:-12], "gzip", "valid gzip"),
+        (b"{}", "br", "isn't supported"),
+    ],
+)
+def test_decode_body_rejects(body, encoding, message):
+    with pytest.raises(InvalidRequest, match=message):
+        decode_body(body, encoding)
+
+
+def test_decompression_stops_at_the_limit():
+    bomb = gzip.compress(b" " * (100 * MAX_REQUEST_BYTES))
+    with pytest.raises(InvalidRequest, match="larger than"):
+        decode_body(bomb, "gzip")
+    with pytest.raises(InvalidRequest, match="larger than"):
+        decode_body(b" " * (MAX_REQUEST_BYTES + 1), None)
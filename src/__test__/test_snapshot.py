@@ -0,0 +1,144 @@
+"""
+Tests of the in-memory product snapshot.
+"""
+import asyncio
+import contextlib
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from api import snapshot
+from api.queries import ComparableWindow, average_volumes
+from api.snapshot import ProductSnapshot, SnapshotStore
+
+
+def product_rows(seed=0, n=400):
+    """Random rows for two brands in one category, as `fetch_product_rows` returns them"""
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "brand_name": str(rng.choice(["Crest", "Colgate"])),
+            "category": "Toothpaste",
+            "retailer_id": int(rng.integers(1, 4)),
+            "year": int(rng.integers(1, 3)),
+            "list_price": float(rng.uniform(1, 10)),
+            "contribution_margin": float(rng.uniform(0, 1)),
+            "volume_sold": float(rng.uniform(100, 1000)),
+        }
+        for _ in range(n)
+    ]
+
+
+@pytest.fixture(name="database")
+def fixture_database(monkeypatch):
+    """A database at data version 1 holding `product_rows()`"""
+
+    @contextlib.asynccontextmanager
+    async def session():
+        yield None
+
+    async def fetch_data_version(db):  # pylint: disable=unused-argument
+        return 1
+
+    async def fetch_product_rows(db):  # pylint: disable=unused-argument
+        return product_rows()
+
+    monkeypatch.setattr(snapshot, "database", SimpleNamespace(session=session))
+    monkeypatch.setattr(snapshot, "fetch_data_version", fetch_data_version)
+    monkeypatch.setattr(snapshot, "fetch_product_rows", fetch_product_rows)
+
+
+def test_refresh_builds_the_snapshot_off_the_event_loop(database, monkeypatch):
+    # pylint: disable=unused-argument
+    threads = []
+    from_rows = ProductSnapshot.from_rows
+
+    def recording_from_rows(*args, **kwargs):
+        threads.append(threading.get_ident())
+        return from_rows(*args, **kwargs)
+
+    monkeypatch.setattr(ProductSnapshot, "from_rows", recording_from_rows)
+    store = SnapshotStore(enabled=True)
+
+    async def run():
+        loaded = await store.refresh()
+        return loaded, threading.get_ident()
+
+    loaded, loop_thread = asyncio.run(run())
+    assert loaded is store.current and loaded.num_rows == 400
+    assert threads and threads[0] != loop_thread
+
+
+def brute_force_window(rows, window):
+    """Volumes of the rows inside a window, by checking every row"""
+    return sorted(
+        r["volume_sold"]
+        for r in rows
+        if r["brand_name"] == "Crest"
+        and r["retailer_id"] == window.retailer_id
+        and r["year"] == window.year
+        and window.min_margin <= r["contribution_margin"] <= window.max_margin
+        and window.min_price <= r["list_price"] <= window.max_price
+    )
+
+
+@pytest.mark.parametrize(
+    "min_price, max_price, min_margin, max_margin",
+    [
+        # narrow in price, then narrow in margin, so both searches are used
+        (4.0, 4.5, 0.0, 1.0),
+        (0.0, 100.0, 0.3, 0.35),
+        (3.0, 8.0, 0.2, 0.9),
+        (50.0, 60.0, 0.0, 1.0),
+    ],
+)
+def test_window_volumes_match_brute_force(min_price, max_price, min_margin, max_margin):
+    rows = product_rows()
+    loaded = ProductSnapshot.from_rows(rows, 1)
+    for retailer_id in (1, 2, 3):
+        window = ComparableWindow(retailer_id, 1, min_margin, max_margin, min_price, max_price)
+        partition = loaded.partitions[("Crest", "Toothpaste", retailer_id, 1)]
+        assert sorted(partition.window_volumes(window)) == brute_force_window(rows, window)
+
+
+def test_average_volumes_match_queries():
+    rows = product_rows()
+    loaded = ProductSnapshot.from_rows(rows, 1)
+    windows = [ComparableWindow(r, y, 0.2, 0.8, 2.0, 9.0) for r in (1, 2, 3) for y in (1, 2, 5)]
+    crest = [SimpleNamespace(**r) for r in rows if r["brand_name"] == "Crest"]
+    expected = average_volumes(crest, windows)
+    assert loaded.average_volumes("Crest", "Toothpaste", windows) == pytest.approx(expected, rel=1e-12)
+
+
+@pytest.mark.parametrize(
+    "list_price, margin, k", [(5.0, 0.5, 5), (1.0, 0.0, 10), (20.0, 1.0, 3), (5.0, 0.5, 1000)]
+)
+def test_nearest_matches_brute_force(list_price, margin, k):
+    partition = ProductSnapshot.from_rows(product_rows(), 1).partitions[("Crest", "Toothpaste", 1, 1)]
+    indices, distances = partition.nearest(list_price, margin, k, 0.1, 0.05)
+    expected = np.hypot(
+        (partition.log_price - np.log(list_price)) / 0.1,
+        (partition.contribution_margin - margin) / 0.05,
+    )
+    k = min(k, len(expected))
+    assert len(indices) == k
+    np.testing.assert_allclose(distances, np.sort(expected)[:k])
+    np.testing.assert_allclose(expected[indices], distances)
+
+
+def test_unchanged_partitions_are_reused():
+    rows = product_rows()
+    first = ProductSnapshot.from_rows(rows, 1)
+    changed = [dict(r) for r in rows]
+    # an ingest that touches one partition
+    target = next(
+        r for r in changed if (r["brand_name"], r["retailer_id"], r["year"]) == ("Crest", 1, 1)
+    )
+    target["volume_sold"] += 1
+    second = ProductSnapshot.from_rows(changed, 2, previous=first)
+    assert second.reused_partitions == len(first.partitions) - 1
+    key = ("Crest", "Toothpaste", 1, 1)
+    assert second.partitions[key] is not first.partitions[key]
+    assert all(second.partitions[k] is p for k, p in first.partitions.items() if k != key)
@@ -0,0 +1,36 @@
+"""
+Tests of scenario sweeps' list price axis.
+"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from api.sweep import list_price_matrices, overridden_everywhere
+
+RETAILERS = [SimpleNamespace(id=1, name="Retailer 1"), SimpleNamespace(id=2, name="Retailer 2")]
+
+
+@pytest.mark.parametrize(
+    "points, expected",
+    [
+        ([4.0, 5.0], {"Retailer 1", "Retailer 2"}),
+        ([4.0, None], set()),
+        ([{"Retailer 1": 4.0}, 5.0], {"Retailer 1"}),
+        ([{"Retailer 1": 4.0, "Retailer 2": ""}, {"Retailer 2": 5.0}], set()),
+        (
+            [{"Retailer 1": 4.0, "Retailer 2": 3.0}, {"Retailer 2": 5.0, "Retailer 1": 6.0}],
+            {"Retailer 1", "Retailer 2"},
+        ),
+    ],
+)
+def test_overridden_everywhere(points, expected):
+    assert overridden_everywhere(points, RETAILERS) == expected
+
+
+def test_overridden_base_prices_are_never_used():
+    # Retailer 2's base price wasn't looked up
+    base = np.array([[2.0, 2.0], [np.nan, np.nan]])
+    matrices = list_price_matrices([{"Retailer 2": 4.0}, 5.0], RETAILERS, base)
+    np.testing.assert_array_equal(matrices[0], [[2.0, 2.0], [4.0, 4.0]])
+    np.testing.assert_array_equal(matrices[1], np.full((2, 2), 5.0))
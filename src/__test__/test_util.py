@@ -0,0 +1,59 @@
+"""
+Tests of the spreadsheet helpers.
+"""
+import math
+
+from api.util import COMPACT_SIGNIFICANT_DIGITS, append_note, compact_sheet, create_partial_sheet
+
+
+def expand(compact):
+    """Expands a compact sheet back into rows, as script.gs does"""
+    num_rows, num_columns = compact["shape"]
+    rows = [[""] * num_columns for _ in range(num_rows)]
+    for j, runs in enumerate(compact["columns"]):
+        for first, values in runs:
+            for i, value in enumerate(values):
+                rows[first + i][j] = value
+    for i, j, index in compact["text"]:
+        rows[i][j] = compact["strings"][index]
+    return rows
+
+
+SHEET = [
+    ["Volume (SKUs Sold)", "", ""],
+    ["Retailer 1", 1200, 1300.5],
+    ["Retailer 2", 800.25, 900],
+    ["Total", 2000.25, 2200.5],
+    ["", "", ""],
+    ["IRR Analysis", "No IRR"],
+    ["Total", 1 / 3, math.nan],
+]
+
+
+def test_compact_sheet_round_trips():
+    compact = compact_sheet(SHEET)
+    assert compact["shape"] == [7, 3]
+    expanded = expand(compact)
+    assert expanded[:6] == [row + [""] * (3 - len(row)) for row in SHEET[:6]]
+    # rounded, and NaN left empty
+    assert expanded[6] == ["Total", float(f"{1 / 3:.{COMPACT_SIGNIFICANT_DIGITS}g}"), ""]
+
+
+def test_compact_sheet_sends_repeated_text_once():
+    compact = compact_sheet(SHEET)
+    assert compact["strings"].count("Total") == 1
+    # consecutive numbers share one run per column
+    assert compact["columns"][1][0] == [1, [1200, 800.25, 2000.25]]
+
+
+def test_compact_sheet_of_nothing():
+    assert compact_sheet([])["shape"] == [0, 0]
+
+
+def test_partial_sheet_says_why():
+    output = create_partial_sheet(["Retailer 1", "Retailer 2"], 3, "the deadline was reached.")
+    append_note(output, "Market price is stale")
+    flat = [cell for row in output for cell in row]
+    assert "Partial result: the deadline was reached." in flat
+    assert output[-1][:2] == ["Note:", "Market price is stale"]
+    assert len({len(row) for row in output}) == 1
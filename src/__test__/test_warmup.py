@@ -0,0 +1,104 @@
+"""
+Tests that preloaded retailers and agreements are only served at the data
+version they were loaded at.
+"""
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from api import calc, versions, warmup
+
+RETAILER = SimpleNamespace(id=1, name="Retailer 1")
+
+
+def agreement(markup: float) -> SimpleNamespace:
+    """A retailer agreement with the given markup"""
+    return SimpleNamespace(
+        retailer_markup=markup,
+        display_costs=0,
+        priority_shelving_costs=0,
+        preferred_vendor_agreement_costs=0,
+    )
+
+
+@pytest.fixture(name="database")
+def fixture_database(monkeypatch):
+    """
+    The database as seen by the warm-up and load_retailers, which holds a
+    data version and the current agreement of RETAILER.
+    """
+    state = SimpleNamespace(version=1, agreement=agreement(0.1))
+
+    async def find_many():
+        return [RETAILER]
+
+    @contextlib.asynccontextmanager
+    async def session():
+        yield SimpleNamespace(retailer=SimpleNamespace(find_many=find_many))
+
+    async def fetch_data_version(_db):
+        return state.version
+
+    async def fetch_all_agreements(_db):
+        return {(RETAILER.id, 1): state.agreement}
+
+    async def fetch_retailers(_db, names):
+        return [RETAILER] if RETAILER.name in names else []
+
+    async def fetch_agreements(_db, retailer_ids, num_years):
+        return {(r, y): state.agreement for r in retailer_ids for y in range(1, num_years + 1)}
+
+    for module in (versions, warmup):
+        monkeypatch.setattr(module.database, "session", session)
+        monkeypatch.setattr(module, "fetch_data_version", fetch_data_version)
+    monkeypatch.setattr(warmup, "fetch_all_agreements", fetch_all_agreements)
+    monkeypatch.setattr(calc, "fetch_retailers", fetch_retailers)
+    monkeypatch.setattr(calc, "fetch_agreements", fetch_agreements)
+    monkeypatch.setattr(versions, "data_version", versions.DataVersion(check_interval=0))
+    monkeypatch.setattr(warmup, "data_version", versions.data_version)
+    warmer = warmup.Warmer(enabled=False)
+    monkeypatch.setattr(calc, "warmer", warmer)
+    return SimpleNamespace(state=state, warmer=warmer)
+
+
+async def load(num_years: int = 1):
+    """The agreements load_retailers returns for RETAILER"""
+    _, agreements = await calc.load_retailers(None, {RETAILER.name: (True, "")}, num_years)
+    return agreements
+
+
+def test_serves_preload_at_current_version(database):
+    async def run():
+        preloaded = await database.warmer.preload()
+        database.state.agreement = agreement(0.5)
+        return preloaded, await load()
+
+    preloaded, agreements = asyncio.run(run())
+    # nothing was ingested, so the preload is used rather than the database
+    assert agreements[(RETAILER.id, 1)] is preloaded.agreements[(RETAILER.id, 1)]
+    assert agreements[(RETAILER.id, 1)].retailer_markup == 0.1
+
+
+def test_bumped_version_serves_fresh_agreements(database):
+    async def run():
+        await database.warmer.preload()
+        database.state.agreement = agreement(0.5)
+        database.state.version = 2
+        fresh = await load()
+        # the stale preload is reloaded in the background
+        await database.warmer._reload  # pylint: disable=protected-access
+        return fresh
+
+    fresh = asyncio.run(run())
+    assert fresh[(RETAILER.id, 1)].retailer_markup == 0.5
+    assert database.warmer.preloaded.version == 2
+    assert database.warmer.preloaded.agreements[(RETAILER.id, 1)].retailer_markup == 0.5
+
+
+def test_falls_back_to_database_without_preload(database):
+    database.state.agreement = agreement(0.3)
+    agreements = asyncio.run(load(num_years=2))
+    assert sorted(agreements) == [(RETAILER.id, 1), (RETAILER.id, 2)]
+    assert agreements[(RETAILER.id, 2)].retailer_markup == 0.3
@@ -0,0 +1,197 @@
+"""
+Admission control. Every request is checked against hard limits on its
+inputs and given a cost estimate: the cells of its sheet (retailers x
+years) times the comparable rows and scenarios each cell works through.
+Requests over MAX_REQUEST_COST are rejected with a 400. Requests over
+EXPENSIVE_REQUEST_COST run a few at a time, in a bounded queue that takes
+turns between callers, so one caller's expensive requests can't starve
+anyone else's. Cheap requests never wait.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict
+
+from api.deadline import DeadlineExceeded, bounded
+from api.metrics import registry
+from api.snapshot import product_snapshot
+
+MAX_RETAILERS = int(os.environ.get("MAX_RETAILERS", "100"))
+MAX_NUM_YEARS = int(os.environ.get("MAX_NUM_YEARS", "30"))
+# comparable rows per retailer and year assumed when there is no snapshot
+EXPECTED_COMPARABLE_ROWS = float(os.environ.get("EXPECTED_COMPARABLE_ROWS", "1000"))
+MAX_REQUEST_COST = float(os.environ.get("MAX_REQUEST_COST", "10000000"))
+EXPENSIVE_REQUEST_COST = float(os.environ.get("EXPENSIVE_REQUEST_COST", "100000"))
+# expensive requests running at once, per worker process
+EXPENSIVE_CONCURRENCY = int(os.environ.get("EXPENSIVE_CONCURRENCY", "2"))
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "32"))
+MAX_QUEUED_PER_CALLER = int(os.environ.get("MAX_QUEUED_PER_CALLER", "4"))
+
+ADMITTED = registry.counter("admission_admitted_total", "Requests admitted, by cost class")
+REJECTED = registry.counter("admission_rejected_total", "Requests rejected by admission control, by reason")
+QUEUE_SECONDS = registry.histogram("admission_queue_seconds", "Time expensive requests waited for a slot")
+
+
+class Overloaded(Exception):
+    """An expensive request couldn't be queued; `status_code` is 429 or 503"""
+
+    def __init__(self, message: str, status_code: int = 503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def check_limits(num_retailers: int, num_years: Any) -> None:
+    """Rejects forecasts with more retailers or years than a sheet can hold"""
+    try:
+        assert isinstance(num_years, int) and 0 < num_years <= MAX_NUM_YEARS, (
+            f"num_years must be a whole number from 1 to {MAX_NUM_YEARS}"
+        )
+        assert num_retailers <= MAX_RETAILERS, (
+            f"retailers_mapping has {num_retailers} retailers, the limit is {MAX_RETAILERS}"
+        )
+    except AssertionError:
+        REJECTED.inc(reason="limits")
+        raise
+
+
+def check_cost(cost: float) -> None:
+    """Rejects forecasts estimated to cost more than MAX_REQUEST_COST"""
+    if cost > MAX_REQUEST_COST:
+        REJECTED.inc(reason="cost")
+        raise AssertionError(
+            f"Forecast is too expensive ({cost:.3g} > {MAX_REQUEST_COST:.3g}), "
+            "use fewer retailers, years, scenarios or trials"
+        )
+
+
+def expected_comparable_rows(product_brand: str, product_category: str) -> float:
+    """Comparable rows in an average retailer and year of a brand and category"""
+    snapshot = product_snapshot.current
+    if snapshot is None:
+        return EXPECTED_COMPARABLE_ROWS
+    return snapshot.rows_per_partition.get((product_brand, product_category), 0.0)
+
+
+def forecast_cost(kwargs: Dict[str, Any], scenarios: int = 1) -> float:
+    """
+    Estimated cost of a forecast given as `calc_output` keyword arguments,
+    computed for `scenarios` scenarios (sweep points or simulation trials).
+    """
+    enabled = sum(1 for v in kwargs["retailers_mapping"].values() if v[0] == True)
+    if kwargs.get("nearest_comparables"):
+        rows = float(kwargs["nearest_comparables"])
+    else:
+        rows = expected_comparable_rows(kwargs["product_brand"], kwargs["product_category"])
+    return enabled * kwargs["num_years"] * (rows + scenarios)
+
+
+class FairQueue:
+    """
+    Runs at most `slots` expensive requests at once. The others wait in
+    one queue per caller, and a freed slot goes to the next caller in
+    turn, not the next request. Callers may queue at most
+    `max_per_caller` requests, and at most `max_queued` wait in total.
+    """
+
+    def __init__(
+        self,
+        slots: int = EXPENSIVE_CONCURRENCY,
+        max_queued: int = MAX_QUEUED_REQUESTS,
+        max_per_caller: int = MAX_QUEUED_PER_CALLER,
+    ):
+        self.slots = slots
+        self.max_queued = max_queued
+        self.max_per_caller = max_per_caller
+        self.running = 0
+        self.queued = 0
+        # caller -> requests waiting, in the order callers get their turn
+        self._waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, caller: str) -> AsyncIterator[None]:
+        """Holds a slot while the block runs, waiting for one if they are all taken"""
+        await self._acquire(caller)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, caller: str) -> None:
+        if self.running < self.slots and not self.queued:
+            self.running += 1
+            return
+        waiters = self._waiting.get(caller)
+        if waiters is not None and len(waiters) >= self.max_per_caller:
+            REJECTED.inc(reason="caller_queue_full")
+            raise Overloaded("Too many expensive forecasts are waiting, please try again", 429)
+        if self.queued >= self.max_queued:
+            REJECTED.inc(reason="queue_full")
+            raise Overloaded("Server is busy with expensive forecasts, please try again")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(caller, deque()).append(future)
+        self.queued += 1
+        started = time.perf_counter()
+        try:
+            await bounded(future)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as the request gave up
+                self._release()
+            else:
+                future.cancel()
+                self._discard(caller, future)
+            if isinstance(e, DeadlineExceeded):
+                REJECTED.inc(reason="queue_timeout")
+                raise Overloaded("Server is busy with expensive forecasts, please try again") from e
+            raise
+        finally:
+            QUEUE_SECONDS.observe(time.perf_counter() - started)
+
+    def _discard(self, caller: str, future: asyncio.Future) -> None:
+        waiters = self._waiting.get(caller)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[caller]
+
+    def _release(self) -> None:
+        while self._waiting:
+            caller, waiters = next(iter(self._waiting.items()))
+            self._waiting.move_to_end(caller)
+            future = waiters.popleft()
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[caller]
+            if not future.done():
+                # the slot passes straight to the waiter, so running stays the same
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> Dict[str, int]:
+        """Queue depth, running requests and callers waiting"""
+        return {"queued": self.queued, "running": self.running, "callers": len(self._waiting)}
+
+
+expensive_queue = FairQueue()
+registry.gauges("admission", expensive_queue.stats)
+
+
+@asynccontextmanager
+async def admit(cost: float, caller: str) -> AsyncIterator[None]:
+    """
+    Admits a request of the given cost for the block: rejects it if it is
+    too expensive, or runs it in its caller's turn if it is expensive.
+    """
+    check_cost(cost)
+    if cost <= EXPENSIVE_REQUEST_COST:
+        ADMITTED.inc(cost_class="cheap")
+        yield
+        return
+    async with expensive_queue.slot(caller):
+        ADMITTED.inc(cost_class="expensive")
+        yield
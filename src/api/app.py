@@ -3,54 +3,208 @@ API called from google sheets custom function,
 that enables the user to calculate the predicted NPV and IRR
 for a new product launch (based on historical and external data)
 """
-import json
-from typing import Any, Dict, List
+import asyncio
+import atexit
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Dict, Tuple, TypeVar
 
-from flask import Flask, request
+from flask import Flask, Response, request
 
-from api.calc import calc_output
+from api.admission import Overloaded
+from api.db import database
+from api.handlers import (
+    caller_id,
+    compute_batch_data,
+    compute_sheet_data,
+    compute_simulation_data,
+    compute_sweep_data,
+    fallback_headers,
+    sheet_headers,
+)
+from api.metrics import registry
+from api.prices import price_api
+from api.schema import MAX_REQUEST_BYTES, InvalidRequest, decode_body
+from api.snapshot import product_snapshot
+from api.util import compact_sheet
+from api.warmup import warmer
+
+T = TypeVar("T")
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+
+# the shared database client is bound to the event loop it connected on,
+# so every request runs its coroutines on this one process-wide loop
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="event-loop", daemon=True).start()
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """Runs a coroutine on the process-wide event loop and waits for the result"""
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()  # type: ignore
 
 
-@app.route("/", methods=["GET"])
-async def compute_sheet():
+async def with_headers(
+    computation: Awaitable[T], headers: Callable[[], Dict[str, str]]
+) -> Tuple[T, Dict[str, str]]:
+    """
+    Awaits a request's computation and builds its response headers on the
+    event loop too, since the fallbacks and cache lookups they report are
+    context variables of the coroutine, not of the Flask thread.
+    """
+    result = await computation
+    return result, headers()
+
+
+def request_caller() -> str:
+    """The caller of the current request, for fair queueing (see `api.handlers.caller_id`)"""
+    return caller_id(request.headers, request.remote_addr)
+
+
+@atexit.register
+def shutdown():
+    """Disconnects the shared database client when the process exits"""
+    run_async(price_api.aclose())
+    run_async(database.disconnect())
+    loop.call_soon_threadsafe(loop.stop)
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """
+    Health check, reports whether the database is reachable.
+    """
+    if run_async(database.health_check()):
+        return {"status": "ok"}
+    return {"status": "database unavailable"}, 503
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Prometheus metrics of this process.
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/", methods=["GET", "POST"])
+def compute_sheet():
     """
     API route to compute the spreadsheet, called by custom function in Google Sheets.
+    The forecast is POSTed as JSON, optionally gzip- or deflate-compressed, or sent
+    in the json_data query parameter of a GET by older copies of script.gs.
+    With format=compact, the sheet is sent column by column (see `api.util.compact_sheet`).
+    """
+    try:
+        if request.method == "POST":
+            json_data = decode_body(request.get_data(), request.headers.get("Content-Encoding"))
+        else:
+            json_data = request.args.get("json_data")
+        output, headers = run_async(
+            with_headers(compute_sheet_data(json_data, request_caller()), sheet_headers)
+        )
+        if request.args.get("format") == "compact":
+            return compact_sheet(output), 200, headers
+        return output, 200, headers
+    except Overloaded as e:
+        return {"message": str(e)}, e.status_code, {"Retry-After": "1"}
+    except InvalidRequest as e:
+        return {"message": str(e), "errors": e.errors}, 400
+    except AssertionError as e:
+        return {"message": str(e)}, 400
+    except Exception as e:
+        return {"message": str(e)}, 500
+
+
+@app.route("/sweep", methods=["GET", "POST"])
+def compute_sweep():
+    """
+    API route to compute a grid of scenarios, called by custom function in Google Sheets.
+    The sweep is POSTed like a forecast (see `compute_sheet`), or sent in the json_data
+    query parameter of a GET by older copies of script.gs.
     """
-    json_data = request.args.get("json_data")
     try:
-        assert json_data, "No data provided"
-        data = json.loads(json_data)
-        output = await calc_output(
-            product_category=data["product_category"],
-            product_brand=data["product_brand"],
-            variable_cost=data["variable_cost"],
-            retailers_mapping=matrix_to_mapping(data["retailers_mapping"]),
-            num_years=data["num_years"],
-            desired_irr=data["desired_irr"],
-            inital_investment=data["inital_investment"],
-            relevant_contribution_margin_range=data["relevant_contribution_margin_range"],
-            relevant_list_price_range=data["relevant_list_price_range"],
+        if request.method == "POST":
+            json_data = decode_body(request.get_data(), request.headers.get("Content-Encoding"))
+        else:
+            json_data = request.args.get("json_data")
+        output, headers = run_async(
+            with_headers(compute_sweep_data(json_data, request_caller()), fallback_headers)
         )
-        return output
+        return output, 200, headers
+    except Overloaded as e:
+        return {"message": str(e)}, e.status_code, {"Retry-After": "1"}
+    except InvalidRequest as e:
+        return {"message": str(e), "errors": e.errors}, 400
     except AssertionError as e:
         return {"message": str(e)}, 400
     except Exception as e:
         return {"message": str(e)}, 500
 
 
-def matrix_to_mapping(matrix: List[List[Any]]) -> Dict[str, Any]:
+@app.route("/simulate", methods=["GET"])
+def compute_simulation():
     """
-    Converts a matrix of values into a dictionary that maps from the
-    first column to the remaining columns.
+    API route to run a Monte Carlo forecast, called by custom function in Google Sheets.
     """
-    m = len(matrix)  # pylint: disable=invalid-name
-    mapping = {}
-    for i in range(m):
-        mapping[matrix[i][0]] = tuple(matrix[i][1:])
-    return mapping
+    try:
+        output, headers = run_async(
+            with_headers(
+                compute_simulation_data(request.args.get("json_data"), request_caller()),
+                fallback_headers,
+            )
+        )
+        return output, 200, headers
+    except Overloaded as e:
+        return {"message": str(e)}, e.status_code, {"Retry-After": "1"}
+    except InvalidRequest as e:
+        return {"message": str(e), "errors": e.errors}, 400
+    except AssertionError as e:
+        return {"message": str(e)}, 400
+    except Exception as e:
+        return {"message": str(e)}, 500
+
+
+async def next_result(results: AsyncIterator[T]) -> T:
+    """Awaits the next item of an async iterator"""
+    return await results.__anext__()
+
+
+@app.route("/batch", methods=["POST"])
+def compute_batch():
+    """
+    API route to compute a batch of forecasts, streamed back as newline-delimited JSON.
+    """
+    try:
+        results = compute_batch_data(
+            decode_body(request.get_data(), request.headers.get("Content-Encoding")), request_caller()
+        )
+        # parse the batch before committing to a 200 response
+        first = run_async(next_result(results))
+    except StopAsyncIteration:
+        return Response("", mimetype="application/x-ndjson")
+    except Overloaded as e:
+        return {"message": str(e)}, e.status_code, {"Retry-After": "1"}
+    except InvalidRequest as e:
+        return {"message": str(e), "errors": e.errors}, 400
+    except AssertionError as e:
+        return {"message": str(e)}, 400
+    except Exception as e:
+        return {"message": str(e)}, 500
+
+    def stream():
+        yield first
+        while True:
+            try:
+                yield run_async(next_result(results))
+            except StopAsyncIteration:
+                return
+
+    return Response(stream(), mimetype="application/x-ndjson")
 
 
 if __name__ == "__main__":
+    run_async(database.connect())
+    run_async(product_snapshot.start())
+    run_async(warmer.start())
     app.run(host="0.0.0.0")
@@ -0,0 +1,401 @@
+"""
+Production ASGI entry point. Each uvicorn worker process keeps a single
+event loop and a single database client for its whole lifetime, so slow
+requests (e.g. waiting on PriceAPI) no longer block each other.
+
+Run with `python -m api.asgi`; the Flask app in api.app is only meant
+for local development.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+import zlib
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api.db import database
+from api.admission import Overloaded
+from api.handlers import (
+    caller_id,
+    fallback_headers,
+    compute_batch_data,
+    compute_sheet_data,
+    compute_simulation_data,
+    compute_sweep_data,
+    sheet_headers,
+)
+from api.metrics import REQUEST_SECONDS, registry, server_timing, stage, start_timings
+from api.prices import price_api
+from api.schema import MAX_REQUEST_BYTES, InvalidRequest, decode_body
+from api.simulation import simulation_pool
+from api.util import compact_sheet
+from api.snapshot import product_snapshot
+from api.warmup import warmer
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.environ.get("PORT", "5000"))
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "2"))
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", "32"))
+PROBE_PATHS = {"/healthz", "/readyz", "/metrics"}
+ROUTE_PATHS = {"/", "/sweep", "/batch", "/simulate"}
+# streamed batch results are sent as they come, so they aren't compressed
+COMPRESSED_PATHS = {"/", "/sweep"}
+GZIP_MINIMUM_SIZE = int(os.environ.get("GZIP_MINIMUM_SIZE", "1000"))
+# fraction of requests to profile with cProfile, written to PROFILE_DIR
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+
+
+class SheetResponse(JSONResponse):
+    """
+    JSON response that, like Flask, allows NaN values in the spreadsheet
+    """
+
+    def render(self, content: Any) -> bytes:
+        return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+
+async def read_body(request: Request) -> bytes:
+    """The request's body, decompressed (see `api.schema.decode_body`)"""
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_REQUEST_BYTES:
+            raise InvalidRequest([{"field": "request", "message": f"is larger than {MAX_REQUEST_BYTES} bytes"}])
+    return decode_body(bytes(body), request.headers.get("content-encoding"))
+
+
+def request_caller(request: Request) -> str:
+    """The caller of a request, for fair queueing (see `api.handlers.caller_id`)"""
+    return caller_id(request.headers, request.client.host if request.client else None)
+
+
+class ConcurrencyLimitMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    Rejects requests with a 503 once `limit` requests are already in
+    flight in this worker, so a backlog of slow forecasts sheds load
+    instead of queueing indefinitely. Probes are never rejected.
+    """
+
+    def __init__(self, app: ASGIApp, limit: int):
+        self.app = app
+        self.limit = limit
+        self.in_flight = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        if self.in_flight >= self.limit:
+            response = JSONResponse(
+                {"message": "Server is busy, please try again"},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+
+class TimingMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    Collects the stage timings of each request and sends them back in a
+    Server-Timing header, records the request latency, and profiles a
+    sample of requests.
+    """
+
+    def __init__(self, app: ASGIApp, profile_sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.app = app
+        self.profile_sample_rate = profile_sample_rate
+        self.profiling = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        timings = start_timings()
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings["total"] = time.perf_counter() - started
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        # cProfile can only profile one request at a time
+        profiler = None
+        if not self.profiling and random.random() < self.profile_sample_rate:
+            self.profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            path = scope["path"] if scope["path"] in ROUTE_PATHS else "other"
+            REQUEST_SECONDS.observe(time.perf_counter() - started, path=path, status=status)
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profiler.dump_stats(
+                    os.path.join(PROFILE_DIR, f"{time.time():.3f}{path.replace('/', '_')}.prof")
+                )
+
+
+def accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """The response encoding to use: gzip if the client accepts it, else deflate, else none"""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        if params.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip())
+    for coding in ("gzip", "deflate"):
+        if coding in accepted:
+            return coding
+    return None
+
+
+class CompressionMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    Compresses responses of the sheet routes with gzip or deflate,
+    whichever the client accepts
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = GZIP_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in COMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        encoding = accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding == "gzip":
+            # GZipMiddleware reads the header itself, and ignores q=0
+            await self.gzip(scope, receive, send)
+        elif encoding == "deflate":
+            await self.deflate(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+    async def deflate(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Sends the response deflated; sheet responses aren't streamed, so it is buffered"""
+        start: Optional[Message] = None
+        body = bytearray()
+
+        async def send_deflated(message: Message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body.extend(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            assert start is not None
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            content = bytes(body)
+            if len(content) >= self.minimum_size and "content-encoding" not in headers:
+                content = zlib.compress(content)
+                headers["Content-Encoding"] = "deflate"
+                headers["Content-Length"] = str(len(content))
+                headers.add_vary_header("Accept-Encoding")
+            await send({**start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": content})
+
+        await self.app(scope, receive, send_deflated)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Connects the shared database client on startup and disconnects on shutdown"""
+    app.state.ready = False
+    try:
+        await database.connect()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # stay alive but not ready, the readiness probe retries the connection
+        logger.exception(e)
+    await product_snapshot.start()
+    await warmer.start()
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    await warmer.stop()
+    simulation_pool.shutdown()
+    await product_snapshot.stop()
+    await price_api.aclose()
+    await database.disconnect()
+
+
+async def compute_sheet(request: Request):
+    """
+    API route to compute the spreadsheet, called by custom function in Google Sheets.
+    The forecast is POSTed as JSON, optionally gzip- or deflate-compressed, or sent
+    in the json_data query parameter of a GET by older copies of script.gs.
+    With format=compact, the sheet is sent column by column (see `api.util.compact_sheet`).
+    """
+    try:
+        if request.method == "POST":
+            json_data = await read_body(request)
+        else:
+            json_data = request.query_params.get("json_data")
+        output = await compute_sheet_data(json_data, request_caller(request))
+        with stage("serialize"):
+            if request.query_params.get("format") == "compact":
+                return SheetResponse(compact_sheet(output), headers=sheet_headers())
+            return SheetResponse(output, headers=sheet_headers())
+    except Overloaded as e:
+        return JSONResponse({"message": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+    except InvalidRequest as e:
+        return JSONResponse({"message": str(e), "errors": e.errors}, status_code=400)
+    except AssertionError as e:
+        return JSONResponse({"message": str(e)}, status_code=400)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return JSONResponse({"message": str(e)}, status_code=500)
+
+
+async def compute_sweep(request: Request):
+    """
+    API route to compute a grid of scenarios, called by custom function in Google Sheets.
+    The sweep is POSTed like a forecast (see `compute_sheet`), or sent in the json_data
+    query parameter of a GET by older copies of script.gs.
+    """
+    try:
+        if request.method == "POST":
+            json_data = await read_body(request)
+        else:
+            json_data = request.query_params.get("json_data")
+        output = await compute_sweep_data(json_data, request_caller(request))
+        with stage("serialize"):
+            return SheetResponse(output, headers=fallback_headers())
+    except Overloaded as e:
+        return JSONResponse({"message": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+    except InvalidRequest as e:
+        return JSONResponse({"message": str(e), "errors": e.errors}, status_code=400)
+    except AssertionError as e:
+        return JSONResponse({"message": str(e)}, status_code=400)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return JSONResponse({"message": str(e)}, status_code=500)
+
+
+async def compute_simulation(request: Request):
+    """
+    API route to run a Monte Carlo forecast, called by custom function in Google Sheets.
+    """
+    try:
+        output = await compute_simulation_data(request.query_params.get("json_data"), request_caller(request))
+        with stage("serialize"):
+            return SheetResponse(output, headers=fallback_headers())
+    except Overloaded as e:
+        return JSONResponse({"message": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+    except InvalidRequest as e:
+        return JSONResponse({"message": str(e), "errors": e.errors}, status_code=400)
+    except AssertionError as e:
+        return JSONResponse({"message": str(e)}, status_code=400)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return JSONResponse({"message": str(e)}, status_code=500)
+
+
+async def compute_batch(request: Request):
+    """
+    API route to compute a batch of forecasts, streamed back as newline-delimited JSON.
+    """
+    try:
+        results = compute_batch_data(await read_body(request), request_caller(request))
+        # parse the batch before committing to a 200 response
+        first = await results.__anext__()
+    except StopAsyncIteration:
+        return StreamingResponse(iter(()), media_type="application/x-ndjson")
+    except Overloaded as e:
+        return JSONResponse({"message": str(e)}, status_code=e.status_code, headers={"Retry-After": "1"})
+    except InvalidRequest as e:
+        return JSONResponse({"message": str(e), "errors": e.errors}, status_code=400)
+    except AssertionError as e:
+        return JSONResponse({"message": str(e)}, status_code=400)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return JSONResponse({"message": str(e)}, status_code=500)
+
+    async def stream():
+        yield first
+        async for result in results:
+            yield result
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+async def liveness(_: Request):
+    """Liveness probe: the worker's event loop is responsive"""
+    return JSONResponse({"status": "ok"})
+
+
+async def readiness(request: Request):
+    """
+    Readiness probe: startup and warm-up have finished and the database is reachable
+    """
+    if not request.app.state.ready:
+        return JSONResponse({"status": "starting"}, status_code=503)
+    if not warmer.ready:
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    if not await database.health_check():
+        return JSONResponse({"status": "database unavailable"}, status_code=503)
+    return JSONResponse({"status": "ok", "snapshot": product_snapshot.stats(), "warmup": warmer.stats()})
+
+
+async def metrics(_: Request):
+    """Prometheus metrics of this worker"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+app = Starlette(
+    routes=[
+        Route("/", compute_sheet, methods=["GET", "POST"]),
+        Route("/sweep", compute_sweep, methods=["GET", "POST"]),
+        Route("/batch", compute_batch, methods=["POST"]),
+        Route("/simulate", compute_simulation, methods=["GET"]),
+        Route("/healthz", liveness, methods=["GET"]),
+        Route("/readyz", readiness, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(TimingMiddleware),
+        Middleware(ConcurrencyLimitMiddleware, limit=MAX_IN_FLIGHT_REQUESTS),
+        Middleware(CompressionMiddleware),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "api.asgi:app",
+        host="0.0.0.0",
+        port=PORT,
+        workers=WORKERS,
+        timeout_graceful_shutdown=30,
+    )
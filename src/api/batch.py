@@ -0,0 +1,186 @@
+"""
+Batch forecasts. Forecasts that share a category, brand, set of retailers
+and number of years share their database fetches and market price lookup,
+groups run concurrently, and each result is yielded as soon as it is ready.
+Each group gets its own deadline (see api.deadline), since a batch can
+stream for longer than a single request, and each result lists the
+fallbacks its forecast used.
+"""
+import asyncio
+import os
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple
+
+from api.calc import (
+    MissingPrice,
+    base_list_prices,
+    forecast_sheet,
+    load_retailers,
+    note_fallbacks,
+    partial_output,
+)
+from api.db import database
+from api.deadline import DeadlineExceeded, fallbacks, start_deadline, start_fallbacks
+from api.nearest import load_partitions, nearest_volumes
+from api.snapshot import Partition
+from api.sweep import Comparables, comparable_volumes, load_comparable_columns
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "1000"))
+
+# (item id, keyword arguments for calc_output, or the error that occurred parsing them)
+BatchItem = Tuple[Any, Dict[str, Any] | Exception]
+
+
+def group_key(spec: Dict[str, Any]) -> Tuple:
+    """Forecasts with the same key can share all of their data fetches"""
+    enabled = sorted(k for k, v in spec["retailers_mapping"].items() if v[0] == True)
+    return (
+        spec["product_category"],
+        spec["product_brand"],
+        tuple(enabled),
+        spec["num_years"],
+    )
+
+
+def error_result(item_id: Any, error: Exception) -> Dict[str, Any]:
+    """Describes a failed item the same way compute_sheet describes a failed request"""
+    status = 400 if isinstance(error, AssertionError) else 500
+    return {"id": item_id, "status": status, "message": str(error)}
+
+
+def sheet_result(item_id: Any, output) -> Dict[str, Any]:
+    """A computed sheet, with notes and a list of the fallbacks it used, like compute_sheet"""
+    return {"id": item_id, "status": 200, "output": note_fallbacks(output), "fallbacks": fallbacks()}
+
+
+def partial_result(item_id: Any, spec: Dict[str, Any], error: Exception) -> Dict[str, Any]:
+    """A forecast cut short by the deadline or a missing price, as a partial sheet"""
+    output = partial_output(spec["product_category"], spec["retailers_mapping"], spec["num_years"], error)
+    return sheet_result(item_id, output)
+
+
+async def forecast_group(
+    members: Sequence[Tuple[Any, Dict[str, Any]]]
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Computes every forecast in a group from a single set of fetches,
+    yielding a result (or error) per member.
+    """
+    start_deadline()
+    first = members[0][1]
+    # only the nearest-comparables search needs partitions indexed, windows need just the columns
+    nearest = any(spec.get("nearest_comparables") for _, spec in members)
+    partitions: Dict[Tuple[int, int], Partition] = {}
+    comparables: Dict[Tuple[int, int], Comparables] = {}
+    try:
+        async with database.session() as db:  # pylint: disable=invalid-name
+            retailers, agreements = await load_retailers(
+                db, first["retailers_mapping"], first["num_years"]
+            )
+            if nearest:
+                partitions = await load_partitions(
+                    db,
+                    first["product_brand"],
+                    first["product_category"],
+                    [r.id for r in retailers],
+                    first["num_years"],
+                )
+                comparables = {
+                    key: (p.list_price, p.contribution_margin, p.volume_sold)
+                    for key, p in partitions.items()
+                }
+            else:
+                comparables = await load_comparable_columns(
+                    db, first["product_brand"], first["product_category"], retailers, first["num_years"]
+                )
+    except DeadlineExceeded as e:
+        for item_id, spec in members:
+            start_fallbacks()
+            yield partial_result(item_id, spec, e)
+        return
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        for item_id, _ in members:
+            yield error_result(item_id, e)
+        return
+
+    for item_id, spec in members:
+        start_fallbacks()
+        try:
+            list_prices = await base_list_prices(
+                spec["product_category"],
+                retailers,
+                agreements,
+                spec["retailers_mapping"],
+                spec["num_years"],
+            )
+            if spec.get("nearest_comparables"):
+                volumes = nearest_volumes(
+                    partitions, list_prices, spec["variable_cost"], spec["nearest_comparables"]
+                )
+            else:
+                volumes = comparable_volumes(
+                    comparables,
+                    list_prices,
+                    spec["variable_cost"],
+                    spec["relevant_contribution_margin_range"],
+                    spec["relevant_list_price_range"],
+                )
+            output = forecast_sheet(
+                retailers,
+                agreements,
+                list_prices,
+                volumes,
+                variable_cost=spec["variable_cost"],
+                num_years=spec["num_years"],
+                desired_irr=spec["desired_irr"],
+                inital_investment=spec["inital_investment"],
+            )
+        except (DeadlineExceeded, MissingPrice) as e:
+            yield partial_result(item_id, spec, e)
+            continue
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            yield error_result(item_id, e)
+            continue
+        yield sheet_result(item_id, output)
+
+
+async def run_batch(items: List[BatchItem]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Computes a batch of forecasts, yielding each result as soon as it is
+    ready (not in request order). Errors are yielded per item and never
+    abort the rest of the batch.
+    """
+    assert len(items) <= MAX_BATCH_SIZE, f"Batch has {len(items)} forecasts, the limit is {MAX_BATCH_SIZE}"
+    results: asyncio.Queue = asyncio.Queue()
+    groups: Dict[Tuple, List[Tuple[Any, Dict[str, Any]]]] = {}
+    for item_id, spec in items:
+        if isinstance(spec, Exception):
+            results.put_nowait(error_result(item_id, spec))
+            continue
+        try:
+            groups.setdefault(group_key(spec), []).append((item_id, spec))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            results.put_nowait(error_result(item_id, e))
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_group(members):
+        answered = 0
+        try:
+            async with semaphore:
+                async for result in forecast_group(members):
+                    await results.put(result)
+                    answered += 1
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # every member still gets a result, or the stream would wait for them forever
+            for item_id, _ in members[answered:]:
+                await results.put(error_result(item_id, e))
+
+    tasks = [asyncio.create_task(run_group(members)) for members in groups.values()]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        # e.g. the client disconnected before the batch finished
+        for task in tasks:
+            task.cancel()
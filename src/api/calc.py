@@ -2,34 +2,160 @@
 Calculates the predicted sales data and returns as a spreadsheet.
 """
 
-import sys
-from dataclasses import dataclass
-from typing import Dict, Tuple, Literal
+import logging
+from typing import Callable, Dict, List, Tuple, Literal
 
 import numpy as np
-import numpy_financial as npf
 from prisma import Prisma
-from prisma.models import ProductRetailerYear, RetailerYear
+from prisma.models import Retailer, RetailerYear
 
+from api import finance
+from api.db import database
+from api.deadline import (
+    FALLBACK_DESCRIPTIONS,
+    HISTORY_PRICE,
+    PARTIAL_RESULT,
+    DeadlineExceeded,
+    fallbacks,
+    record_fallback,
+)
+from api.engine import compute_forecast
+from api.finance import RECOMMENDATIONS, recommend
+from api.metrics import registry, stage
+from api.nearest import load_partitions, nearest_volumes
 from api.prices import get_average_price
-from api.util import create_template_sheet
+from api.queries import (
+    ComparableWindow,
+    fetch_agreements,
+    fetch_average_volumes,
+    fetch_category_list_prices,
+    fetch_retailers,
+)
+from api.result_cache import ResultCache
+from api.snapshot import product_snapshot
+from api.util import append_note, create_partial_sheet, create_template_sheet, fill_template_sheet
+from api.versions import record_read
+from api.warmup import warmer
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class RetailerTotals:
+
+class MissingPrice(Exception):
+    """Neither a market price nor price history is available for a category"""
+
+
+async def load_retailers(
+    db: Prisma,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+) -> Tuple[List[Retailer], Dict[Tuple[int, int], RetailerYear]]:
+    """
+    Loads the enabled retailers and their agreements for every forecast
+    year, keyed by (retailer_id, year). Served from memory when the
+    warm-up has preloaded all of them at the current data version.
+    """
+    enabled_retailers = [k for k, v in retailers_mapping.items() if v[0] == True]
+    preloaded = await warmer.current_preload()
+    if preloaded is not None:
+        found = preloaded.lookup(enabled_retailers, num_years)
+        if found is not None:
+            record_read(preloaded.version)
+            return found
+
+    retailers = await fetch_retailers(db, enabled_retailers)
+    discovered_retailers = {r.name for r in retailers}
+    missing = [r for r in enabled_retailers if r not in discovered_retailers]
+    assert not missing, f"Couldn't find {missing} in database, please ask finance department to input data for this retailer."
+
+    agreements = await fetch_agreements(db, [r.id for r in retailers], num_years)
+    missing_years = [
+        f"{r.name} (year {y})" for r in retailers for y in range(1, num_years + 1)
+        if (r.id, y) not in agreements
+    ]
+    assert not missing_years, f"Couldn't find retailer agreements for {missing_years} in database, please ask finance department to input data for this retailer."
+    return retailers, agreements
+
+
+async def base_list_prices(
+    product_category: str,
+    retailers: List[Retailer],
+    agreements: Dict[Tuple[int, int], RetailerYear],
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+) -> Dict[Tuple[int, int], float]:
     """
-    Accumulates totals per retailer (i.e. per row in the output spreadsheet)
+    Returns the list price at each retailer in each year, keyed by
+    (retailer_id, year): the one given in retailers_mapping, or else
+    derived from the average market price and the retailer's markup. If
+    there is no market price, the category's historical average list
+    price is used instead.
     """
+    list_prices = {}
+    # fetched once, and only if some retailer has no list price of its own
+    market_price = None
+    history = None
+    for retailer in retailers:
+        for year in range(1, num_years + 1):
+            retailer_agreement = agreements[(retailer.id, year)]
+            if retailer.name in retailers_mapping and isinstance(retailers_mapping[retailer.name][1], float):
+                list_price = float(retailers_mapping[retailer.name][1])
+            else:
+                if market_price is None:
+                    market_price = await get_average_price(product_category)
+                if market_price > 0:
+                    list_price = market_price / (1+ retailer_agreement.retailer_markup)
+                else:
+                    if history is None:
+                        history = await history_list_prices(product_category, retailers, num_years)
+                    list_price = history[(retailer.id, year)]
+            list_prices[(retailer.id, year)] = list_price
+    return list_prices
+
+
+async def history_list_prices(
+    product_category: str, retailers: List[Retailer], num_years: int
+) -> Dict[Tuple[int, int], float]:
+    """
+    The category's average historical list price at each retailer and
+    year, or over all of them where a retailer has no history that year.
+    """
+    async with database.session() as db:  # pylint: disable=invalid-name
+        prices, overall = await fetch_category_list_prices(
+            db, product_category, [r.id for r in retailers], num_years
+        )
+    if overall is None:
+        raise MissingPrice(f"no market price or price history is available for {product_category}")
+    record_fallback(HISTORY_PRICE)
+    return {
+        (r.id, y): prices.get((r.id, y), overall)
+        for r in retailers
+        for y in range(1, num_years + 1)
+    }
 
-    total_volume: float = 0
-    total_retailer_sales_revenue: float = 0
-    total_manufacturer_sales_revenue: float = 0
-    total_manufacturer_gross_revenue: float = 0
-    total_fixed_costs: float = 0
-    total_net_revenue: float = 0
 
+def fixed_costs(agreement: RetailerYear) -> float:
+    """Fixed costs owed to a retailer for one year of an agreement"""
+    return (
+        agreement.display_costs
+        + agreement.priority_shelving_costs
+        + agreement.preferred_vendor_agreement_costs
+    )
 
-# pylint: disable=too-many-locals disable=too-many-arguments disable=too-many-statements
+
+def retailer_year_matrix(
+    retailers: List[Retailer], num_years: int, value: Callable[[int, int], float]
+) -> np.ndarray:
+    """
+    Collects a (retailers x years) matrix by calling value(retailer_id, year)
+    for every cell.
+    """
+    return np.array(
+        [[value(r.id, year) for year in range(1, num_years + 1)] for r in retailers],
+        dtype=float,
+    ).reshape(len(retailers), num_years)
+
+
+# pylint: disable=too-many-locals disable=too-many-arguments
 async def calc_output(
     product_category: str,
     product_brand: str,
@@ -40,199 +166,295 @@ async def calc_output(
     inital_investment: float,
     relevant_contribution_margin_range: float,
     relevant_list_price_range: float,
+    nearest_comparables: int = 0,
 ):
     """
     Main function: computes spreadsheet of predicted sales data
-    for a new product with given parameters.
+    for a new product with given parameters. With nearest_comparables=k,
+    volumes come from the k nearest comparable products (see api.nearest)
+    instead of the ones inside the relevant ranges.
+
+    If the request's deadline passes, or no price is available at all, a
+    partial sheet says so. Any fallbacks used are noted below the sheet.
     """
-    enabled_retailers = [k for k, v in retailers_mapping.items() if v[0] == True]
-    num_retailers = len(enabled_retailers)
-    db = Prisma()  # pylint: disable=invalid-name
-    await db.connect()
     try:
-        retailers = await db.retailer.find_many(
-            where={"name": {"in": enabled_retailers}}
+        output = await calc_full_output(
+            product_category,
+            product_brand,
+            variable_cost,
+            retailers_mapping,
+            num_years,
+            desired_irr,
+            inital_investment,
+            relevant_contribution_margin_range,
+            relevant_list_price_range,
+            nearest_comparables,
         )
-        discovered_retailers = {r.name for r in retailers}
-        missing = [r for r in enabled_retailers if r not in discovered_retailers]
-        assert not missing, f"Couldn't find {missing} in database, please ask finance department to input data for this retailer."
-        output, offsets = create_template_sheet(retailers, num_years)
-        (
-            volume_offset,
-            retailer_price_offset,
-            retailer_sales_offset,
-            manufacturer_sales_offset,
-            manufacturer_gross_offset,
-            fixed_costs_offset,
-            net_revenue_offset,
-        ) = offsets
-
-        retailer_totals = [RetailerTotals() for _ in retailers + [None]]
-        cashflows = [-inital_investment]
-
-        for j, year in enumerate(range(1, num_years + 1)):
-            total_volume = 0
-            total_retailer_sales_revenue = 0
-            total_manufacturer_sales_revenue = 0
-            total_manufacturer_gross_revenue = 0
-            total_fixed_costs = 0
-            for i, retailer in enumerate(retailers):
-                retailer_agreements = await db.query_raw(
-                    """
-                    SELECT *
-                    FROM RetailerYear
-                    WHERE retailer_id = ?
-                    AND year = ?
-                    """,
-                    retailer.id,
-                    year,
-                    model=RetailerYear
+    except (DeadlineExceeded, MissingPrice) as e:
+        output = partial_output(product_category, retailers_mapping, num_years, e)
+    return note_fallbacks(output)
+
+
+def partial_output(
+    product_category: str,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+    error: Exception,
+):
+    """A partial sheet that says why a forecast couldn't be completed"""
+    logger.warning("partial result for %s: %s", product_category, error)
+    record_fallback(PARTIAL_RESULT)
+    enabled_retailers = [k for k, v in retailers_mapping.items() if v[0] == True]
+    return create_partial_sheet(enabled_retailers, num_years, f"{error}.")
+
+
+def note_fallbacks(output):
+    """Notes every fallback the current forecast used below its sheet"""
+    for name in fallbacks():
+        append_note(output, FALLBACK_DESCRIPTIONS[name])
+    return output
+
+
+# pylint: disable=too-many-locals disable=too-many-arguments
+async def calc_full_output(
+    product_category: str,
+    product_brand: str,
+    variable_cost: float,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+    desired_irr: float,
+    inital_investment: float,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+    nearest_comparables: int = 0,
+):
+    """
+    Computes the spreadsheet of `calc_output`, without any fallbacks, from
+    the memoized stages below. Only the decision is computed every time.
+    """
+    output, offsets, cashflows, solved = await cashflows_cache.get(
+        product_category=product_category,
+        product_brand=product_brand,
+        retailers_mapping=enabled_mapping(retailers_mapping),
+        num_years=num_years,
+        variable_cost=variable_cost,
+        comparables=comparables_key(
+            relevant_contribution_margin_range, relevant_list_price_range, nearest_comparables
+        ),
+        inital_investment=inital_investment,
+    )
+    # the stages share their sheet, so the decision is filled into a copy
+    output = [list(row) for row in output]
+    fill_decision(output, offsets, cashflows, solved, desired_irr)
+    logger.debug("output: %s", output)
+    return output
+
+
+# Stages. The spreadsheet is built in memoized stages, each cached under
+# only the inputs it depends on, so a request that changes e.g. just the
+# desired IRR reuses everything upstream of the decision:
+#
+#   prices     category, enabled retailers and their list prices, years
+#   volumes    + brand, variable cost, comparables (ranges or nearest k)
+#   grid       same as volumes: the sheet's line items and net revenue
+#   cashflows  + initial investment: the cashflows and their IRR
+#   decision   + desired IRR: NPV and recommendation, i.e. the sheet cache
+#
+# Each stage looks up the one before it, so a hit ends the lookups.
+
+
+def enabled_mapping(
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]]
+) -> Dict[str, Tuple[bool, float | Literal[""]]]:
+    """The rows of retailers_mapping that affect a forecast, i.e. the enabled ones"""
+    return {k: v for k, v in retailers_mapping.items() if v[0] == True}
+
+
+def comparables_key(
+    relevant_contribution_margin_range: float, relevant_list_price_range: float, nearest_comparables: int
+) -> Tuple:
+    """Which comparables a forecast averages: the k nearest, or those inside the ranges"""
+    if nearest_comparables:
+        return ("nearest", nearest_comparables)
+    return ("ranges", relevant_contribution_margin_range, relevant_list_price_range)
+
+
+async def prices_stage(
+    product_category: str,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+):
+    """The enabled retailers, their agreements and their list prices"""
+    async with database.session() as db:  # pylint: disable=invalid-name
+        with stage("load"):
+            retailers, agreements = await load_retailers(db, retailers_mapping, num_years)
+    with stage("prices"):
+        list_prices = await base_list_prices(
+            product_category, retailers, agreements, retailers_mapping, num_years
+        )
+    return retailers, agreements, list_prices
+
+
+async def volumes_stage(
+    product_category: str,
+    product_brand: str,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+    variable_cost: float,
+    comparables: Tuple,
+):
+    """The prices stage, plus the comparable volume at each retailer and year"""
+    retailers, agreements, list_prices = await prices_cache.get(
+        product_category=product_category, retailers_mapping=retailers_mapping, num_years=num_years
+    )
+    async with database.session() as db:  # pylint: disable=invalid-name
+        with stage("volumes"):
+            if comparables[0] == "nearest":
+                partitions = await load_partitions(
+                    db, product_brand, product_category, [r.id for r in retailers], num_years
                 )
-                retailer_agreement = retailer_agreements[0]
-                
-                if retailer.name in retailers_mapping and isinstance(retailers_mapping[retailer.name][1], float):
-                    list_price = float(retailers_mapping[retailer.name][1])
+                volumes = nearest_volumes(partitions, list_prices, variable_cost, comparables[1])
+            else:
+                windows = comparable_windows(retailers, list_prices, variable_cost, num_years, *comparables[1:])
+                snapshot = product_snapshot.current
+                if snapshot is not None:
+                    record_read(snapshot.version)
+                    volumes = snapshot.average_volumes(product_brand, product_category, windows)
                 else:
-                    list_price = (await get_average_price(product_category)) / (1+ retailer_agreement.retailer_markup)
-
-                contribution_margin = (list_price - variable_cost) / list_price
-                data_points = await db.query_raw(
-                    """
-                    SELECT *
-                    FROM ProductRetailerYear
-                    JOIN Product ON Product.id = ProductRetailerYear.product_id
-                    WHERE retailer_id = ?
-                    AND year = ?
-                    AND contribution_margin BETWEEN ? AND ?
-                    AND list_price BETWEEN ? AND ?
-                    AND Product.brand_name = ?
-                    AND Product.category = ?
-                    """,
-                    retailer.id,
-                    year,
-                    contribution_margin - relevant_contribution_margin_range,
-                    contribution_margin + relevant_contribution_margin_range,
-                    list_price * (1 - relevant_list_price_range),
-                    list_price * (1 + relevant_list_price_range),
-                    product_brand,
-                    product_category,
-                    model=ProductRetailerYear,
-                )
+                    volumes = await fetch_average_volumes(db, product_brand, product_category, windows)
+    return retailers, agreements, list_prices, volumes
 
-                volume = (
-                    # pylint: disable=consider-using-generator
-                    sum([d.volume_sold for d in data_points]) / len(data_points)
-                    if data_points
-                    else 0
-                )
-                retailer_price = list_price * (1 + retailer_agreement.retailer_markup)
-                retailer_sales_revenue = volume * retailer_price
-                manufacturer_sales_revenue = volume * list_price
-                manufacturer_gross_revenue = (
-                    manufacturer_sales_revenue * contribution_margin
-                )
-                fixed_costs = (
-                    retailer_agreement.display_costs +
-                    retailer_agreement.priority_shelving_costs +
-                    retailer_agreement.preferred_vendor_agreement_costs)
-
-                total_volume += volume
-                total_retailer_sales_revenue += retailer_sales_revenue
-                total_manufacturer_sales_revenue += manufacturer_sales_revenue
-                total_manufacturer_gross_revenue += manufacturer_gross_revenue
-                total_fixed_costs += fixed_costs
-
-                retailer_totals[i].total_volume += volume
-                retailer_totals[
-                    i
-                ].total_retailer_sales_revenue += retailer_sales_revenue
-                retailer_totals[
-                    i
-                ].total_manufacturer_sales_revenue += manufacturer_sales_revenue
-                retailer_totals[
-                    i
-                ].total_manufacturer_gross_revenue += manufacturer_gross_revenue
-                retailer_totals[i].total_fixed_costs += fixed_costs
-
-                output[volume_offset + i][j + 1] = volume
-                output[retailer_price_offset + i][j + 1] = retailer_price
-                output[retailer_sales_offset + i][j + 1] = retailer_sales_revenue
-                output[manufacturer_sales_offset + i][
-                    j + 1
-                ] = manufacturer_sales_revenue
-                output[manufacturer_gross_offset + i][
-                    j + 1
-                ] = manufacturer_gross_revenue
-                output[fixed_costs_offset + i][j + 1] = fixed_costs
-                output[volume_offset + i][j + 1] = volume
-
-            net_revenue = total_manufacturer_gross_revenue - total_fixed_costs
-
-            output[volume_offset + num_retailers][j + 1] = total_volume
-            output[retailer_sales_offset + num_retailers][
-                j + 1
-            ] = total_retailer_sales_revenue
-            output[manufacturer_sales_offset + num_retailers][
-                j + 1
-            ] = total_manufacturer_sales_revenue
-            output[manufacturer_gross_offset + num_retailers][
-                j + 1
-            ] = total_manufacturer_gross_revenue
-            output[fixed_costs_offset + num_retailers][j + 1] = total_fixed_costs
-            output[net_revenue_offset][j + 1] = net_revenue
-
-            retailer_totals[-1].total_volume += total_volume
-            retailer_totals[
-                -1
-            ].total_retailer_sales_revenue += total_retailer_sales_revenue
-            retailer_totals[
-                -1
-            ].total_manufacturer_sales_revenue += total_manufacturer_sales_revenue
-            retailer_totals[
-                -1
-            ].total_manufacturer_gross_revenue += total_manufacturer_gross_revenue
-            retailer_totals[-1].total_fixed_costs += total_fixed_costs
-            retailer_totals[-1].total_net_revenue += net_revenue
-
-            cashflows.append(net_revenue)
-
-        for i, totals in enumerate(retailer_totals):
-            output[volume_offset + i][num_years + 1] = totals.total_volume
-            output[retailer_sales_offset + i][
-                num_years + 1
-            ] = totals.total_retailer_sales_revenue
-            output[manufacturer_sales_offset + i][
-                num_years + 1
-            ] = totals.total_manufacturer_sales_revenue
-            output[manufacturer_gross_offset + i][
-                num_years + 1
-            ] = totals.total_manufacturer_gross_revenue
-            output[fixed_costs_offset + i][num_years + 1] = totals.total_fixed_costs
-
-        output[net_revenue_offset][num_years + 1] = retailer_totals[
-            -1
-        ].total_net_revenue
-
-        npv = npf.npv(desired_irr, cashflows)
-        irr = npf.irr(cashflows)
-        print('old irr: ', irr, file=sys.stderr)
-        if np.isnan(irr):
-            irr = -999999999
-        print('new irr: ', irr, file=sys.stderr)
-        output[net_revenue_offset + 3][1] = npv
-        output[net_revenue_offset + 4][1] = irr
-        if npv < 0:
-            output[net_revenue_offset + 5][
-                1
-            ] = "Project is not Financially Viable. Reject."
-        elif irr < desired_irr:
-            output[net_revenue_offset + 5][
-                1
-            ] = "Project is Financially Viable, but does not meet desired IRR. Reject."
-        else:
-            output[net_revenue_offset + 5][1] = "Project is Financially Viable. Accept."
-
-        print('output: ', output, file=sys.stderr)
-        return output
-    finally:
-        await db.disconnect()
+
+async def grid_stage(**kwargs):
+    """The sheet's line items, which the financial inputs don't affect, and the yearly net revenue"""
+    retailers, agreements, list_prices, volumes = await volumes_cache.get(**kwargs)
+    return revenue_grid(
+        retailers, agreements, list_prices, volumes, kwargs["variable_cost"], kwargs["num_years"]
+    )
+
+
+async def cashflows_stage(inital_investment: float, **kwargs):
+    """The grid stage, plus the cashflows and their IRR"""
+    output, offsets, net_revenue = await grid_cache.get(**kwargs)
+    cashflows, solved = solve_cashflows(net_revenue, inital_investment)
+    return output, offsets, cashflows, solved
+
+
+def comparable_windows(
+    retailers: List[Retailer],
+    list_prices: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    num_years: int,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+) -> List[ComparableWindow]:
+    """The window of comparable products around each retailer's list price in each year"""
+    windows = []
+    for retailer in retailers:
+        for year in range(1, num_years + 1):
+            list_price = list_prices[(retailer.id, year)]
+            contribution_margin = (list_price - variable_cost) / list_price
+            windows.append(ComparableWindow(
+                retailer_id=retailer.id,
+                year=year,
+                min_margin=contribution_margin - relevant_contribution_margin_range,
+                max_margin=contribution_margin + relevant_contribution_margin_range,
+                min_price=list_price * (1 - relevant_list_price_range),
+                max_price=list_price * (1 + relevant_list_price_range),
+            ))
+    return windows
+
+
+# pylint: disable=too-many-arguments
+def forecast_sheet(
+    retailers: List[Retailer],
+    agreements: Dict[Tuple[int, int], RetailerYear],
+    list_prices: Dict[Tuple[int, int], float],
+    volumes: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    num_years: int,
+    desired_irr: float,
+    inital_investment: float,
+):
+    """
+    Computes the spreadsheet from already loaded agreements, list prices
+    and comparable volumes, all keyed by (retailer_id, year).
+    """
+    output, offsets, net_revenue = revenue_grid(
+        retailers, agreements, list_prices, volumes, variable_cost, num_years
+    )
+    cashflows, solved = solve_cashflows(net_revenue, inital_investment)
+    fill_decision(output, offsets, cashflows, solved, desired_irr)
+    logger.debug("output: %s", output)
+    return output
+
+
+# pylint: disable=too-many-arguments
+def revenue_grid(
+    retailers: List[Retailer],
+    agreements: Dict[Tuple[int, int], RetailerYear],
+    list_prices: Dict[Tuple[int, int], float],
+    volumes: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    num_years: int,
+) -> Tuple[List[List[str | float | int]], List[int], np.ndarray]:
+    """
+    Fills a template spreadsheet with every line item of the forecast,
+    and returns it with its row offsets and the net revenue of each year.
+    """
+
+    def matrix(value) -> np.ndarray:
+        return retailer_year_matrix(retailers, num_years, value)
+
+    with stage("forecast"):
+        result = compute_forecast(
+            volume=matrix(lambda r, y: volumes[(r, y)]),
+            list_price=matrix(lambda r, y: list_prices[(r, y)]),
+            retailer_markup=matrix(lambda r, y: agreements[(r, y)].retailer_markup),
+            fixed_costs=matrix(lambda r, y: fixed_costs(agreements[(r, y)])),
+            variable_cost=variable_cost,
+            inital_investment=0,
+        )
+        output, offsets = create_template_sheet(retailers, num_years)
+        fill_template_sheet(output, offsets, result)
+    return output, offsets, result.net_revenue
+
+
+def solve_cashflows(net_revenue: np.ndarray, inital_investment: float) -> Tuple[np.ndarray, finance.IRRResult]:
+    """The cashflows of a forecast, the investment followed by each year's net revenue, and their IRR"""
+    cashflows = np.concatenate([[-float(inital_investment)], net_revenue])
+    with stage("irr"):
+        solved = finance.irr(cashflows)
+    logger.debug("irr: %s %s", float(solved.irr), solved.report())
+    return cashflows, solved
+
+
+def fill_decision(
+    output: List[List[str | float | int]],
+    offsets: List[int],
+    cashflows: np.ndarray,
+    solved: finance.IRRResult,
+    desired_irr: float,
+) -> None:
+    """Fills the NPV, IRR and recommendation into a spreadsheet"""
+    net_revenue_offset = offsets[-1]
+    npv = float(finance.npv(desired_irr, cashflows))
+    irr = float(solved.irr)
+    output[net_revenue_offset + 3][1] = npv
+    output[net_revenue_offset + 4][1] = "No IRR" if solved.no_irr else irr
+    if solved.multiple_irr:
+        output[net_revenue_offset + 4][2] = "Multiple IRRs, showing the one closest to 0%"
+    elif not solved.converged:
+        output[net_revenue_offset + 4][2] = "IRR did not converge"
+    output[net_revenue_offset + 5][1] = RECOMMENDATIONS[int(recommend(npv, irr, desired_irr))]
+
+
+prices_cache = ResultCache(prices_stage, name="prices")
+volumes_cache = ResultCache(volumes_stage, name="volumes")
+grid_cache = ResultCache(grid_stage, name="grid")
+cashflows_cache = ResultCache(cashflows_stage, name="cashflows")
+# the decision depends on every input, so the sheet cache is its stage
+sheet_cache = ResultCache(calc_output, name="decision")
+for stage_cache in (prices_cache, volumes_cache, grid_cache, cashflows_cache):
+    registry.gauges(f"stage_cache_{stage_cache.name}", stage_cache.metrics)
+registry.gauges("sheet_cache", sheet_cache.metrics)
@@ -0,0 +1,151 @@
+"""
+Application-lifetime database client. A single pooled Prisma client is
+connected at startup and shared by every request in the process, instead
+of a new query-engine connection per forecast.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from prisma import Prisma
+from prisma.engine.errors import EngineConnectionError, NotConnectedError
+from prisma.errors import ClientNotConnectedError, HTTPClientClosedError
+
+from api.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", "10"))
+POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT", "10"))
+CONNECT_TIMEOUT = int(os.environ.get("DATABASE_CONNECT_TIMEOUT", "10"))
+CONNECT_ATTEMPTS = int(os.environ.get("DATABASE_CONNECT_ATTEMPTS", "3"))
+
+# errors that mean the query engine connection is gone, rather than the query being bad
+CONNECTION_ERRORS = (
+    EngineConnectionError,
+    NotConnectedError,
+    ClientNotConnectedError,
+    HTTPClientClosedError,
+)
+
+
+def pooled_url(url: str, pool_size: int, pool_timeout: int) -> str:
+    """
+    Adds the connection pool settings to a database url, leaving any
+    settings that were already configured in the url untouched.
+    """
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault("connection_limit", str(pool_size))
+    query.setdefault("pool_timeout", str(pool_timeout))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class Database:
+    """
+    Owns the process-wide Prisma client: connects it on startup,
+    reconnects it after a connection failure and disconnects it on shutdown.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = POOL_SIZE,
+        pool_timeout: int = POOL_TIMEOUT,
+        connect_timeout: int = CONNECT_TIMEOUT,
+        connect_attempts: int = CONNECT_ATTEMPTS,
+    ):
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.connect_timeout = connect_timeout
+        self.connect_attempts = connect_attempts
+        self._client: Optional[Prisma] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _create_client(self) -> Prisma:
+        url = os.environ.get("DATABASE_URL")
+        datasource = (
+            {"url": pooled_url(url, self.pool_size, self.pool_timeout)}
+            if url
+            else None
+        )
+        return Prisma(datasource=datasource, connect_timeout=self.connect_timeout)
+
+    @property
+    def is_connected(self) -> bool:
+        """Whether the shared client currently holds a query-engine connection"""
+        return self._client is not None and self._client.is_connected()
+
+    async def connect(self) -> Prisma:
+        """
+        Connects the shared client if it isn't already connected, retrying
+        with exponential backoff.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._client is not None and self._client.is_connected():
+                return self._client
+            for attempt in range(self.connect_attempts):
+                client = self._create_client()
+                try:
+                    await client.connect()
+                except CONNECTION_ERRORS as e:
+                    if attempt == self.connect_attempts - 1:
+                        raise
+                    logger.warning("database connection attempt %d failed: %s", attempt + 1, e)
+                    await asyncio.sleep(0.5 * 2**attempt)
+                    continue
+                self._client = client
+                break
+            assert self._client is not None
+            return self._client
+
+    async def disconnect(self) -> None:
+        """Disconnects the shared client, e.g. on graceful shutdown"""
+        client, self._client = self._client, None
+        if client is not None and client.is_connected():
+            await client.disconnect()
+
+    async def reconnect(self) -> Prisma:
+        """Drops the current connection and establishes a new one"""
+        try:
+            await self.disconnect()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning("failed to disconnect broken database client: %s", e)
+        return await self.connect()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[Prisma]:
+        """
+        Yields the connected shared client. If the connection turns out to
+        be broken, the client is disconnected, so its query engine doesn't
+        linger, and discarded so the next session reconnects.
+        """
+        with stage("db_connect"):
+            client = await self.connect()
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            try:
+                await client.disconnect()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.warning("failed to disconnect broken database client: %s", e)
+            if self._client is client:
+                self._client = None
+            raise
+
+    async def health_check(self) -> bool:
+        """Returns True if the database answers a trivial query"""
+        try:
+            async with self.session() as client:
+                await client.query_raw("SELECT 1")
+            return True
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.warning("database health check failed: %s", e)
+            return False
+
+
+database = Database()
@@ -0,0 +1,113 @@
+"""
+Per-request deadlines. Google Sheets gives up on a custom function after
+about 30 seconds, so every request gets a deadline that bounds database
+queries and the PriceAPI lookup. When a stage runs out of time, the
+forecast degrades instead of failing, in this order:
+
+1. the last market price fetched for the category, however old
+2. the category's average list price in the historical data
+3. a partial result that says what is missing
+
+Fallbacks used are recorded per request (per forecast, in a batch), so the
+response can report them.
+The deadline and fallbacks live in context variables, like the stage
+timings in api.metrics: tasks started during a request share them.
+"""
+import asyncio
+import functools
+import os
+from contextvars import ContextVar
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+from api.metrics import registry
+
+T = TypeVar("T")
+
+# leaves a few seconds of the Sheets timeout for the network and serialization
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "25"))
+
+STALE_PRICE = "stale_price"
+HISTORY_PRICE = "history_price"
+PARTIAL_RESULT = "partial_result"
+FALLBACK_DESCRIPTIONS = {
+    STALE_PRICE: "Market price is an old cached price, PriceAPI didn't answer in time",
+    HISTORY_PRICE: "List price is the category's historical average, no market price was available",
+    PARTIAL_RESULT: "Partial result, the forecast couldn't be completed",
+}
+
+FALLBACKS = registry.counter("forecast_fallbacks_total", "Degraded results, by fallback used")
+DEADLINES_EXCEEDED = registry.counter("deadline_exceeded_total", "Stages cut short by the request deadline")
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+_fallbacks: ContextVar[Optional[List[str]]] = ContextVar("fallbacks", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before a stage finished"""
+
+
+def start_deadline(seconds: float = REQUEST_DEADLINE) -> None:
+    """
+    Starts the deadline of the current request, `seconds` from now, and
+    starts recording its fallbacks.
+    """
+    _deadline.set(asyncio.get_running_loop().time() + seconds)
+    start_fallbacks()
+
+
+def start_fallbacks() -> List[str]:
+    """Starts recording fallbacks afresh, e.g. for each forecast of a batch"""
+    recorded: List[str] = []
+    _fallbacks.set(recorded)
+    return recorded
+
+
+def remaining() -> Optional[float]:
+    """Seconds left until the current request's deadline, or None if it has none"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+
+async def bounded(awaitable: Awaitable[T], reserve: float = 0) -> T:
+    """
+    Awaits `awaitable`, cancelling it if it is still running `reserve`
+    seconds before the request's deadline. Outside a request it isn't bounded.
+    """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left - reserve, 0))
+    except asyncio.TimeoutError as e:
+        DEADLINES_EXCEEDED.inc()
+        raise DeadlineExceeded("the request's deadline was reached") from e
+
+
+def deadline_bounded(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Bounds every call of an async function by the request deadline (see `bounded`)"""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs) -> T:
+        return await bounded(fn(*args, **kwargs))
+
+    return wrapper
+
+
+def record_fallback(name: str, count: bool = True) -> None:
+    """
+    Records that the current request used a fallback (once per request).
+    With count=False, it isn't counted again in the metrics, e.g. when the
+    computation that used it was already counted (see api.result_cache).
+    """
+    fallbacks = _fallbacks.get()
+    if count and (fallbacks is None or name not in fallbacks):
+        FALLBACKS.inc(fallback=name)
+    if fallbacks is not None and name not in fallbacks:
+        fallbacks.append(name)
+
+
+def fallbacks() -> List[str]:
+    """The fallbacks the current request used so far"""
+    return list(_fallbacks.get() or ())
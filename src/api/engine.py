@@ -0,0 +1,111 @@
+"""
+Vectorized forecast engine. Every line item of the spreadsheet is
+computed for all retailers and years at once from (retailers x years)
+matrices, instead of cell by cell.
+
+All inputs may carry extra leading dimensions (e.g. scenarios x retailers
+x years), in which case every scenario is computed in the same pass.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class ForecastResult:  # pylint: disable=too-many-instance-attributes
+    """
+    Line items of a forecast. Per-retailer items have shape (..., R, Y),
+    per-year totals (..., Y), and per-retailer totals over all years (..., R).
+    """
+
+    volume: np.ndarray
+    retailer_price: np.ndarray
+    retailer_sales_revenue: np.ndarray
+    manufacturer_sales_revenue: np.ndarray
+    manufacturer_gross_revenue: np.ndarray
+    fixed_costs: np.ndarray
+    net_revenue: np.ndarray
+    cashflows: np.ndarray
+
+    @staticmethod
+    def year_totals(item: np.ndarray) -> np.ndarray:
+        """Totals a per-retailer line item over all retailers, for each year"""
+        return item.sum(axis=-2)
+
+    @staticmethod
+    def retailer_totals(item: np.ndarray) -> np.ndarray:
+        """Totals a per-retailer line item over all years, for each retailer"""
+        return item.sum(axis=-1)
+
+
+def contribution_margins(list_price: np.ndarray, variable_cost) -> np.ndarray:
+    """Contribution margin of each unit sold at the given list prices"""
+    return (list_price - variable_cost) / list_price
+
+
+# pylint: disable=too-many-arguments
+def window_mask(
+    prices: np.ndarray,
+    margins: np.ndarray,
+    list_price,
+    contribution_margin,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+) -> np.ndarray:
+    """
+    Which comparables, given as columns of list prices and margins, fall in
+    the window around each (list_price, contribution_margin) pair. The
+    pairs may be arrays, in which case the mask has their shape plus one
+    trailing dimension over the comparables.
+    """
+    list_price = np.asarray(list_price)[..., np.newaxis]
+    contribution_margin = np.asarray(contribution_margin)[..., np.newaxis]
+    return (
+        (margins >= contribution_margin - relevant_contribution_margin_range)
+        & (margins <= contribution_margin + relevant_contribution_margin_range)
+        & (prices >= list_price * (1 - relevant_list_price_range))
+        & (prices <= list_price * (1 + relevant_list_price_range))
+    )
+
+
+# pylint: disable=too-many-arguments
+def compute_forecast(
+    volume: np.ndarray,
+    list_price: np.ndarray,
+    retailer_markup: np.ndarray,
+    fixed_costs: np.ndarray,
+    variable_cost,
+    inital_investment,
+) -> ForecastResult:
+    """
+    Computes every line item of the forecast from (..., R, Y) matrices of
+    expected volume, list price, retailer markup and fixed costs.
+    `variable_cost` and `inital_investment` are scalars, or arrays that
+    broadcast against the leading dimensions.
+    """
+    volume = np.asarray(volume, dtype=float)
+    list_price = np.asarray(list_price, dtype=float)
+    fixed_costs = np.broadcast_to(np.asarray(fixed_costs, dtype=float), volume.shape)
+    variable_cost = np.asarray(variable_cost, dtype=float)[..., np.newaxis, np.newaxis]
+    inital_investment = np.asarray(inital_investment, dtype=float)[..., np.newaxis]
+
+    retailer_price = list_price * (1 + np.asarray(retailer_markup, dtype=float))
+    retailer_sales_revenue = volume * retailer_price
+    manufacturer_sales_revenue = volume * list_price
+    manufacturer_gross_revenue = manufacturer_sales_revenue * contribution_margins(
+        list_price, variable_cost
+    )
+    net_revenue = manufacturer_gross_revenue.sum(axis=-2) - fixed_costs.sum(axis=-2)
+
+    investment = np.broadcast_to(-inital_investment, net_revenue.shape[:-1] + (1,))
+    cashflows = np.concatenate([investment, net_revenue], axis=-1)
+    return ForecastResult(
+        volume=volume,
+        retailer_price=retailer_price,
+        retailer_sales_revenue=retailer_sales_revenue,
+        manufacturer_sales_revenue=manufacturer_sales_revenue,
+        manufacturer_gross_revenue=manufacturer_gross_revenue,
+        fixed_costs=fixed_costs,
+        net_revenue=net_revenue,
+        cashflows=cashflows,
+    )
@@ -0,0 +1,215 @@
+"""
+Batched NPV and IRR. Cashflows are (..., T) arrays, one vector of T
+yearly cashflows (starting with the initial investment) per scenario,
+and every scenario is solved in the same vectorized pass.
+
+IRRs are bracketed on a fixed grid of rates, which also tells whether a
+cashflow has no IRR or more than one, and then every bracket is refined
+with Newton's method, falling back to bisection whenever a step leaves
+the bracket. Like numpy_financial.irr, the IRR closest to 0% is reported
+when there are several. Unlike it, only IRRs on the grid's range, from
+-99.9999% to +99999900%, are found.
+"""
+import os
+from dataclasses import dataclass
+from typing import Any, Dict
+
+import numpy as np
+
+IRR_TOLERANCE = float(os.environ.get("IRR_TOLERANCE", "1e-12"))
+IRR_MAX_ITERATIONS = int(os.environ.get("IRR_MAX_ITERATIONS", "100"))
+# IRRs are searched between -99.9999% and +99999900%, with a finer grid where
+# they usually are, so two IRRs rarely fall between the same grid points
+RATE_GRID = np.unique(np.concatenate([np.logspace(-6, 6, 241) - 1, np.linspace(-0.5, 1, 301)]))
+
+IRR_OK = "ok"
+NO_IRR = "no_irr"
+MULTIPLE_IRR = "multiple_irr"
+NOT_CONVERGED = "not_converged"
+
+RECOMMENDATIONS = (
+    "Project is not Financially Viable. Reject.",
+    "Project is Financially Viable, but does not meet desired IRR. Reject.",
+    "Project is Financially Viable. Accept.",
+)
+
+
+@dataclass
+class IRRResult:
+    """
+    IRR of each scenario (NaN where there is none) and how it was found.
+    All arrays have the leading shape of the cashflows.
+    """
+
+    irr: np.ndarray
+    converged: np.ndarray
+    iterations: np.ndarray
+    residual: np.ndarray
+    no_irr: np.ndarray
+    multiple_irr: np.ndarray
+
+    @property
+    def status(self) -> np.ndarray:
+        """IRR_OK, NO_IRR, MULTIPLE_IRR or NOT_CONVERGED for each scenario"""
+        return np.select(
+            [self.no_irr, ~self.converged, self.multiple_irr],
+            [NO_IRR, NOT_CONVERGED, MULTIPLE_IRR],
+            IRR_OK,
+        )
+
+    def report(self) -> Dict[str, Any]:
+        """Summary of the solver's convergence over all scenarios"""
+        solved = ~self.no_irr
+        return {
+            "scenarios": int(self.irr.size),
+            "converged": int(np.count_nonzero(self.converged & solved)),
+            "no_irr": int(np.count_nonzero(self.no_irr)),
+            "multiple_irr": int(np.count_nonzero(self.multiple_irr)),
+            "max_iterations": int(self.iterations.max(initial=0)),
+            "max_residual": float(np.nanmax(self.residual, initial=0.0)),
+        }
+
+
+def recommend(npv, irr, desired_irr):  # pylint: disable=redefined-outer-name
+    """
+    Returns the index into RECOMMENDATIONS for the given NPV and IRR.
+    Works elementwise on arrays, e.g. for a grid of scenarios. A missing
+    (NaN) IRR never meets the desired IRR.
+    """
+    meets_irr = np.nan_to_num(irr, nan=-np.inf) >= desired_irr
+    return np.where(npv < 0, 0, np.where(meets_irr, 2, 1))
+
+
+def npv(rate, cashflows: np.ndarray) -> np.ndarray:
+    """
+    NPV of (..., T) cashflows at `rate`, which broadcasts against the
+    leading dimensions. The first cashflow is not discounted, as in
+    numpy_financial.npv.
+    """
+    cashflows = np.asarray(cashflows, dtype=float)
+    rate = np.asarray(rate, dtype=float)[..., np.newaxis]
+    years = np.arange(cashflows.shape[-1])
+    return (cashflows / (1 + rate) ** years).sum(axis=-1)
+
+
+def _exponents(rate: np.ndarray, years: np.ndarray) -> np.ndarray:
+    """
+    Powers of (1 + rate) that each cashflow is multiplied by: the discount
+    factors' -year for positive rates, and those times (1 + rate)^(T - 1)
+    for negative ones. Scaling the NPV by a positive factor keeps its sign
+    and roots, and no power of (1 + rate) exceeds 1, so rates near -100%
+    don't overflow.
+    """
+    shift = np.where(rate < 0, years[-1], 0)
+    return shift[..., np.newaxis] - years
+
+
+def _npv_and_slope(rate: np.ndarray, cashflows: np.ndarray, exponents: np.ndarray):
+    growth = (1 + rate[:, np.newaxis]) ** exponents
+    value = (cashflows * growth).sum(axis=-1)
+    slope = (cashflows * exponents * growth / (1 + rate[:, np.newaxis])).sum(axis=-1)
+    magnitude = np.abs(cashflows * growth).sum(axis=-1)
+    return value, slope, magnitude
+
+
+# pylint: disable=too-many-locals
+def irr(
+    cashflows: np.ndarray,
+    tolerance: float = IRR_TOLERANCE,
+    max_iterations: int = IRR_MAX_ITERATIONS,
+) -> IRRResult:
+    """Solves the IRR of every (..., T) cashflow vector at once"""
+    cashflows = np.asarray(cashflows, dtype=float)
+    shape = cashflows.shape[:-1]
+    flows = cashflows.reshape(-1, cashflows.shape[-1])
+    years = np.arange(flows.shape[-1])
+
+    # bracket every root on the grid; a zero counts as positive so a root
+    # exactly on a grid point is still bracketed once
+    with np.errstate(over="ignore", invalid="ignore", under="ignore"):
+        grid_npv = flows @ ((1 + RATE_GRID)[:, np.newaxis] ** _exponents(RATE_GRID, years)).T
+    signs = np.where(grid_npv < 0, -1, 1)
+    changes = (signs[:, :-1] != signs[:, 1:]) & np.isfinite(grid_npv[:, :-1]) & np.isfinite(grid_npv[:, 1:])
+    num_roots = changes.sum(axis=-1)
+    no_irr = num_roots == 0
+
+    # refine every bracket, then keep each scenario's root closest to 0%
+    rows, bracket = np.nonzero(changes)
+    root, converged, iterations, residual = _refine(
+        flows[rows],
+        years,
+        RATE_GRID[bracket],
+        RATE_GRID[bracket + 1],
+        grid_npv[rows, bracket],
+        tolerance,
+        max_iterations,
+    )
+    order = np.lexsort((np.abs(root), rows))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = rows[order][1:] != rows[order][:-1]
+    first = order[is_first]
+
+    def per_scenario(values: np.ndarray, missing) -> np.ndarray:
+        result = np.full(len(flows), missing, dtype=values.dtype)
+        result[rows[first]] = values[first]
+        return result
+
+    return IRRResult(
+        irr=per_scenario(root, np.nan).reshape(shape),
+        converged=per_scenario(converged, True).reshape(shape),
+        iterations=per_scenario(iterations, 0).reshape(shape),
+        residual=per_scenario(residual, np.nan).reshape(shape),
+        no_irr=no_irr.reshape(shape),
+        multiple_irr=(num_roots > 1).reshape(shape),
+    )
+
+
+# pylint: disable=too-many-arguments
+def _refine(
+    flows: np.ndarray,
+    years: np.ndarray,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    f_lo: np.ndarray,
+    tolerance: float,
+    max_iterations: int,
+):
+    """
+    Finds the root of each cashflow's NPV inside [lo, hi], where the NPV
+    changes sign. Returns the roots and whether, after how many iterations
+    and with what relative residual, each of them converged.
+    """
+    # one scaling per bracket, so the NPV stays continuous inside it
+    exponents = _exponents(hi, years)
+    rate = (lo + hi) / 2
+    converged = np.zeros(len(flows), dtype=bool)
+    iterations = np.zeros(len(flows), dtype=int)
+    residual = np.full(len(flows), np.nan)
+    for _ in range(max_iterations):
+        active = ~converged
+        if not active.any():
+            break
+        with np.errstate(under="ignore"):
+            value, slope, magnitude = _npv_and_slope(rate[active], flows[active], exponents[active])
+        # relative to the scaled cashflows, so it doesn't depend on the scaling
+        residual[active] = np.abs(value) / np.maximum(magnitude, 1e-300)
+        done = (residual[active] <= tolerance) | (
+            hi[active] - lo[active] <= tolerance * np.maximum(np.abs(rate[active]), 1)
+        )
+        iterations[active] += 1
+
+        # shrink the bracket around the root
+        same_side = np.sign(value) == np.sign(f_lo[active])
+        new_lo = np.where(same_side, rate[active], lo[active])
+        new_hi = np.where(same_side, hi[active], rate[active])
+        f_lo[active] = np.where(same_side, value, f_lo[active])
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = rate[active] - value / slope
+        inside = np.isfinite(newton) & (newton > new_lo) & (newton < new_hi)
+        next_rate = np.where(inside, newton, (new_lo + new_hi) / 2)
+
+        lo[active], hi[active] = new_lo, new_hi
+        rate[active] = np.where(done, rate[active], next_rate)
+        converged[active] = done
+    return rate, converged, iterations, residual
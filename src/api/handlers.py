@@ -0,0 +1,176 @@
+"""
+Request handling shared by the Flask development server (api.app) and
+the production ASGI app (api.asgi).
+"""
+import json
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional, Sequence, Union
+
+from api.admission import admit, check_cost, check_limits, forecast_cost
+from api.batch import BatchItem, run_batch
+from api.calc import sheet_cache
+from api.deadline import fallbacks, start_deadline
+from api.result_cache import cache_report, start_cache_report
+from api.schema import ForecastSpec, SimulationSpec, SweepSpec, parse_json, validate
+from api.simulation import SIMULATION_TIME_BUDGET, SIMULATION_TRIALS, calc_simulation
+from api.sweep import calc_sweep, expand_axis
+
+
+def forecast_kwargs(data: Any) -> Dict[str, Any]:
+    """
+    Validates a forecast spec sent by the Google Sheets custom function
+    (see `api.schema.ForecastSpec`), unless it already is one, and
+    converts it into keyword arguments for `calc_output`.
+    """
+    spec = data if isinstance(data, ForecastSpec) else validate(ForecastSpec, data)
+    check_limits(len(spec.retailers_mapping), spec.num_years)
+    return dict(
+        product_category=spec.product_category,
+        product_brand=spec.product_brand,
+        variable_cost=spec.variable_cost,
+        retailers_mapping=matrix_to_mapping(spec.retailers_mapping),
+        num_years=spec.num_years,
+        desired_irr=spec.desired_irr,
+        inital_investment=spec.inital_investment,
+        relevant_contribution_margin_range=spec.relevant_contribution_margin_range,
+        relevant_list_price_range=spec.relevant_list_price_range,
+        nearest_comparables=spec.nearest_comparables,
+    )
+
+
+async def compute_sheet_data(json_data: Optional[Union[str, bytes]], caller: str = ""):
+    """
+    Parses the json_data sent by the Google Sheets custom function, as a
+    query parameter or a POST body, and computes the spreadsheet, or
+    returns it from the result cache. Expensive forecasts wait their
+    caller's turn (see api.admission), unless the sheet is cached or
+    already being computed. The stages it reused are reported by
+    `api.result_cache.cache_report`.
+    """
+    start_deadline()
+    start_cache_report()
+    kwargs = forecast_kwargs(parse_json(json_data))
+    found, output = await sheet_cache.get_existing(**kwargs)
+    if found:
+        return output
+    async with admit(forecast_cost(kwargs), caller):
+        return await sheet_cache.get(**kwargs)
+
+
+async def compute_batch_data(body: bytes, caller: str = "") -> AsyncIterator[str]:
+    """
+    Parses a batch of forecast specs, {"forecasts": [spec, ...]}, and
+    yields one line of JSON per result as soon as it is ready. Each result
+    carries the spec's "id" (or its index in the batch) and a status, and
+    each sheet the fallbacks it used. Forecasts over MAX_REQUEST_COST fail
+    on their own, and the batch is admitted at the cost of the rest, or
+    rejected if that is over the limit too. The batch's deadline bounds
+    its wait for admission; its groups then get deadlines of their own.
+    """
+    start_deadline()
+    data = parse_json(body)
+    specs = data.get("forecasts") if isinstance(data, dict) else data
+    assert isinstance(specs, list), "Expected a list of forecasts"
+    items: List[BatchItem] = []
+    cost = 0.0
+    for i, spec in enumerate(specs):
+        item_id = spec.get("id", i) if isinstance(spec, dict) else i
+        try:
+            kwargs = forecast_kwargs(spec)
+            item_cost = forecast_cost(kwargs)
+            check_cost(item_cost)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            items.append((item_id, e))
+            continue
+        items.append((item_id, kwargs))
+        cost += item_cost
+    async with admit(cost, caller):
+        async for result in run_batch(items):
+            yield json.dumps(result) + "\n"
+
+
+async def compute_sweep_data(json_data: Optional[Union[str, bytes]], caller: str = ""):
+    """
+    Parses a sweep request and computes its grid of scenarios. The request
+    has the same fields as a forecast, except that variable_cost,
+    desired_irr and inital_investment may be lists or ranges, and an
+    optional list_price axis overrides the retailers' list prices.
+    """
+    start_deadline()
+    spec = validate(SweepSpec, parse_json(json_data))
+    check_limits(len(spec.retailers_mapping), spec.num_years)
+    kwargs = dict(
+        product_category=spec.product_category,
+        product_brand=spec.product_brand,
+        retailers_mapping=matrix_to_mapping(spec.retailers_mapping),
+        num_years=spec.num_years,
+        relevant_contribution_margin_range=spec.relevant_contribution_margin_range,
+        relevant_list_price_range=spec.relevant_list_price_range,
+        variable_cost=expand_axis(spec.variable_cost),
+        list_price=expand_axis(spec.list_price),
+        desired_irr=expand_axis(spec.desired_irr),
+        inital_investment=expand_axis(spec.inital_investment),
+    )
+    scenarios = 1
+    for axis in ("variable_cost", "list_price", "desired_irr", "inital_investment"):
+        scenarios *= len(kwargs[axis])
+    async with admit(forecast_cost(kwargs, scenarios), caller):
+        return await calc_sweep(**kwargs)
+
+
+async def compute_simulation_data(json_data: Optional[Union[str, bytes]], caller: str = ""):
+    """
+    Parses a simulation request and runs it. The request has the same
+    fields as a forecast, plus optional "trials", "time_budget_seconds",
+    "sample_prices" and "seed".
+    """
+    start_deadline()
+    spec = validate(SimulationSpec, parse_json(json_data))
+    kwargs = forecast_kwargs(spec)
+    trials = spec.trials or SIMULATION_TRIALS
+    async with admit(forecast_cost(kwargs, trials), caller):
+        return await calc_simulation(
+            **kwargs,
+            trials=trials,
+            time_budget=spec.time_budget_seconds or SIMULATION_TIME_BUDGET,
+            sample_prices=spec.sample_prices,
+            seed=spec.seed,
+        )
+
+
+def caller_id(headers: Mapping[str, str], client_host: Optional[str]) -> str:
+    """
+    Identifies the caller for fair queueing: the spreadsheet id sent by
+    script.gs in X-Caller, or else the client's address.
+    """
+    forwarded = headers.get("x-forwarded-for", "").split(",")[0].strip()
+    return headers.get("x-caller") or forwarded or client_host or ""
+
+
+def fallback_headers() -> Dict[str, str]:
+    """Names the fallbacks (see api.deadline) the request used, if any"""
+    used = fallbacks()
+    return {"Forecast-Fallbacks": ", ".join(used)} if used else {}
+
+
+def sheet_headers() -> Dict[str, str]:
+    """
+    The fallbacks a sheet request used, and how it found each stage of
+    the forecast (see api.calc), e.g. "decision=miss, cashflows=hit"
+    """
+    headers = fallback_headers()
+    report = cache_report()
+    if report:
+        headers["Forecast-Stages"] = ", ".join(f"{name}={outcome}" for name, outcome in report.items())
+    return headers
+
+
+def matrix_to_mapping(matrix: Sequence[Sequence[Any]]) -> Dict[str, Any]:
+    """
+    Converts a matrix of values into a dictionary that maps from the
+    first column to the remaining columns.
+    """
+    m = len(matrix)  # pylint: disable=invalid-name
+    mapping = {}
+    for i in range(m):
+        mapping[matrix[i][0]] = tuple(matrix[i][1:])
+    return mapping
@@ -0,0 +1,184 @@
+"""
+Hot-path instrumentation: per-stage timings of each request (sent back in
+a Server-Timing header) and process-wide counters and histograms, served
+in the Prometheus text format at /metrics.
+
+Metrics are kept per worker process, so each uvicorn worker reports its
+own; Prometheus adds them up across pods and workers.
+"""
+import functools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# seconds; forecasts range from a few ms (all cached) to a PriceAPI job
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        return f"{name}{{{label_text}}} {value}"
+    return f"{name} {value}"
+
+
+class Counter:
+    """A monotonically increasing count, per set of labels"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """Adds `amount` to the count for these labels"""
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        """Lines of the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(_format(self.name, labels, value) for labels, value in self.values.items())
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, per set of labels"""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self.values: Dict[Labels, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """Records one observation for these labels"""
+        key = _labels(labels)
+        counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        """Lines of the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(_format(f"{self.name}_bucket", labels + (("le", str(bound)),), bucket_count))
+            lines.append(_format(f"{self.name}_bucket", labels + (("le", "+Inf"),), count))
+            lines.append(_format(f"{self.name}_sum", labels, total))
+            lines.append(_format(f"{self.name}_count", labels, count))
+        return lines
+
+
+class Registry:
+    """All metrics of this process, plus gauges read from other components"""
+
+    def __init__(self):
+        self.metrics: List[Any] = []
+        self.gauge_sources: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        """Creates and registers a counter"""
+        counter = Counter(name, documentation)
+        self.metrics.append(counter)
+        return counter
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = BUCKETS) -> Histogram:
+        """Creates and registers a histogram"""
+        histogram = Histogram(name, documentation, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def gauges(self, prefix: str, source: Callable[[], Dict[str, Any]]) -> None:
+        """
+        Exports every numeric value returned by `source()` as a gauge named
+        `{prefix}_{key}`, e.g. the hit counters of a cache.
+        """
+        self.gauge_sources.append((prefix, source))
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for prefix, source in self.gauge_sources:
+            for key, value in source().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{key} gauge")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("forecast_stage_seconds", "Time spent in each stage of a request")
+QUERY_SECONDS = registry.histogram("db_query_seconds", "Latency of database queries")
+QUERIES = registry.counter("db_queries_total", "Database queries issued")
+REQUEST_SECONDS = registry.histogram("http_request_duration_seconds", "Latency of HTTP requests")
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("timings", default=None)
+
+
+def start_timings() -> Dict[str, float]:
+    """
+    Starts collecting stage timings for the current request. Tasks started
+    from here on share the collection, so stages they run are included.
+    """
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def record(name: str, seconds: float) -> None:
+    """Records time spent in a stage, for the histogram and the current request"""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the enclosed block as stage `name`"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def timed_query(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """
+    Counts and times calls of an async query function, under its own name
+    and as part of the request's "db" stage.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs) -> T:
+        QUERIES.inc(query=fn.__name__)
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_SECONDS.observe(elapsed, query=fn.__name__)
+            record("db", elapsed)
+
+    return wrapper
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Formats stage timings as a Server-Timing header value, in milliseconds"""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
@@ -0,0 +1,189 @@
+"""
+Monte Carlo kernel. Each trial samples the volume sold at every retailer
+in every year from the comparable products in its window, instead of
+using their mean, and optionally samples the market price from the
+spread of PriceAPI prices. Trials run in vectorized blocks; a block only
+depends on its inputs and seed, so blocks can run in worker processes.
+A block given a time to stop at gives up once it passes, so blocks still
+queued or running after a simulation's deadline don't keep workers busy.
+
+This module only depends on numpy, to keep the worker processes light.
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from api import finance
+from api.engine import compute_forecast, contribution_margins, window_mask
+
+PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+# bounds the (trials x comparables) masks built when prices are sampled
+MAX_MASK_ELEMENTS = 4_000_000
+
+# (list_price, contribution_margin, volume_sold) of comparable products
+Comparables = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+@dataclass
+class SimulationInputs:  # pylint: disable=too-many-instance-attributes
+    """
+    Everything a block of trials needs, as (retailers x years) matrices.
+    `comparables` holds the columns of each cell's comparables, in row-major
+    (retailer, year) order. Only retailers with `derived_price` follow the
+    sampled market price; the others keep the list price they were given.
+    """
+
+    list_price: np.ndarray
+    derived_price: np.ndarray
+    retailer_markup: np.ndarray
+    fixed_costs: np.ndarray
+    comparables: List[Comparables]
+    variable_cost: float
+    inital_investment: float
+    desired_irr: float
+    relevant_contribution_margin_range: float
+    relevant_list_price_range: float
+    market_price: float = 0.0
+    market_price_spread: float = 0.0
+
+    @property
+    def samples_prices(self) -> bool:
+        """Whether trials sample the market price"""
+        return self.market_price > 0 and self.market_price_spread > 0 and bool(self.derived_price.any())
+
+    def narrowed(self) -> "SimulationInputs":
+        """
+        When prices aren't sampled every trial shares the same windows, so
+        only the comparables inside them are kept (and sent to workers).
+        """
+        if self.samples_prices:
+            return self
+        margins = contribution_margins(self.list_price, self.variable_cost)
+        comparables = []
+        for (prices, cell_margins, volumes), list_price, margin in zip(
+            self.comparables, self.list_price.ravel(), margins.ravel()
+        ):
+            in_window = window_mask(
+                prices,
+                cell_margins,
+                list_price,
+                margin,
+                self.relevant_contribution_margin_range,
+                self.relevant_list_price_range,
+            )
+            comparables.append((prices[in_window], cell_margins[in_window], volumes[in_window]))
+        return SimulationInputs(**{**self.__dict__, "comparables": comparables})
+
+
+def sample_market_prices(inputs: SimulationInputs, rng: np.random.Generator, trials: int) -> np.ndarray:
+    """
+    Market prices drawn from a lognormal distribution with the mean and
+    standard deviation of the PriceAPI prices, so they stay positive.
+    """
+    sigma2 = np.log1p((inputs.market_price_spread / inputs.market_price) ** 2)
+    return rng.lognormal(np.log(inputs.market_price) - sigma2 / 2, np.sqrt(sigma2), trials)
+
+
+def sample_volumes(
+    comparables: Comparables,
+    list_price: np.ndarray,
+    rng: np.random.Generator,
+    inputs: SimulationInputs,
+) -> np.ndarray:
+    """
+    Draws one comparable's volume per trial, uniformly from the comparables
+    in the window around that trial's list price (0 if it is empty).
+    """
+    prices, margins, volumes = comparables
+    trials = len(list_price)
+    if len(volumes) == 0:
+        return np.zeros(trials)
+    if not inputs.samples_prices:
+        return volumes[rng.integers(len(volumes), size=trials)]
+
+    sampled = np.zeros(trials)
+    chunk = max(1, MAX_MASK_ELEMENTS // len(volumes))
+    for start in range(0, trials, chunk):
+        price = list_price[start : start + chunk]
+        in_window = window_mask(
+            prices,
+            margins,
+            price,
+            contribution_margins(price, inputs.variable_cost),
+            inputs.relevant_contribution_margin_range,
+            inputs.relevant_list_price_range,
+        )
+        counts = in_window.sum(axis=-1)
+        # the k-th comparable in each trial's window, for a random k
+        k = np.floor(rng.random(len(price)) * counts)
+        index = np.argmax(np.cumsum(in_window, axis=-1) > k[:, np.newaxis], axis=-1)
+        sampled[start : start + chunk] = np.where(counts > 0, volumes[index], 0)
+    return sampled
+
+
+def simulate_block(
+    inputs: SimulationInputs,
+    seed: np.random.SeedSequence,
+    trials: int,
+    stop_at: Optional[float] = None,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Runs `trials` trials and returns the NPV and IRR (NaN if none) of each,
+    or None if the wall clock (time.time) passes `stop_at` before it is done.
+    """
+    if stop_at is not None and time.time() > stop_at:
+        return None
+    rng = np.random.default_rng(seed)
+    num_retailers, num_years = inputs.list_price.shape
+    list_price = np.repeat(inputs.list_price[np.newaxis], trials, axis=0)
+    if inputs.samples_prices:
+        factor = sample_market_prices(inputs, rng, trials) / inputs.market_price
+        list_price[:, inputs.derived_price, :] *= factor[:, np.newaxis, np.newaxis]
+
+    volume = np.zeros(list_price.shape)
+    for i in range(num_retailers):
+        for j in range(num_years):
+            if stop_at is not None and time.time() > stop_at:
+                return None
+            volume[:, i, j] = sample_volumes(
+                inputs.comparables[i * num_years + j], list_price[:, i, j], rng, inputs
+            )
+
+    result = compute_forecast(
+        volume=volume,
+        list_price=list_price,
+        retailer_markup=inputs.retailer_markup,
+        fixed_costs=inputs.fixed_costs,
+        variable_cost=inputs.variable_cost,
+        inital_investment=inputs.inital_investment,
+    )
+    return finance.npv(inputs.desired_irr, result.cashflows), finance.irr(result.cashflows).irr
+
+
+def percentiles(values: np.ndarray, qs: Sequence[int] = PERCENTILES) -> Dict[str, Optional[float]]:
+    """Percentiles of the values, keyed like "p50" (None if there are no values)"""
+    if len(values) == 0:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": float(v) for q, v in zip(qs, np.percentile(values, qs))}
+
+
+def summarize(npv: np.ndarray, irr: np.ndarray, desired_irr: float) -> Dict[str, object]:
+    """
+    Distribution of NPV and IRR over all trials. IRR percentiles are over
+    the trials that have an IRR. A project is viable when its NPV isn't
+    negative; "recommendations" gives the share of trials behind each of
+    finance.RECOMMENDATIONS.
+    """
+    decided = finance.recommend(npv, irr, desired_irr)
+    has_irr = ~np.isnan(irr)
+    return {
+        "npv": {"mean": float(npv.mean()), "std": float(npv.std()), **percentiles(npv)},
+        "irr": {**percentiles(irr[has_irr]), "no_irr_probability": float(1 - has_irr.mean())},
+        "probability_viable": float((npv >= 0).mean()),
+        "probability_meets_desired_irr": float((decided == 2).mean()),
+        "recommendations": {
+            text: float((decided == i).mean()) for i, text in enumerate(finance.RECOMMENDATIONS)
+        },
+    }
@@ -0,0 +1,96 @@
+"""
+Nearest comparables. Instead of averaging every historical product inside
+a hard list price / contribution margin window, which is either empty (a
+volume of 0) or, with the 999999999 defaults in script.gs, the whole
+category, a forecast can average the k products closest to it, weighted
+by inverse distance. The ranges are ignored in this mode.
+
+Lookups are answered by the snapshot's partitions (see
+`api.snapshot.Partition.nearest`); without a snapshot, partitions are
+built from the fetched comparables for each request.
+"""
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+from prisma import Prisma
+
+from api.engine import contribution_margins
+from api.queries import fetch_comparables
+from api.snapshot import Partition, product_snapshot
+from api.versions import record_read
+
+# a 10% difference in list price counts as much as 5 points of margin
+NEAREST_PRICE_SCALE = float(os.environ.get("NEAREST_PRICE_SCALE", "0.1"))
+NEAREST_MARGIN_SCALE = float(os.environ.get("NEAREST_MARGIN_SCALE", "0.05"))
+MAX_NEAREST_COMPARABLES = int(os.environ.get("MAX_NEAREST_COMPARABLES", "100"))
+# rows at least this close count as exact matches and outweigh all others
+MIN_DISTANCE = 1e-9
+
+EMPTY_PARTITION = Partition.from_columns(np.empty(0), np.empty(0), np.empty(0))
+
+
+async def load_partitions(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    retailer_ids: List[int],
+    num_years: int,
+) -> Dict[Tuple[int, int], Partition]:
+    """
+    Returns the comparables of every retailer and year as partitions, keyed
+    by (retailer_id, year), from the snapshot when it is loaded.
+    """
+    keys = [(r, y) for r in retailer_ids for y in range(1, num_years + 1)]
+    snapshot = product_snapshot.current
+    if snapshot is not None:
+        record_read(snapshot.version)
+        return {
+            key: snapshot.partitions.get((product_brand, product_category, *key), EMPTY_PARTITION)
+            for key in keys
+        }
+
+    rows = await fetch_comparables(db, product_brand, product_category, retailer_ids, num_years)
+    grouped: Dict[Tuple[int, int], List[Tuple[float, float, float]]] = {}
+    for row in rows:
+        grouped.setdefault((row.retailer_id, row.year), []).append(
+            (row.list_price, row.contribution_margin, row.volume_sold)
+        )
+    partitions = {}
+    for key in keys:
+        values = np.array(grouped.get(key, []), dtype=float).reshape(-1, 3)
+        partitions[key] = Partition.from_columns(values[:, 0], values[:, 1], values[:, 2])
+    return partitions
+
+
+def nearest_volume(partition: Partition, list_price: float, contribution_margin: float, k: int) -> float:
+    """Inverse-distance weighted volume of the k nearest comparables, or 0 if there are none"""
+    rows, distances = partition.nearest(
+        list_price, contribution_margin, k, NEAREST_PRICE_SCALE, NEAREST_MARGIN_SCALE
+    )
+    if len(rows) == 0:
+        return 0
+    weights = 1 / np.maximum(distances, MIN_DISTANCE)
+    return float(weights @ partition.volume_sold[rows] / weights.sum())
+
+
+def nearest_volumes(
+    partitions: Dict[Tuple[int, int], Partition],
+    list_prices: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    k: int,
+) -> Dict[Tuple[int, int], float]:
+    """
+    Nearest-comparables volume of a forecast at every retailer and year,
+    keyed by (retailer_id, year), from partitions loaded by `load_partitions`.
+    """
+    assert 0 < k <= MAX_NEAREST_COMPARABLES, f"nearest_comparables must be between 1 and {MAX_NEAREST_COMPARABLES}"
+    return {
+        key: nearest_volume(
+            partitions[key],
+            list_price,
+            float(contribution_margins(list_price, variable_cost)),
+            k,
+        )
+        for key, list_price in list_prices.items()
+    }
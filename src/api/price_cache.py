@@ -0,0 +1,272 @@
+"""
+Persistent, TTL-aware cache of average PriceAPI prices.
+
+Entries are fresh for PRICE_CACHE_TTL_SECONDS, after which they are still
+served for PRICE_CACHE_STALE_SECONDS while a background refresh fetches a
+new price. Failed lookups, and failed refreshes of stale entries, are
+remembered for a much shorter PRICE_CACHE_NEGATIVE_TTL_SECONDS, so a
+PriceAPI outage neither sticks nor starts a job on every request.
+The SQLite backend lives on a file that every worker (and the next pod)
+shares, so only the first request for a category waits on PriceAPI.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import statistics
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+PRICE_CACHE_BACKEND = os.environ.get("PRICE_CACHE_BACKEND", "memory")
+PRICE_CACHE_PATH = os.environ.get("PRICE_CACHE_PATH", "price_cache.sqlite3")
+# PriceAPI itself only refreshes results older than max_age=1440 minutes
+PRICE_CACHE_TTL = float(os.environ.get("PRICE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+PRICE_CACHE_STALE = float(os.environ.get("PRICE_CACHE_STALE_SECONDS", str(7 * 24 * 60 * 60)))
+PRICE_CACHE_NEGATIVE_TTL = float(os.environ.get("PRICE_CACHE_NEGATIVE_TTL_SECONDS", "60"))
+
+# the event loop only keeps weak references to tasks, so running refreshes are kept here
+_background_tasks: Set[asyncio.Task] = set()
+
+
+@dataclass
+class CachedPrice:
+    """
+    An average price, or a failed lookup (ok=False), and when it was
+    fetched. `spread` is the standard deviation of the prices averaged.
+    """
+
+    price: float
+    fetched_at: float
+    ok: bool = True
+    spread: float = 0.0
+
+
+@dataclass
+class PriceCacheStats:
+    """Hit/miss counters of a price cache"""
+
+    hits: int = 0
+    stale_hits: int = 0
+    negative_hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    refresh_errors: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        """Fraction of lookups that didn't have to wait on PriceAPI"""
+        served = self.hits + self.stale_hits + self.negative_hits
+        return served / (served + self.misses) if served + self.misses else 0.0
+
+
+class PriceCacheBackend:
+    """Storage for cached prices, keyed by product category"""
+
+    async def get(self, product_category: str) -> Optional[CachedPrice]:
+        """Returns the cached entry for a category, if any"""
+        raise NotImplementedError
+
+    async def set(self, product_category: str, entry: CachedPrice) -> None:
+        """Stores the entry for a category"""
+        raise NotImplementedError
+
+
+class MemoryPriceCacheBackend(PriceCacheBackend):
+    """Per-process backend, lost on restart"""
+
+    def __init__(self):
+        self.entries: Dict[str, CachedPrice] = {}
+
+    async def get(self, product_category: str) -> Optional[CachedPrice]:
+        return self.entries.get(product_category)
+
+    async def set(self, product_category: str, entry: CachedPrice) -> None:
+        self.entries[product_category] = entry
+
+
+class SqlitePriceCacheBackend(PriceCacheBackend):
+    """
+    Backend stored in a SQLite file, shared by every process that can see
+    the file. Queries run in a thread so they never block the event loop.
+    """
+
+    def __init__(self, path: str = PRICE_CACHE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS price_cache (
+                    product_category TEXT PRIMARY KEY,
+                    price REAL NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    ok INTEGER NOT NULL,
+                    spread REAL NOT NULL DEFAULT 0
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(price_cache)")}
+            if "spread" not in columns:
+                # files written before the spread was cached
+                conn.execute("ALTER TABLE price_cache ADD COLUMN spread REAL NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:  # commits on success
+                yield conn
+        finally:
+            conn.close()
+
+    def _get(self, product_category: str) -> Optional[CachedPrice]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT price, fetched_at, ok, spread FROM price_cache WHERE product_category = ?",
+                (product_category,),
+            ).fetchone()
+        return CachedPrice(price=row[0], fetched_at=row[1], ok=bool(row[2]), spread=row[3]) if row else None
+
+    def _set(self, product_category: str, entry: CachedPrice) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO price_cache (product_category, price, fetched_at, ok, spread)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (product_category, entry.price, entry.fetched_at, int(entry.ok), entry.spread),
+            )
+
+    async def get(self, product_category: str) -> Optional[CachedPrice]:
+        return await asyncio.to_thread(self._get, product_category)
+
+    async def set(self, product_category: str, entry: CachedPrice) -> None:
+        await asyncio.to_thread(self._set, product_category, entry)
+
+
+class PriceCache:
+    """
+    Serves average prices from a backend, fetching them with `fetch_prices`
+    on a miss and refreshing stale entries in the background.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        backend: PriceCacheBackend,
+        fetch_prices: Callable[[str], Awaitable[List[float]]],
+        ttl: float = PRICE_CACHE_TTL,
+        stale: float = PRICE_CACHE_STALE,
+        negative_ttl: float = PRICE_CACHE_NEGATIVE_TTL,
+    ):
+        self.backend = backend
+        self.fetch_prices = fetch_prices
+        self.ttl = ttl
+        self.stale = stale
+        self.negative_ttl = negative_ttl
+        self.stats = PriceCacheStats()
+        self._refreshing: Set[str] = set()
+        # when refreshing a stale entry last failed, per category
+        self._failed_refreshes: Dict[str, float] = {}
+        # the newest successful lookup seen per category, however old
+        self._last_good: Dict[str, CachedPrice] = {}
+
+    async def get(self, product_category: str) -> float:
+        """
+        Returns the average price for a category, or 0 if it can't be fetched.
+        """
+        return (await self.get_entry(product_category)).price
+
+    async def get_entry(self, product_category: str) -> CachedPrice:
+        """Like `get`, but returns the whole entry, including the price spread"""
+        entry = await self.backend.get(product_category)
+        if entry is not None:
+            if entry.ok:
+                self._last_good[product_category] = entry
+            age = time.time() - entry.fetched_at
+            if not entry.ok and age < self.negative_ttl:
+                self.stats.negative_hits += 1
+                return entry
+            if entry.ok and age < self.ttl:
+                self.stats.hits += 1
+                return entry
+            if entry.ok and age < self.ttl + self.stale:
+                self.stats.stale_hits += 1
+                self.refresh_in_background(product_category, entry)
+                return entry
+        self.stats.misses += 1
+        # shielded so a caller that runs out of time leaves the fetch filling the cache
+        return await asyncio.shield(_spawn(self.refresh(product_category)))
+
+    def last_good(self, product_category: str) -> Optional[CachedPrice]:
+        """
+        The newest successful lookup this process has seen for a category,
+        even if it expired or was replaced by a failure since.
+        """
+        return self._last_good.get(product_category)
+
+    async def refresh(
+        self, product_category: str, stale_entry: Optional[CachedPrice] = None
+    ) -> CachedPrice:
+        """
+        Fetches the average price for a category and stores it. If the
+        fetch fails, a stale entry is kept rather than replaced by a failure,
+        and isn't refreshed again for PRICE_CACHE_NEGATIVE_TTL_SECONDS.
+        """
+        self.stats.refreshes += 1
+        try:
+            prices = await self.fetch_prices(product_category)
+            assert len(prices) > 0, f"No prices found for category {product_category}"
+            entry = CachedPrice(
+                price=statistics.fmean(prices),
+                fetched_at=time.time(),
+                spread=statistics.pstdev(prices),
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.stats.refresh_errors += 1
+            logger.exception(e)
+            if stale_entry is not None:
+                self._failed_refreshes[product_category] = time.time()
+                return stale_entry
+            entry = CachedPrice(price=0, fetched_at=time.time(), ok=False)
+        await self.backend.set(product_category, entry)
+        if entry.ok:
+            self._last_good[product_category] = entry
+            self._failed_refreshes.pop(product_category, None)
+        return entry
+
+    def refresh_in_background(self, product_category: str, stale_entry: CachedPrice) -> None:
+        """
+        Starts refreshing a category, unless a refresh is already running
+        or the last one failed less than PRICE_CACHE_NEGATIVE_TTL_SECONDS ago.
+        """
+        if product_category in self._refreshing:
+            return
+        failed_at = self._failed_refreshes.get(product_category)
+        if failed_at is not None and time.time() - failed_at < self.negative_ttl:
+            return
+        self._refreshing.add(product_category)
+        task = _spawn(self.refresh(product_category, stale_entry))
+        task.add_done_callback(lambda _: self._refreshing.discard(product_category))
+
+    def metrics(self) -> Dict[str, float]:
+        """Hit/miss counters and hit ratio"""
+        return {**asdict(self.stats), "hit_ratio": self.stats.hit_ratio}
+
+
+def _spawn(coro: Awaitable[CachedPrice]) -> asyncio.Task:
+    """Runs a coroutine in a task that is kept referenced until it finishes"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def create_backend(kind: str = PRICE_CACHE_BACKEND) -> PriceCacheBackend:
+    """Creates the backend configured by PRICE_CACHE_BACKEND ("memory" or "sqlite")"""
+    if kind == "sqlite":
+        return SqlitePriceCacheBackend()
+    assert kind == "memory", f"Unknown price cache backend {kind}"
+    return MemoryPriceCacheBackend()
@@ -2,90 +2,204 @@
 Fetches prices from PriceAPI
 """
 import asyncio
+import logging
 import os
-import sys
-from typing import List
+import time
+from typing import Dict, List, Optional, Tuple
 
-import requests
-from async_lru import alru_cache
-import logging
-logging.basicConfig(level=logging.ERROR)
+import httpx
+
+from api.deadline import STALE_PRICE, DeadlineExceeded, bounded, record_fallback
+from api.metrics import registry, stage
+from api.price_cache import CachedPrice, PriceCache, create_backend
+
+# e.g. LOG_LEVEL=DEBUG to log PriceAPI results and whole spreadsheets
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "ERROR"))
 logger = logging.getLogger(__name__)
 
 
 headers = {"accept": "application/json", "content-type": "application/json"}
 params = {"token": os.environ["PRICE_API_TOKEN"]}
 
+# point this at a local stub (see __test__/priceapi_stub.py) for testing
+PRICE_API_URL = os.environ.get("PRICE_API_URL", "https://api.priceapi.com/v2")
+PRICE_API_DEADLINE = float(os.environ.get("PRICE_API_DEADLINE_SECONDS", "20"))
+PRICE_API_MAX_CONNECTIONS = int(os.environ.get("PRICE_API_MAX_CONNECTIONS", "10"))
+# time kept back from the request deadline for the fallbacks if PriceAPI is slow
+PRICE_FALLBACK_RESERVE = float(os.environ.get("PRICE_FALLBACK_RESERVE_SECONDS", "3"))
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 4.0
+
+PRICE_API_JOBS = registry.counter("priceapi_jobs_total", "PriceAPI jobs created")
+PRICE_API_POLLS = registry.counter("priceapi_polls_total", "PriceAPI job status polls")
+
 
 class PriceAPIException(Exception):
     """Custom exception for PriceAPI errors"""
 
 
+class PriceAPIClient:
+    """
+    Async PriceAPI client. Keeps a persistent connection pool, polls jobs
+    with exponential backoff up to an overall deadline, and coalesces
+    concurrent lookups of the same category into a single job.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        base_url: str = PRICE_API_URL,
+        deadline: float = PRICE_API_DEADLINE,
+        poll_delay: float = POLL_INITIAL_DELAY,
+        max_poll_delay: float = POLL_MAX_DELAY,
+        max_connections: int = PRICE_API_MAX_CONNECTIONS,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url
+        self.deadline = deadline
+        self.poll_delay = poll_delay
+        self.max_poll_delay = max_poll_delay
+        self.max_connections = max_connections
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled HTTP client, created on first use"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=headers,
+                params=params,
+                timeout=5,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def aclose(self):
+        """Closes the connection pool"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_prices(self, product_category: str) -> List[float]:
+        """
+        Returns a list of prices for a product category. Concurrent calls
+        for the same category share the same PriceAPI job.
+        """
+        future = self._in_flight.get(product_category)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_prices(product_category))
+            self._in_flight[product_category] = future
+            future.add_done_callback(
+                lambda _: self._in_flight.pop(product_category, None)
+            )
+        # shielded so one caller giving up doesn't cancel the job for the others
+        return await asyncio.shield(future)
+
+    async def _fetch_prices(self, product_category: str) -> List[float]:
+        with stage("priceapi"):
+            return await self._run_job(product_category)
+
+    async def _run_job(self, product_category: str) -> List[float]:
+        payload = {
+            "source": "amazon",
+            "country": "ca",
+            "topic": "search_results",
+            "key": "term",
+            "values": product_category,
+            "max_pages": "1",
+            "max_age": "1440",
+            "timeout": "5",
+        }
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+
+        response = await self.client.post("/jobs", json=payload)
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        PRICE_API_JOBS.inc()
+
+        delay = self.poll_delay
+        while True:
+            response = await self.client.get(f"/jobs/{job_id}")
+            PRICE_API_POLLS.inc()
+            response.raise_for_status()
+            status = response.json()["status"]
+            if status == "finished":
+                break
+            if status in ("cancelled", "failed"):
+                raise PriceAPIException(
+                    f"An error occurred, the job was {status} by PriceAPI"
+                )
+            if loop.time() + delay > deadline:
+                raise PriceAPIException(
+                    f"PriceAPI job {job_id} didn't finish within {self.deadline}s"
+                )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_delay)
+
+        response = await self.client.get(f"/jobs/{job_id}/download.json")
+        response.raise_for_status()
+        search_results = response.json()["results"][0]["content"]["search_results"]
+        logger.debug("results: %s", search_results)
+        nested_prices = [[r["min_price"], r["max_price"]] for r in search_results]
+        filtered_prices = [[float(p) for p in arr if p] for arr in nested_prices] # filter out None values
+        avg_prices = [sum(arr) / len(arr) for arr in filtered_prices if arr]
+        return avg_prices
+
+
+price_api = PriceAPIClient()
+
+
 async def get_prices(product_category: str) -> List[float]:
     """Returns a list of price for a product, fetched from PriceAPI"""
-    payload = {
-        "source": "amazon",
-        "country": "ca",
-        "topic": "search_results",
-        "key": "term",
-        "values": product_category,
-        "max_pages": "1",
-        "max_age": "1440",
-        "timeout": "5",
-    }
-    loop = asyncio.get_event_loop()
-
-    def create_job():
-        return requests.post(
-            "https://api.priceapi.com/v2/jobs",
-            headers=headers,
-            json=payload,
-            params=params,
-            timeout=5,
-        )
-
-    response = await loop.run_in_executor(None, create_job)
-    job = response.json()
-    job_id = job["job_id"]
-
-    def get_job_status():
-        return requests.get(
-            f"https://api.priceapi.com/v2/jobs/{job_id}", params=params, timeout=5
-        )
-
-    response = await loop.run_in_executor(None, get_job_status)
-    while response.json()["status"] != "finished":
-        if response.json()["status"] == "cancelled":
-            raise PriceAPIException(
-                "An error occurred, the job was cancelled by PriceAPI"
-            )
-        await asyncio.sleep(1)
-        response = await loop.run_in_executor(None, get_job_status)
-
-    def get_job_results():
-        return requests.get(
-            f"https://api.priceapi.com/v2/jobs/{job_id}/download.json",
-            params=params,
-            timeout=5,
-        )
-
-    response = await loop.run_in_executor(None, get_job_results)
-    search_results = response.json()["results"][0]["content"]["search_results"]
-    print('results: ', search_results, file=sys.stderr)
-    nested_prices = [[r["min_price"], r["max_price"]] for r in search_results]
-    filtered_prices = [[float(p) for p in arr if p] for arr in nested_prices] # filter out None values
-    avg_prices = [sum(arr) / len(arr) for arr in filtered_prices if arr]
-    return avg_prices
-
-
-@alru_cache(maxsize=200)
+    return await price_api.get_prices(product_category)
+
+
+price_cache = PriceCache(create_backend(), get_prices)
+registry.gauges("price_cache", price_cache.metrics)
+
+
 async def get_average_price(product_category: str) -> float:
-    """Returns the average price for a product, fetched from PriceAPI"""
-    try:
-        prices = await get_prices(product_category)
-        assert len(prices) > 0, f"No prices found for category {product_category}"
-    except Exception as e:
-        logger.exception(e)
-        print(f'failed to fetch prices for {product_category}:', e, file=sys.stderr)
-        return 0
-    return sum(prices) / len(prices)
+    """
+    Returns the average price for a product, fetched from PriceAPI and
+    cached (see api.price_cache). Returns 0 if no price could be fetched.
+    """
+    return (await get_price_entry(product_category)).price
+
+
+async def get_price_entry(product_category: str) -> CachedPrice:
+    """
+    Looks up the cached price of a category, giving up PRICE_FALLBACK_RESERVE
+    seconds before the request's deadline. If the lookup fails or runs out
+    of time, falls back to the last price fetched for the category, however
+    old, or else to a failed entry (price 0).
+    """
+    with stage("price"):
+        try:
+            entry = await bounded(price_cache.get_entry(product_category), reserve=PRICE_FALLBACK_RESERVE)
+        except DeadlineExceeded:
+            entry = CachedPrice(price=0, fetched_at=time.time(), ok=False)
+        if entry.ok:
+            return entry
+        last_good = price_cache.last_good(product_category)
+        if last_good is not None:
+            record_fallback(STALE_PRICE)
+            return last_good
+        return entry
+
+
+async def get_price_distribution(product_category: str) -> Tuple[float, float]:
+    """
+    Returns the average price for a product and the standard deviation of
+    the prices it averages, from the same cache as `get_average_price`.
+    The spread is 0 if no price could be fetched.
+    """
+    entry = await get_price_entry(product_category)
+    return entry.price, entry.spread
@@ -0,0 +1,435 @@
+"""
+Set-based data access for forecasts. Each loader fetches everything a
+forecast needs for all enabled retailers and years in a single query, so
+the number of round trips no longer grows with the size of the sheet.
+"""
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from prisma import Prisma
+from prisma.models import ProductRetailerYear, Retailer, RetailerYear
+
+from api.deadline import deadline_bounded
+from api.metrics import timed_query
+
+# when disabled, comparable rows are fetched once and averaged in python
+AGGREGATE_IN_SQL = os.environ.get("COMPARABLES_AGGREGATE_IN_SQL", "1") != "0"
+# when enabled, windows are answered from VolumeBucket where possible
+AGGREGATE_FROM_BUCKETS = os.environ.get("COMPARABLES_FROM_BUCKETS", "1") != "0"
+# VolumeBucket bin widths; changing them needs a rebuild_volume_buckets
+PRICE_BIN_WIDTH = 1.0
+MARGIN_BIN_WIDTH = 0.05
+
+
+@dataclass(frozen=True)
+class ComparableWindow:
+    """
+    The contribution margin / list price window used to find comparable
+    historical products for one retailer in one year.
+    """
+
+    retailer_id: int
+    year: int
+    min_margin: float
+    max_margin: float
+    min_price: float
+    max_price: float
+
+    def contains(self, row: ProductRetailerYear) -> bool:
+        """Whether a historical row falls inside this window"""
+        return (
+            row.retailer_id == self.retailer_id
+            and row.year == self.year
+            and self.min_margin <= row.contribution_margin <= self.max_margin
+            and self.min_price <= row.list_price <= self.max_price
+        )
+
+
+def _placeholders(count: int) -> str:
+    return ", ".join("?" for _ in range(count))
+
+
+@timed_query
+@deadline_bounded
+async def fetch_retailers(db: Prisma, names: Sequence[str]) -> List[Retailer]:
+    """Returns the retailers with the given names"""
+    return await db.retailer.find_many(where={"name": {"in": list(names)}})
+
+
+@timed_query
+@deadline_bounded
+async def fetch_agreements(
+    db: Prisma, retailer_ids: Sequence[int], num_years: int
+) -> Dict[Tuple[int, int], RetailerYear]:
+    """
+    Returns every retailer agreement for the given retailers in years
+    1..num_years, keyed by (retailer_id, year).
+    """
+    if not retailer_ids:
+        return {}
+    agreements = await db.query_raw(
+        f"""
+        SELECT *
+        FROM RetailerYear
+        WHERE retailer_id IN ({_placeholders(len(retailer_ids))})
+        AND year BETWEEN 1 AND ?
+        """,
+        *retailer_ids,
+        num_years,
+        model=RetailerYear,
+    )
+    return {(a.retailer_id, a.year): a for a in agreements}
+
+
+@timed_query
+@deadline_bounded
+async def fetch_comparables(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    retailer_ids: Sequence[int],
+    num_years: int,
+) -> List[ProductRetailerYear]:
+    """
+    Returns every historical product row of the given brand and category
+    sold at the given retailers in years 1..num_years.
+    """
+    if not retailer_ids:
+        return []
+    return await db.query_raw(
+        f"""
+        SELECT ProductRetailerYear.*
+        FROM ProductRetailerYear
+        JOIN Product ON Product.id = ProductRetailerYear.product_id
+        WHERE retailer_id IN ({_placeholders(len(retailer_ids))})
+        AND year BETWEEN 1 AND ?
+        AND Product.brand_name = ?
+        AND Product.category = ?
+        """,
+        *retailer_ids,
+        num_years,
+        product_brand,
+        product_category,
+        model=ProductRetailerYear,
+    )
+
+
+def average_volumes(
+    rows: Iterable[ProductRetailerYear], windows: Sequence[ComparableWindow]
+) -> Dict[Tuple[int, int], float]:
+    """
+    Averages volume_sold of the rows inside each window, keyed by
+    (retailer_id, year). Windows without any comparable rows get 0.
+    """
+    by_key: Dict[Tuple[int, int], List[ProductRetailerYear]] = {}
+    for row in rows:
+        by_key.setdefault((row.retailer_id, row.year), []).append(row)
+    volumes = {}
+    for window in windows:
+        key = (window.retailer_id, window.year)
+        matches = [r.volume_sold for r in by_key.get(key, []) if window.contains(r)]
+        volumes[key] = sum(matches) / len(matches) if matches else 0
+    return volumes
+
+
+async def fetch_average_volumes(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    windows: Sequence[ComparableWindow],
+) -> Dict[Tuple[int, int], float]:
+    """
+    Returns the average volume_sold of comparable products inside each
+    window, keyed by (retailer_id, year). Windows are answered from the
+    precomputed VolumeBucket sums, and only those that cut through a
+    bucket fall back to the raw rows.
+    """
+    if not windows:
+        return {}
+    if not AGGREGATE_FROM_BUCKETS:
+        return await fetch_row_average_volumes(db, product_brand, product_category, windows)
+    volumes, cut = await fetch_bucket_average_volumes(
+        db, product_brand, product_category, windows
+    )
+    if cut:
+        volumes.update(
+            await fetch_row_average_volumes(db, product_brand, product_category, cut)
+        )
+    return volumes
+
+
+async def fetch_row_average_volumes(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    windows: Sequence[ComparableWindow],
+) -> Dict[Tuple[int, int], float]:
+    """
+    Returns the average volume_sold of comparable products inside each
+    window, keyed by (retailer_id, year), from the raw rows in a single query.
+    """
+    if not windows:
+        return {}
+    if not AGGREGATE_IN_SQL:
+        retailer_ids = sorted({w.retailer_id for w in windows})
+        num_years = max(w.year for w in windows)
+        rows = await fetch_comparables(
+            db, product_brand, product_category, retailer_ids, num_years
+        )
+        return average_volumes(rows, windows)
+    return await fetch_window_average_volumes(db, product_brand, product_category, windows)
+
+
+@timed_query
+@deadline_bounded
+async def fetch_window_average_volumes(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    windows: Sequence[ComparableWindow],
+) -> Dict[Tuple[int, int], float]:
+    """
+    Averages volume_sold of the raw rows inside each window in MySQL.
+    """
+    # the windows are sent as a derived table, so MySQL can join and
+    # aggregate every (retailer, year) pair in one pass
+    window_table = " UNION ALL ".join(
+        "SELECT ? AS retailer_id, ? AS year, ? AS min_margin, "
+        "? AS max_margin, ? AS min_price, ? AS max_price"
+        for _ in windows
+    )
+    args = [
+        value
+        for w in windows
+        for value in (
+            w.retailer_id,
+            w.year,
+            w.min_margin,
+            w.max_margin,
+            w.min_price,
+            w.max_price,
+        )
+    ]
+    results = await db.query_raw(
+        f"""
+        SELECT w.retailer_id, w.year, AVG(ProductRetailerYear.volume_sold) AS volume
+        FROM ({window_table}) AS w
+        JOIN ProductRetailerYear
+            ON ProductRetailerYear.retailer_id = w.retailer_id
+            AND ProductRetailerYear.year = w.year
+            AND ProductRetailerYear.contribution_margin BETWEEN w.min_margin AND w.max_margin
+            AND ProductRetailerYear.list_price BETWEEN w.min_price AND w.max_price
+        JOIN Product ON Product.id = ProductRetailerYear.product_id
+        WHERE Product.brand_name = ?
+        AND Product.category = ?
+        GROUP BY w.retailer_id, w.year
+        """,
+        *args,
+        product_brand,
+        product_category,
+    )
+    volumes: Dict[Tuple[int, int], float] = {
+        (w.retailer_id, w.year): 0 for w in windows
+    }
+    for result in results:
+        key = (int(result["retailer_id"]), int(result["year"]))
+        volumes[key] = float(result["volume"] or 0)
+    return volumes
+
+
+@timed_query
+@deadline_bounded
+async def fetch_bucket_average_volumes(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    windows: Sequence[ComparableWindow],
+) -> Tuple[Dict[Tuple[int, int], float], List[ComparableWindow]]:
+    """
+    Averages volume_sold inside each window from the VolumeBucket sums.
+    Returns the averages, keyed by (retailer_id, year), of the windows
+    that every bucket is either fully inside or fully outside of, and the
+    windows that cut through a bucket (all of them if VolumeBucket hasn't
+    been rebuilt since the data last changed).
+    """
+    retailer_ids = sorted({w.retailer_id for w in windows})
+    buckets = await db.query_raw(
+        f"""
+        SELECT DataVersion.aggregated_version = DataVersion.version AS current, VolumeBucket.*
+        FROM DataVersion
+        LEFT JOIN VolumeBucket
+            ON DataVersion.aggregated_version = DataVersion.version
+            AND VolumeBucket.brand_name = ?
+            AND VolumeBucket.category = ?
+            AND VolumeBucket.retailer_id IN ({_placeholders(len(retailer_ids))})
+            AND VolumeBucket.year BETWEEN 1 AND ?
+        WHERE DataVersion.id = 1
+        """,
+        product_brand,
+        product_category,
+        *retailer_ids,
+        max(w.year for w in windows),
+    )
+    if not buckets or not int(buckets[0]["current"]):
+        return {}, list(windows)
+
+    by_key: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+    for bucket in buckets:
+        if bucket["retailer_id"] is not None:
+            by_key.setdefault((int(bucket["retailer_id"]), int(bucket["year"])), []).append(bucket)
+    volumes: Dict[Tuple[int, int], float] = {}
+    cut: List[ComparableWindow] = []
+    for window in windows:
+        key = (window.retailer_id, window.year)
+        count, total = 0, 0.0
+        for bucket in by_key.get(key, []):
+            if (
+                bucket["max_price"] < window.min_price
+                or bucket["min_price"] > window.max_price
+                or bucket["max_margin"] < window.min_margin
+                or bucket["min_margin"] > window.max_margin
+            ):
+                continue
+            if not (
+                window.min_price <= bucket["min_price"]
+                and bucket["max_price"] <= window.max_price
+                and window.min_margin <= bucket["min_margin"]
+                and bucket["max_margin"] <= window.max_margin
+            ):
+                cut.append(window)
+                break
+            count += int(bucket["row_count"])
+            total += float(bucket["sum_volume"])
+        else:
+            volumes[key] = total / count if count else 0
+    return volumes, cut
+
+
+@timed_query
+@deadline_bounded
+async def rebuild_volume_buckets(db: Prisma) -> None:
+    """
+    Recomputes VolumeBucket from the raw rows and marks it current for
+    the data version, in one transaction. Call it after every change to
+    ProductRetailerYear or Product, once the data version has been bumped.
+    """
+    async with db.batch_() as batcher:
+        batcher.execute_raw("DELETE FROM VolumeBucket")
+        batcher.execute_raw(
+            """
+            INSERT INTO VolumeBucket (
+                brand_name, category, retailer_id, year, price_bin, margin_bin,
+                row_count, sum_volume, sum_volume_sq,
+                min_price, max_price, min_margin, max_margin
+            )
+            SELECT
+                Product.brand_name AS bucket_brand_name,
+                Product.category AS bucket_category,
+                ProductRetailerYear.retailer_id AS bucket_retailer_id,
+                ProductRetailerYear.year AS bucket_year,
+                FLOOR(ProductRetailerYear.list_price / ?) AS bucket_price_bin,
+                FLOOR(ProductRetailerYear.contribution_margin / ?) AS bucket_margin_bin,
+                COUNT(*),
+                SUM(ProductRetailerYear.volume_sold),
+                SUM(ProductRetailerYear.volume_sold * ProductRetailerYear.volume_sold),
+                MIN(ProductRetailerYear.list_price),
+                MAX(ProductRetailerYear.list_price),
+                MIN(ProductRetailerYear.contribution_margin),
+                MAX(ProductRetailerYear.contribution_margin)
+            FROM ProductRetailerYear
+            JOIN Product ON Product.id = ProductRetailerYear.product_id
+            GROUP BY
+                bucket_brand_name, bucket_category, bucket_retailer_id,
+                bucket_year, bucket_price_bin, bucket_margin_bin
+            """,
+            PRICE_BIN_WIDTH,
+            MARGIN_BIN_WIDTH,
+        )
+        batcher.execute_raw("UPDATE DataVersion SET aggregated_version = version WHERE id = 1")
+
+
+@timed_query
+@deadline_bounded
+async def fetch_category_list_prices(
+    db: Prisma, product_category: str, retailer_ids: Sequence[int], num_years: int
+) -> Tuple[Dict[Tuple[int, int], float], Optional[float]]:
+    """
+    Returns the average historical list price of every brand in a category
+    at each retailer and year, keyed by (retailer_id, year), and over all
+    retailers and years (None if the category has no history).
+    """
+    if not retailer_ids:
+        return {}, None
+    results = await db.query_raw(
+        f"""
+        SELECT
+            ProductRetailerYear.retailer_id,
+            ProductRetailerYear.year,
+            COUNT(*) AS row_count,
+            AVG(ProductRetailerYear.list_price) AS average_price
+        FROM ProductRetailerYear
+        JOIN Product ON Product.id = ProductRetailerYear.product_id
+        WHERE Product.category = ?
+        AND retailer_id IN ({_placeholders(len(retailer_ids))})
+        AND year BETWEEN 1 AND ?
+        GROUP BY ProductRetailerYear.retailer_id, ProductRetailerYear.year
+        """,
+        product_category,
+        *retailer_ids,
+        num_years,
+    )
+    prices = {(int(r["retailer_id"]), int(r["year"])): float(r["average_price"]) for r in results}
+    rows = sum(int(r["row_count"]) for r in results)
+    overall = sum(float(r["average_price"]) * int(r["row_count"]) for r in results) / rows if rows else None
+    return prices, overall
+
+
+@timed_query
+@deadline_bounded
+async def fetch_data_version(db: Prisma) -> int:
+    """
+    Returns the current version of the historical data, which is bumped
+    every time it is (re)loaded.
+    """
+    results = await db.query_raw("SELECT version FROM DataVersion WHERE id = 1")
+    return int(results[0]["version"]) if results else 0
+
+
+@timed_query
+@deadline_bounded
+async def fetch_product_rows(db: Prisma) -> List[Dict[str, Any]]:
+    """
+    Returns every historical product row joined with its product's
+    brand and category.
+    """
+    return await db.query_raw(
+        """
+        SELECT
+            Product.brand_name,
+            Product.category,
+            ProductRetailerYear.retailer_id,
+            ProductRetailerYear.year,
+            ProductRetailerYear.contribution_margin,
+            ProductRetailerYear.list_price,
+            ProductRetailerYear.volume_sold
+        FROM ProductRetailerYear
+        JOIN Product ON Product.id = ProductRetailerYear.product_id
+        """
+    )
+
+
+@timed_query
+@deadline_bounded
+async def fetch_categories(db: Prisma) -> List[str]:
+    """Returns every distinct product category in the catalogue"""
+    results = await db.query_raw("SELECT DISTINCT category FROM Product")
+    return [r["category"] for r in results]
+
+
+@timed_query
+@deadline_bounded
+async def fetch_all_agreements(db: Prisma) -> Dict[Tuple[int, int], RetailerYear]:
+    """Returns every retailer agreement, keyed by (retailer_id, year)"""
+    agreements = await db.query_raw("SELECT * FROM RetailerYear", model=RetailerYear)
+    return {(a.retailer_id, a.year): a for a in agreements}
@@ -0,0 +1,184 @@
+"""
+Cache of computed results, for whole spreadsheets and the stages that
+build them (see `api.calc`). Google Sheets recalculates custom functions
+often and sends byte-identical requests, so results are cached under a
+canonical form of their inputs and stamped with the data version they
+were computed from; bumping the version (see scripts/seed.py)
+invalidates every entry. A result that read in-memory data at any other
+version (see `api.versions.record_read`) isn't cached. Concurrent
+identical requests share one computation, and each of them reports the
+fallbacks it used. Each request's lookups are reported by cache name
+(see `cache_report`), so a response can say which stages it reused.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Optional, Tuple
+
+from api.deadline import record_fallback, start_fallbacks
+from api.versions import data_version, record_read, start_reads
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+# bounds how stale the market price baked into a cached sheet can get
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL_SECONDS", "300"))
+FLOAT_DIGITS = 9
+
+_report: ContextVar[Optional[Dict[str, str]]] = ContextVar("cache_report", default=None)
+
+
+def start_cache_report() -> None:
+    """Starts recording the cache lookups of the current request"""
+    _report.set({})
+
+
+def cache_report() -> Dict[str, str]:
+    """
+    How each cache was first looked up during the current request, by
+    cache name: "hit", "coalesced" (joined a computation in flight) or
+    "miss". Caches that weren't looked up are left out.
+    """
+    return dict(_report.get() or {})
+
+
+def _record(name: str, outcome: str) -> None:
+    report = _report.get()
+    if report is not None:
+        report.setdefault(name, outcome)
+
+
+def canonicalize(value: Any) -> Any:
+    """
+    Normalizes forecast inputs so equivalent requests compare equal:
+    mappings are ordered by key, tuples become lists and floats are
+    rounded to FLOAT_DIGITS decimals.
+    """
+    if isinstance(value, dict):
+        return {str(k): canonicalize(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(v) for v in value]
+    if isinstance(value, float):
+        return round(value, FLOAT_DIGITS)
+    return value
+
+
+def cache_key(kwargs: Dict[str, Any]) -> str:
+    """The canonical form of a forecast's keyword arguments, as a string"""
+    return json.dumps(canonicalize(kwargs), sort_keys=True)
+
+
+@dataclass
+class ResultCacheStats:
+    """Hit/miss counters of a result cache"""
+
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        """Fraction of lookups that didn't start a computation"""
+        served = self.hits + self.coalesced
+        return served / (served + self.misses) if served + self.misses else 0.0
+
+
+class ResultCache:
+    """
+    LRU cache of `compute(**kwargs)` results, keyed by `cache_key(kwargs)`
+    and the data version. Failed computations, degraded ones that used a
+    fallback (see api.deadline), and ones that read data at another
+    version, e.g. a snapshot that hasn't been reloaded yet, are not cached.
+    """
+
+    def __init__(
+        self,
+        compute: Callable[..., Awaitable[Any]],
+        name: str = "sheet",
+        size: int = RESULT_CACHE_SIZE,
+        ttl: float = RESULT_CACHE_TTL,
+    ):
+        self.compute = compute
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.stats = ResultCacheStats()
+        # (data version, key) -> (computed_at, result)
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[float, Any]]" = OrderedDict()
+        # in flight: (data version, key) -> (result, versions it read, fallbacks it used)
+        self._in_flight: Dict[Tuple[int, str], asyncio.Future] = {}
+        self._version: Optional[int] = None
+
+    async def data_version(self) -> int:
+        """The current data version (see api.versions), dropping every entry when it changes"""
+        version = await data_version.current()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        return version
+
+    async def get(self, **kwargs) -> Any:
+        """Returns the cached result for these arguments, computing it on a miss"""
+        _, result = await self._lookup(kwargs, compute=True)
+        return result
+
+    async def get_existing(self, **kwargs) -> Tuple[bool, Any]:
+        """
+        Returns (True, result) if the result for these arguments is cached
+        or already being computed, or (False, None) rather than computing it.
+        """
+        return await self._lookup(kwargs, compute=False)
+
+    async def _lookup(self, kwargs: Dict[str, Any], compute: bool) -> Tuple[bool, Any]:
+        key = (await self.data_version(), cache_key(kwargs))
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] < self.ttl:
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            _record(self.name, "hit")
+            record_read(key[0])
+            return True, entry[1]
+
+        future = self._in_flight.get(key)
+        leader = future is None
+        if not leader:
+            self.stats.coalesced += 1
+            _record(self.name, "coalesced")
+        elif not compute:
+            return False, None
+        else:
+            self.stats.misses += 1
+            _record(self.name, "miss")
+            future = asyncio.ensure_future(self._compute(key, kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shielded so one caller giving up doesn't cancel it for the others
+        result, reads, used = await asyncio.shield(future)
+        # a stage's reads and fallbacks are also those of the stages and sheets that use it
+        record_read(*reads)
+        for name in used:
+            # counted once, by the computation that used it, and again for each request that joined it
+            record_fallback(name, count=not leader)
+        return True, result
+
+    async def _compute(
+        self, key: Tuple[int, str], kwargs: Dict[str, Any]
+    ) -> Tuple[Any, FrozenSet[int], Tuple[str, ...]]:
+        # runs in its own task, so these reads and fallbacks are only this computation's
+        reads = start_reads()
+        used = start_fallbacks()
+        result = await self.compute(**kwargs)
+        if self.size > 0 and key[0] == self._version and reads <= {key[0]} and not used:
+            self._entries[key] = (time.time(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+        return result, frozenset(reads), tuple(used)
+
+    def metrics(self) -> Dict[str, float]:
+        """Hit/miss counters, hit ratio and size"""
+        return {**asdict(self.stats), "hit_ratio": self.stats.hit_ratio, "entries": len(self._entries)}
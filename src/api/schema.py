@@ -0,0 +1,211 @@
+"""
+Request schemas. Forecast specs are validated with pydantic (the version
+prisma depends on) before anything is computed, so a missing or mistyped
+field is reported as a 400 that names the field, instead of a KeyError
+or TypeError surfacing as a 500.
+"""
+import json
+import os
+import zlib
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type, TypeVar, Union
+
+from pydantic import (
+    BaseModel,
+    Extra,
+    StrictBool,
+    StrictStr,
+    ValidationError,
+    confloat,
+    conint,
+    conlist,
+    root_validator,
+    validator,
+)
+
+M = TypeVar("M", bound=BaseModel)
+
+# the defaults of the optional ranges in script.gs, i.e. every product
+DEFAULT_RANGE = 999999999
+# bounds the size of decompressed request bodies, e.g. of a zip bomb
+MAX_REQUEST_BYTES = int(os.environ.get("MAX_REQUEST_BYTES", str(1024 * 1024)))
+# bounds the scenarios of a sweep, and so the values of each of its axes
+MAX_SWEEP_SCENARIOS = int(os.environ.get("MAX_SWEEP_SCENARIOS", "10000"))
+
+FiniteFloat = confloat(allow_inf_nan=False)
+Price = confloat(gt=0, allow_inf_nan=False)
+# [retailer name, enabled, list price or "" to derive it from the market price]
+RetailerRow = Tuple[StrictStr, Union[StrictBool, Literal[""]], Union[Price, Literal[""]]]  # type: ignore
+
+
+class AxisRange(BaseModel):
+    """
+    A sweep axis given as a range from start to stop, inclusive, either
+    every `step` or in `num` evenly spaced values
+    """
+
+    start: FiniteFloat  # type: ignore
+    stop: FiniteFloat  # type: ignore
+    step: Optional[confloat(gt=0, allow_inf_nan=False)] = None  # type: ignore
+    num: Optional[conint(strict=True, gt=0)] = None  # type: ignore
+
+    class Config:  # pylint: disable=too-few-public-methods
+        extra = Extra.forbid
+
+    @root_validator(skip_on_failure=True)
+    def check_length(cls, values):  # pylint: disable=no-self-argument
+        """Rejects ranges that run backwards or expand to too many values"""
+        start, stop, step, num = values["start"], values["stop"], values["step"], values["num"]
+        if stop < start:
+            raise ValueError("stop must be at least start")
+        if (step is None) == (num is None):
+            raise ValueError("give either step or num")
+        # checked before expanding, so a tiny step can't exhaust memory
+        if (num or 0) > MAX_SWEEP_SCENARIOS or (step and (stop - start) / step >= MAX_SWEEP_SCENARIOS):
+            raise ValueError(f"a range can have at most {MAX_SWEEP_SCENARIOS} values")
+        return values
+
+
+# a value, a non-empty list of values, or a range
+RANGE_FIELDS = set(AxisRange.__fields__)
+
+Axis = Union[FiniteFloat, conlist(FiniteFloat, min_items=1), AxisRange]  # type: ignore
+# a list price for every retailer, none ("" or null) to use the base prices, or one per retailer
+ListPricePoint = Union[Price, Literal[""], None, Dict[StrictStr, Union[Price, Literal[""], None]]]  # type: ignore
+
+
+class InvalidRequest(AssertionError):
+    """A request that doesn't match its schema; `errors` has one entry per field"""
+
+    def __init__(self, errors: List[Dict[str, str]]):
+        super().__init__(
+            "Invalid request: " + "; ".join(f"{e['field']}: {e['message']}" for e in errors)
+        )
+        self.errors = errors
+
+
+class ProductSpec(BaseModel):
+    """Fields shared by every kind of forecast request"""
+
+    product_category: StrictStr
+    product_brand: StrictStr
+    retailers_mapping: List[RetailerRow]
+    num_years: conint(strict=True)  # type: ignore
+    relevant_contribution_margin_range: FiniteFloat = DEFAULT_RANGE  # type: ignore
+    relevant_list_price_range: FiniteFloat = DEFAULT_RANGE  # type: ignore
+
+
+class ForecastSpec(ProductSpec):
+    """A forecast, as sent by FORECAST_SALES"""
+
+    variable_cost: FiniteFloat  # type: ignore
+    desired_irr: FiniteFloat  # type: ignore
+    inital_investment: FiniteFloat  # type: ignore
+    nearest_comparables: conint(strict=True, ge=0) = 0  # type: ignore
+
+
+class SimulationSpec(ForecastSpec):
+    """A Monte Carlo forecast, as sent by FORECAST_SIMULATION"""
+
+    trials: Optional[conint(strict=True)] = None  # type: ignore
+    time_budget_seconds: Optional[FiniteFloat] = None  # type: ignore
+    sample_prices: bool = False
+    seed: Optional[conint(strict=True)] = None  # type: ignore
+
+
+class SweepSpec(ProductSpec):
+    """A grid of scenarios, as sent by FORECAST_SWEEP"""
+
+    variable_cost: Axis
+    desired_irr: Axis
+    inital_investment: Axis
+    # points, or a range (see api.sweep.list_price_matrices)
+    list_price: Union[AxisRange, conlist(ListPricePoint, min_items=1), ListPricePoint] = None  # type: ignore
+
+    @validator("list_price", pre=True)
+    def parse_list_price_range(cls, value):  # pylint: disable=no-self-argument
+        """A map with any of the range's fields is a range of list prices, not retailers' prices"""
+        if isinstance(value, list) and not value:
+            raise ValueError("give at least one list price")
+        if isinstance(value, dict) and RANGE_FIELDS & value.keys():
+            try:
+                return AxisRange.parse_obj(value)
+            except ValidationError as e:
+                raise ValueError(
+                    "; ".join(
+                        f"{error['field']}: {error['message']}" if error["field"] else error["message"]
+                        for error in field_errors(e)
+                    )
+                ) from e
+        return value
+
+
+def validate(model: Type[M], data: Any) -> M:
+    """Validates parsed JSON against a schema, raising InvalidRequest if it doesn't match"""
+    if not isinstance(data, dict):
+        raise InvalidRequest([{"field": "request", "message": "must be a JSON object"}])
+    try:
+        return model.parse_obj(data)
+    except ValidationError as e:
+        raise InvalidRequest(field_errors(e)) from e
+
+
+def field_errors(error: ValidationError) -> List[Dict[str, str]]:
+    """One error per field, whose message lists every way it didn't match"""
+    # a field of a union type gets an error per type it didn't match
+    messages: Dict[str, List[str]] = {}
+    for e in error.errors():
+        field = ".".join(str(part) for part in e["loc"] if part != "__root__")
+        messages.setdefault(field, []).append(e["msg"])
+    return [{"field": field, "message": " or ".join(msgs)} for field, msgs in messages.items()]
+
+
+def parse_json(body: Optional[Union[str, bytes]]) -> Any:
+    """Parses a request's JSON, raising InvalidRequest if there is none or it isn't valid"""
+    if not body:
+        raise InvalidRequest([{"field": "request", "message": "No data provided"}])
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise InvalidRequest([{"field": "request", "message": f"isn't valid JSON ({e})"}]) from e
+
+
+def decode_body(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Decompresses a request body sent with Content-Encoding gzip or
+    deflate, up to MAX_REQUEST_BYTES.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        decoded = body
+    elif encoding in ("gzip", "x-gzip", "deflate"):
+        # gzip, or zlib-wrapped deflate; raw deflate is retried below
+        wbits = zlib.MAX_WBITS | 16 if "gzip" in encoding else zlib.MAX_WBITS
+        try:
+            decoded = _decompress(body, wbits)
+        except zlib.error as e:
+            if "gzip" in encoding:
+                raise InvalidRequest([{"field": "request", "message": f"isn't valid gzip ({e})"}]) from e
+            try:
+                decoded = _decompress(body, -zlib.MAX_WBITS)
+            except zlib.error as raw_error:
+                raise InvalidRequest(
+                    [{"field": "request", "message": f"isn't valid deflate ({raw_error})"}]
+                ) from raw_error
+    else:
+        raise InvalidRequest(
+            [{"field": "Content-Encoding", "message": f"{encoding} isn't supported, use gzip or deflate"}]
+        )
+    if len(decoded) > MAX_REQUEST_BYTES:
+        raise InvalidRequest(
+            [{"field": "request", "message": f"is larger than {MAX_REQUEST_BYTES} bytes"}]
+        )
+    return decoded
+
+
+def _decompress(body: bytes, wbits: int) -> bytes:
+    decompressor = zlib.decompressobj(wbits)
+    # one byte past the limit is enough to tell it was exceeded
+    decoded = decompressor.decompress(body, MAX_REQUEST_BYTES + 1)
+    if not decompressor.eof and len(decoded) <= MAX_REQUEST_BYTES:
+        raise zlib.error("truncated body")
+    return decoded
@@ -0,0 +1,258 @@
+"""
+Monte Carlo forecasts: the risk around a forecast's NPV and IRR. The
+historical data and market price are loaded once, as for a single
+forecast, and the trials (see api.montecarlo) run in blocks on a pool of
+worker processes. Whatever blocks finish within the time budget are
+summarized, so a simulation stays interactive from Google Sheets.
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import secrets
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import numpy as np
+from prisma import Prisma
+from prisma.models import Retailer
+
+from api.calc import base_list_prices, fixed_costs, load_retailers, retailer_year_matrix
+from api.db import database
+from api.engine import contribution_margins
+from api.metrics import registry, stage
+from api.montecarlo import Comparables, SimulationInputs, simulate_block, summarize
+from api.nearest import (
+    MAX_NEAREST_COMPARABLES,
+    NEAREST_MARGIN_SCALE,
+    NEAREST_PRICE_SCALE,
+    load_partitions,
+)
+from api.prices import get_price_distribution
+from api.sweep import load_comparable_columns
+
+SIMULATION_TRIALS = int(os.environ.get("SIMULATION_TRIALS", "2000"))
+MAX_SIMULATION_TRIALS = int(os.environ.get("MAX_SIMULATION_TRIALS", "100000"))
+SIMULATION_BLOCK_SIZE = int(os.environ.get("SIMULATION_BLOCK_SIZE", "500"))
+# Google Sheets gives up on a custom function after 30 seconds
+SIMULATION_TIME_BUDGET = float(os.environ.get("SIMULATION_TIME_BUDGET_SECONDS", "5"))
+MAX_SIMULATION_TIME_BUDGET = float(os.environ.get("MAX_SIMULATION_TIME_BUDGET_SECONDS", "25"))
+# API worker processes (see api.asgi), which share the cores with their simulation workers
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# worker processes per API worker; 0 runs blocks on threads of this process
+SIMULATION_WORKERS = int(
+    os.environ.get("SIMULATION_WORKERS", str(max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1)))
+)
+
+TRIALS_RUN = registry.counter("simulation_trials_total", "Monte Carlo trials run")
+TRUNCATED = registry.counter("simulation_truncated_total", "Simulations cut short by their time budget")
+
+
+class SimulationPool:
+    """
+    Process pool that runs blocks of trials, started on first use. Workers
+    are spawned rather than forked, since the API process runs threads.
+    """
+
+    def __init__(self, workers: int = SIMULATION_WORKERS):
+        self.workers = workers
+        self._executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> Optional[concurrent.futures.Executor]:
+        """The process pool, or None for the event loop's default thread pool"""
+        if self.workers <= 0:
+            return None
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def run(
+        self, inputs: SimulationInputs, trials: int, deadline: float, seed: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Runs `trials` trials in blocks and returns the (npv, irr) of every
+        block that finished by `deadline` (on the event loop's clock), in
+        order. The first block is always waited for. The others stop at the
+        deadline, whether they are still queued or already running.
+        """
+        loop = asyncio.get_running_loop()
+        sizes = [SIMULATION_BLOCK_SIZE] * (trials // SIMULATION_BLOCK_SIZE)
+        if trials % SIMULATION_BLOCK_SIZE:
+            sizes.append(trials % SIMULATION_BLOCK_SIZE)
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        # workers only share the wall clock with this process
+        stop_at = time.time() + (deadline - loop.time())
+        try:
+            futures = [
+                loop.run_in_executor(
+                    self.executor, simulate_block, inputs, block_seed, size, None if i == 0 else stop_at
+                )
+                for i, (block_seed, size) in enumerate(zip(seeds, sizes))
+            ]
+            try:
+                done, _ = await asyncio.wait(futures, timeout=max(deadline - loop.time(), 0))
+                # blocks that gave up at stop_at return None
+                blocks = [f.result() for f in futures if f in done and f.result() is not None]
+                if not blocks:
+                    blocks = [await futures[0]]
+            finally:
+                # blocks that haven't started yet are dropped, and running ones stop at stop_at
+                for future in futures:
+                    future.cancel()
+            return blocks
+        except BrokenProcessPool:
+            # a worker died, e.g. killed for running out of memory; start over next time
+            self._executor = None
+            raise
+
+    def shutdown(self) -> None:
+        """Stops the worker processes, without waiting for running blocks"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+simulation_pool = SimulationPool()
+
+
+# pylint: disable=too-many-arguments
+async def nearest_comparable_columns(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    retailers: List[Retailer],
+    num_years: int,
+    list_prices: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    k: int,
+) -> Dict[Tuple[int, int], Comparables]:
+    """
+    The columns of the k comparables nearest to the forecast's list price
+    at every retailer and year, keyed by (retailer_id, year).
+    """
+    assert 0 < k <= MAX_NEAREST_COMPARABLES, f"nearest_comparables must be between 1 and {MAX_NEAREST_COMPARABLES}"
+    partitions = await load_partitions(
+        db, product_brand, product_category, [r.id for r in retailers], num_years
+    )
+    columns = {}
+    for key, list_price in list_prices.items():
+        partition = partitions[key]
+        rows, _ = partition.nearest(
+            list_price,
+            float(contribution_margins(list_price, variable_cost)),
+            k,
+            NEAREST_PRICE_SCALE,
+            NEAREST_MARGIN_SCALE,
+        )
+        columns[key] = (
+            partition.list_price[rows],
+            partition.contribution_margin[rows],
+            partition.volume_sold[rows],
+        )
+    return columns
+
+
+# pylint: disable=too-many-locals disable=too-many-arguments
+async def calc_simulation(
+    product_category: str,
+    product_brand: str,
+    variable_cost: float,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+    desired_irr: float,
+    inital_investment: float,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+    nearest_comparables: int = 0,
+    trials: int = SIMULATION_TRIALS,
+    time_budget: float = SIMULATION_TIME_BUDGET,
+    sample_prices: bool = False,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Simulates a forecast `trials` times, sampling comparable volumes (and,
+    with sample_prices, the market price) in each trial, and returns the
+    distribution of NPV and IRR and the probability the project is viable.
+    Stops after `time_budget` seconds with the trials run so far. The same
+    seed and inputs give the same trials. With nearest_comparables=k,
+    volumes are drawn from the k comparables nearest to the forecast's
+    list prices (see api.nearest) instead of the relevant ranges.
+    """
+    assert 0 < trials <= MAX_SIMULATION_TRIALS, f"Simulations can run 1 to {MAX_SIMULATION_TRIALS} trials"
+    assert 0 < time_budget <= MAX_SIMULATION_TIME_BUDGET, f"Simulation time budgets can be at most {MAX_SIMULATION_TIME_BUDGET}s"
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + time_budget
+    started = time.perf_counter()
+    seed = secrets.randbits(32) if seed is None else int(seed)
+
+    async with database.session() as db:  # pylint: disable=invalid-name
+        with stage("load"):
+            retailers, agreements = await load_retailers(db, retailers_mapping, num_years)
+        with stage("prices"):
+            list_prices = await base_list_prices(
+                product_category, retailers, agreements, retailers_mapping, num_years
+            )
+        with stage("volumes"):
+            if nearest_comparables:
+                comparables = await nearest_comparable_columns(
+                    db, product_brand, product_category, retailers, num_years,
+                    list_prices, variable_cost, nearest_comparables,
+                )
+                # every trial draws from the same k comparables
+                relevant_contribution_margin_range = relevant_list_price_range = np.inf
+            else:
+                comparables = await load_comparable_columns(
+                    db, product_brand, product_category, retailers, num_years
+                )
+
+    def matrix(value) -> np.ndarray:
+        return retailer_year_matrix(retailers, num_years, value)
+
+    # the retailers whose list price follows the market price (see base_list_prices)
+    derived_price = np.array(
+        [
+            not (r.name in retailers_mapping and isinstance(retailers_mapping[r.name][1], float))
+            for r in retailers
+        ],
+        dtype=bool,
+    )
+    market_price, market_price_spread = 0.0, 0.0
+    if sample_prices and derived_price.any():
+        market_price, market_price_spread = await get_price_distribution(product_category)
+
+    inputs = SimulationInputs(
+        list_price=matrix(lambda r, y: list_prices[(r, y)]),
+        derived_price=derived_price,
+        retailer_markup=matrix(lambda r, y: agreements[(r, y)].retailer_markup),
+        fixed_costs=matrix(lambda r, y: fixed_costs(agreements[(r, y)])),
+        comparables=[comparables[(r.id, y)] for r in retailers for y in range(1, num_years + 1)],
+        variable_cost=float(variable_cost),
+        inital_investment=float(inital_investment),
+        desired_irr=float(desired_irr),
+        relevant_contribution_margin_range=relevant_contribution_margin_range,
+        relevant_list_price_range=relevant_list_price_range,
+        market_price=market_price,
+        market_price_spread=market_price_spread,
+    ).narrowed()
+
+    with stage("simulate"):
+        blocks = await simulation_pool.run(inputs, trials, deadline, seed)
+    npv = np.concatenate([block_npv for block_npv, _ in blocks])
+    irr = np.concatenate([block_irr for _, block_irr in blocks])
+    TRIALS_RUN.inc(len(npv))
+    if len(npv) < trials:
+        TRUNCATED.inc()
+
+    return {
+        "trials": len(npv),
+        "requested_trials": trials,
+        "truncated": len(npv) < trials,
+        "seed": seed,
+        "sampled_prices": inputs.samples_prices,
+        "elapsed_seconds": time.perf_counter() - started,
+        **summarize(npv, irr, float(desired_irr)),
+    }
@@ -0,0 +1,334 @@
+"""
+Optional in-memory columnar snapshot of ProductRetailerYear joined with
+Product. Rows are stored as NumPy arrays partitioned by
+(brand, category, retailer, year) and sorted, so comparable-product
+windows resolve with a binary search instead of a table scan, and the
+nearest comparables (see api.nearest) with a search outward from the
+query's list price.
+
+When the snapshot is reloaded, partitions whose rows didn't change are
+carried over from the previous snapshot, so only the partitions touched by
+an ingest are sorted and indexed again.
+"""
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from api.db import database
+from api.queries import ComparableWindow, fetch_data_version, fetch_product_rows
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.environ.get("PRODUCT_SNAPSHOT", "0") == "1"
+REFRESH_INTERVAL = float(os.environ.get("PRODUCT_SNAPSHOT_REFRESH_SECONDS", "60"))
+# reload even if the data version hasn't changed, in case data was edited by hand
+MAX_AGE = float(os.environ.get("PRODUCT_SNAPSHOT_MAX_AGE_SECONDS", "3600"))
+
+PartitionKey = Tuple[str, str, int, int]
+# list prices are compared on a log scale; this keeps a price of 0 finite
+MIN_LOG_PRICE = 1e-9
+
+
+def column_digest(*columns: np.ndarray) -> bytes:
+    """Hash of some columns' values, in order"""
+    digest = hashlib.blake2b(digest_size=16)
+    for column in columns:
+        digest.update(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+    return digest.digest()
+
+
+@dataclass
+class Partition:
+    """
+    Historical rows for one (brand, category, retailer, year), sorted by
+    list price, plus a permutation that sorts them by contribution margin.
+    `digest` identifies the rows the partition was built from.
+    """
+
+    list_price: np.ndarray
+    contribution_margin: np.ndarray
+    volume_sold: np.ndarray
+    margin_order: np.ndarray
+    sorted_margin: np.ndarray
+    digest: bytes = b""
+
+    @classmethod
+    def from_columns(
+        cls, list_price: np.ndarray, contribution_margin: np.ndarray, volume_sold: np.ndarray
+    ) -> "Partition":
+        """Builds a partition from unsorted columns"""
+        digest = column_digest(list_price, contribution_margin, volume_sold)
+        order = np.argsort(list_price, kind="stable")
+        contribution_margin = contribution_margin[order]
+        margin_order = np.argsort(contribution_margin, kind="stable")
+        return cls(
+            list_price=list_price[order],
+            contribution_margin=contribution_margin,
+            volume_sold=volume_sold[order],
+            margin_order=margin_order,
+            sorted_margin=contribution_margin[margin_order],
+            digest=digest,
+        )
+
+    def window_volumes(self, window: ComparableWindow) -> np.ndarray:
+        """
+        Returns volume_sold of every row inside the window. Whichever of
+        the price and margin ranges is narrower is resolved by binary
+        search, and the other is checked on that slice only.
+        """
+        lo = np.searchsorted(self.list_price, window.min_price, side="left")
+        hi = np.searchsorted(self.list_price, window.max_price, side="right")
+        margin_lo = np.searchsorted(self.sorted_margin, window.min_margin, side="left")
+        margin_hi = np.searchsorted(self.sorted_margin, window.max_margin, side="right")
+        if hi - lo <= margin_hi - margin_lo:
+            margins = self.contribution_margin[lo:hi]
+            mask = (margins >= window.min_margin) & (margins <= window.max_margin)
+            return self.volume_sold[lo:hi][mask]
+        rows = self.margin_order[margin_lo:margin_hi]
+        prices = self.list_price[rows]
+        mask = (prices >= window.min_price) & (prices <= window.max_price)
+        return self.volume_sold[rows[mask]]
+
+    @functools.cached_property
+    def log_price(self) -> np.ndarray:
+        """Log list prices, in which `nearest` measures price distances"""
+        return np.log(np.maximum(self.list_price, MIN_LOG_PRICE))
+
+    # pylint: disable=too-many-arguments
+    def nearest(
+        self,
+        list_price: float,
+        contribution_margin: float,
+        k: int,
+        price_scale: float,
+        margin_scale: float,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices and distances of the k rows closest to
+        (list_price, contribution_margin), nearest first, where distance is
+        the hypotenuse of the log price difference over `price_scale` and
+        the margin difference over `margin_scale`. Rows are sorted by
+        price, so the search starts at the query's price and widens until
+        no row outside the slice can be closer than the k-th inside it.
+        """
+        n = len(self.list_price)
+        k = min(k, n)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        x = np.log(max(list_price, MIN_LOG_PRICE))
+        position = int(np.searchsorted(self.log_price, x))
+        width = k
+        while True:
+            lo, hi = max(position - width, 0), min(position + width, n)
+            distances = np.hypot(
+                (self.log_price[lo:hi] - x) / price_scale,
+                (self.contribution_margin[lo:hi] - contribution_margin) / margin_scale,
+            )
+            if hi - lo >= k:
+                best = np.argpartition(distances, k - 1)[:k]
+                below = x - self.log_price[lo - 1] if lo > 0 else np.inf
+                above = self.log_price[hi] - x if hi < n else np.inf
+                if min(below, above) / price_scale >= distances[best].max():
+                    best = best[np.argsort(distances[best], kind="stable")]
+                    return lo + best, distances[best]
+            width *= 2
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by this partition's arrays"""
+        return (
+            self.list_price.nbytes
+            + self.contribution_margin.nbytes
+            + self.volume_sold.nbytes
+            + self.margin_order.nbytes
+            + self.sorted_margin.nbytes
+        )
+
+
+@dataclass
+class ProductSnapshot:
+    """
+    A point-in-time copy of the historical product data, at a given data version.
+    """
+
+    partitions: Dict[PartitionKey, Partition]
+    version: int
+    loaded_at: float
+    num_rows: int
+    # partitions carried over unchanged from the previous snapshot
+    reused_partitions: int = 0
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: Sequence[Dict[str, Any]],
+        version: int,
+        previous: Optional["ProductSnapshot"] = None,
+    ) -> "ProductSnapshot":
+        """
+        Builds a snapshot from rows returned by `fetch_product_rows`,
+        keeping the partitions of `previous` whose rows are unchanged.
+        """
+        if not rows:
+            return cls(partitions={}, version=version, loaded_at=time.time(), num_rows=0)
+        brands, brand_codes = np.unique([r["brand_name"] for r in rows], return_inverse=True)
+        categories, category_codes = np.unique([r["category"] for r in rows], return_inverse=True)
+        retailer_ids = np.fromiter((r["retailer_id"] for r in rows), dtype=np.int64, count=len(rows))
+        years = np.fromiter((r["year"] for r in rows), dtype=np.int64, count=len(rows))
+        margins = np.fromiter((r["contribution_margin"] for r in rows), dtype=np.float64, count=len(rows))
+        prices = np.fromiter((r["list_price"] for r in rows), dtype=np.float64, count=len(rows))
+        volumes = np.fromiter((r["volume_sold"] for r in rows), dtype=np.float64, count=len(rows))
+
+        # group rows by partition key, then split into contiguous runs
+        order = np.lexsort((years, retailer_ids, category_codes, brand_codes))
+        keys = np.stack(
+            [brand_codes[order], category_codes[order], retailer_ids[order], years[order]]
+        )
+        boundaries = np.flatnonzero(np.any(np.diff(keys, axis=1) != 0, axis=0)) + 1
+        partitions = {}
+        reused = 0
+        for run in np.split(order, boundaries):
+            first = run[0]
+            key = (
+                str(brands[brand_codes[first]]),
+                str(categories[category_codes[first]]),
+                int(retailer_ids[first]),
+                int(years[first]),
+            )
+            columns = (prices[run], margins[run], volumes[run])
+            old = previous.partitions.get(key) if previous is not None else None
+            if old is not None and old.digest == column_digest(*columns):
+                # skips sorting again, and keeps the log prices it already computed
+                partitions[key] = old
+                reused += 1
+            else:
+                partitions[key] = Partition.from_columns(*columns)
+        return cls(
+            partitions=partitions,
+            version=version,
+            loaded_at=time.time(),
+            num_rows=len(rows),
+            reused_partitions=reused,
+        )
+
+    def average_volumes(
+        self, product_brand: str, product_category: str, windows: Sequence[ComparableWindow]
+    ) -> Dict[Tuple[int, int], float]:
+        """
+        Same as `api.queries.fetch_average_volumes`, answered from memory.
+        """
+        volumes: Dict[Tuple[int, int], float] = {}
+        for window in windows:
+            key = (window.retailer_id, window.year)
+            partition = self.partitions.get((product_brand, product_category, *key))
+            matches = partition.window_volumes(window) if partition else None
+            volumes[key] = float(matches.mean()) if matches is not None and matches.size else 0
+        return volumes
+
+    @functools.cached_property
+    def rows_per_partition(self) -> Dict[Tuple[str, str], float]:
+        """Average rows in the partitions of each (brand, category)"""
+        totals: Dict[Tuple[str, str], List[int]] = {}
+        for (brand, category, _, _), partition in self.partitions.items():
+            total = totals.setdefault((brand, category), [0, 0])
+            total[0] += len(partition.volume_sold)
+            total[1] += 1
+        return {key: rows / count for key, (rows, count) in totals.items()}
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by all partition arrays"""
+        return sum(p.nbytes for p in self.partitions.values())
+
+
+class SnapshotStore:
+    """
+    Holds the current snapshot and refreshes it in the background, either
+    when the data version is bumped or when it gets older than `max_age`.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = SNAPSHOT_ENABLED,
+        refresh_interval: float = REFRESH_INTERVAL,
+        max_age: float = MAX_AGE,
+    ):
+        self.enabled = enabled
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.current: Optional[ProductSnapshot] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self, force: bool = False) -> Optional[ProductSnapshot]:
+        """Reloads the snapshot if the data version changed or it is too old"""
+        async with database.session() as db:
+            version = await fetch_data_version(db)
+            current = self.current
+            if (
+                not force
+                and current is not None
+                and current.version == version
+                and time.time() - current.loaded_at < self.max_age
+            ):
+                return current
+            started = time.perf_counter()
+            rows = await fetch_product_rows(db)
+        # sorting and indexing a full table takes a while, so it runs off the event loop
+        snapshot = await asyncio.to_thread(ProductSnapshot.from_rows, rows, version, previous=self.current)
+        self.current = snapshot
+        logger.info(
+            "loaded product snapshot v%d: %d rows, %d partitions (%d unchanged), %.1f MiB in %.2fs",
+            snapshot.version,
+            snapshot.num_rows,
+            len(snapshot.partitions),
+            snapshot.reused_partitions,
+            snapshot.nbytes / 2**20,
+            time.perf_counter() - started,
+        )
+        return snapshot
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # keep serving the previous snapshot
+                logger.exception(e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self):
+        """Starts refreshing the snapshot in the background, if enabled"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        """Stops the background refresh"""
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Describes the current snapshot, e.g. for diagnostics"""
+        snapshot = self.current
+        if snapshot is None:
+            return {"enabled": self.enabled, "loaded": False}
+        return {
+            "enabled": self.enabled,
+            "loaded": True,
+            "version": snapshot.version,
+            "rows": snapshot.num_rows,
+            "partitions": len(snapshot.partitions),
+            "reused_partitions": snapshot.reused_partitions,
+            "bytes": snapshot.nbytes,
+            "age_seconds": time.time() - snapshot.loaded_at,
+        }
+
+
+product_snapshot = SnapshotStore()
@@ -0,0 +1,267 @@
+"""
+Scenario sweeps: evaluates a grid of variable costs, list prices, desired
+IRRs and initial investments in one call. The historical data and market
+price are loaded once and every scenario is computed in the same
+vectorized pass, so a sensitivity table costs about as much as a single
+forecast.
+"""
+from typing import Any, Dict, List, Literal, Sequence, Set, Tuple
+
+import numpy as np
+from prisma import Prisma
+from prisma.models import Retailer
+
+from api import finance
+from api.calc import (
+    RECOMMENDATIONS,
+    base_list_prices,
+    fixed_costs,
+    load_retailers,
+    recommend,
+    retailer_year_matrix,
+)
+from api.db import database
+from api.engine import compute_forecast, contribution_margins, window_mask
+from api.queries import fetch_comparables
+from api.schema import MAX_SWEEP_SCENARIOS, AxisRange
+from api.snapshot import product_snapshot
+
+# (list_price, contribution_margin, volume_sold) of comparable products
+Comparables = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def expand_axis(spec: Any) -> List[Any]:
+    """
+    Expands a sweep axis given as a single value, a list of values, or a
+    range (validated by `api.schema.AxisRange`).
+    """
+    if isinstance(spec, AxisRange):
+        if spec.num is not None:
+            return np.linspace(spec.start, spec.stop, spec.num).tolist()
+        return np.arange(spec.start, spec.stop + spec.step / 2, spec.step).tolist()
+    if isinstance(spec, list):
+        return spec
+    return [spec]
+
+
+async def load_comparable_columns(
+    db: Prisma,
+    product_brand: str,
+    product_category: str,
+    retailers: List[Retailer],
+    num_years: int,
+) -> Dict[Tuple[int, int], Comparables]:
+    """
+    Returns the columns of every comparable historical product, keyed by
+    (retailer_id, year), from the in-memory snapshot when it is loaded.
+    """
+    keys = [(r.id, y) for r in retailers for y in range(1, num_years + 1)]
+    empty = (np.empty(0), np.empty(0), np.empty(0))
+    snapshot = product_snapshot.current
+    if snapshot is not None:
+        columns = {}
+        for key in keys:
+            partition = snapshot.partitions.get((product_brand, product_category, *key))
+            columns[key] = (
+                (partition.list_price, partition.contribution_margin, partition.volume_sold)
+                if partition
+                else empty
+            )
+        return columns
+
+    rows = await fetch_comparables(
+        db, product_brand, product_category, [r.id for r in retailers], num_years
+    )
+    grouped: Dict[Tuple[int, int], List[Tuple[float, float, float]]] = {}
+    for row in rows:
+        grouped.setdefault((row.retailer_id, row.year), []).append(
+            (row.list_price, row.contribution_margin, row.volume_sold)
+        )
+    columns = {}
+    for key in keys:
+        values = np.array(grouped.get(key, []), dtype=float).reshape(-1, 3)
+        columns[key] = (values[:, 0], values[:, 1], values[:, 2])
+    return columns
+
+
+def window_average_volumes(
+    comparables: Comparables,
+    list_price: np.ndarray,
+    contribution_margin: np.ndarray,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+) -> np.ndarray:
+    """
+    Averages the volume of comparables inside the window around every
+    (list_price, contribution_margin) pair at once, with 0 for empty windows.
+    """
+    prices, margins, volumes = comparables
+    in_window = window_mask(
+        prices,
+        margins,
+        list_price,
+        contribution_margin,
+        relevant_contribution_margin_range,
+        relevant_list_price_range,
+    )
+    counts = in_window.sum(axis=-1)
+    totals = in_window.astype(float) @ volumes
+    return np.divide(totals, counts, out=np.zeros(counts.shape), where=counts > 0)
+
+
+def comparable_volumes(
+    comparables: Dict[Tuple[int, int], Comparables],
+    list_prices: Dict[Tuple[int, int], float],
+    variable_cost: float,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+) -> Dict[Tuple[int, int], float]:
+    """
+    Averages the volume of comparables for a single forecast, keyed by
+    (retailer_id, year), from columns loaded by `load_comparable_columns`.
+    """
+    volumes = {}
+    for key, list_price in list_prices.items():
+        volumes[key] = float(
+            window_average_volumes(
+                comparables[key],
+                np.asarray(list_price),
+                contribution_margins(np.asarray(list_price), variable_cost),
+                relevant_contribution_margin_range,
+                relevant_list_price_range,
+            )
+        )
+    return volumes
+
+
+def list_price_matrices(
+    points: Sequence[Any],
+    retailers: List[Retailer],
+    base: np.ndarray,
+) -> np.ndarray:
+    """
+    Builds a (points x retailers x years) list price array. Each point is
+    either empty (use the base prices), a number applied to every
+    retailer, or a mapping of retailer name to list price.
+    """
+    matrices = np.repeat(base[np.newaxis], len(points), axis=0)
+    for k, point in enumerate(points):
+        if point is None or point == "":
+            continue
+        if isinstance(point, dict):
+            for i, retailer in enumerate(retailers):
+                if point.get(retailer.name) not in (None, ""):
+                    matrices[k, i, :] = float(point[retailer.name])
+        else:
+            matrices[k] = float(point)
+    assert np.all(matrices > 0), "List prices must be positive"
+    return matrices
+
+
+def overridden_everywhere(points: Sequence[Any], retailers: List[Retailer]) -> Set[str]:
+    """
+    Names of the retailers whose list price every point of the list_price
+    axis overrides, so their base prices are never used.
+    """
+    names = {retailer.name for retailer in retailers}
+    for point in points:
+        if point is None or point == "":
+            return set()
+        if isinstance(point, dict):
+            names &= {name for name, value in point.items() if value not in (None, "")}
+    return names
+
+
+# pylint: disable=too-many-locals disable=too-many-arguments
+async def calc_sweep(
+    product_category: str,
+    product_brand: str,
+    retailers_mapping: Dict[str, Tuple[bool, float | Literal[""]]],
+    num_years: int,
+    relevant_contribution_margin_range: float,
+    relevant_list_price_range: float,
+    variable_cost: Sequence[float],
+    list_price: Sequence[Any],
+    desired_irr: Sequence[float],
+    inital_investment: Sequence[float],
+) -> Dict[str, Any]:
+    """
+    Computes NPV, IRR and recommendation for every combination of the
+    given variable costs, list prices, desired IRRs and initial investments.
+    Results are nested lists indexed [variable_cost][list_price][desired_irr][inital_investment].
+    """
+    shape = (len(variable_cost), len(list_price), len(desired_irr), len(inital_investment))
+    assert int(np.prod(shape)) <= MAX_SWEEP_SCENARIOS, f"Sweep has {int(np.prod(shape))} scenarios, the limit is {MAX_SWEEP_SCENARIOS}"
+    async with database.session() as db:  # pylint: disable=invalid-name
+        retailers, agreements = await load_retailers(db, retailers_mapping, num_years)
+        # skips the market price when the sweep sets every list price itself
+        overridden = overridden_everywhere(list_price, retailers)
+        base_prices = await base_list_prices(
+            product_category,
+            [r for r in retailers if r.name not in overridden],
+            agreements,
+            retailers_mapping,
+            num_years,
+        )
+        comparables = await load_comparable_columns(
+            db, product_brand, product_category, retailers, num_years
+        )
+
+    def matrix(value) -> np.ndarray:
+        return retailer_year_matrix(retailers, num_years, value)
+
+    # (P, R, Y) list prices and (V, P, R, Y) margins and volumes
+    list_prices = list_price_matrices(
+        list_price, retailers, matrix(lambda r, y: base_prices.get((r, y), np.nan))
+    )
+    variable_costs = np.asarray(variable_cost, dtype=float)
+    margins = contribution_margins(
+        list_prices[np.newaxis], variable_costs[:, np.newaxis, np.newaxis, np.newaxis]
+    )
+    volume = np.zeros(margins.shape)
+    for i, retailer in enumerate(retailers):
+        for j in range(num_years):
+            volume[:, :, i, j] = window_average_volumes(
+                comparables[(retailer.id, j + 1)],
+                list_prices[:, i, j],
+                margins[:, :, i, j],
+                relevant_contribution_margin_range,
+                relevant_list_price_range,
+            )
+
+    result = compute_forecast(
+        volume=volume,
+        list_price=list_prices[np.newaxis],
+        retailer_markup=matrix(lambda r, y: agreements[(r, y)].retailer_markup),
+        fixed_costs=matrix(lambda r, y: fixed_costs(agreements[(r, y)])),
+        variable_cost=variable_costs[:, np.newaxis],
+        inital_investment=0,
+    )
+    # (V, P, N, Y+1) cashflows, one per initial investment
+    cashflows = np.repeat(result.cashflows[:, :, np.newaxis, :], shape[3], axis=2)
+    cashflows[..., 0] = -np.asarray(inital_investment, dtype=float)
+
+    solved = finance.irr(cashflows)
+    discount = (1 + np.asarray(desired_irr, dtype=float)[:, np.newaxis]) ** -np.arange(
+        num_years + 1
+    )
+    npv = np.einsum("vpnt,it->vpin", cashflows, discount)
+    irr = np.broadcast_to(solved.irr[:, :, np.newaxis, :], shape)
+    recommendation = recommend(
+        npv, irr, np.asarray(desired_irr, dtype=float)[:, np.newaxis]
+    )
+    irr_status = np.broadcast_to(solved.status[:, :, np.newaxis, :], shape)
+    return {
+        "axes": {
+            "variable_cost": list(variable_cost),
+            "list_price": list(list_price),
+            "desired_irr": list(desired_irr),
+            "inital_investment": list(inital_investment),
+        },
+        "npv": npv.tolist(),
+        # null where the cashflows have no IRR
+        "irr": np.where(np.isnan(irr), None, irr).tolist(),
+        "irr_status": irr_status.tolist(),
+        "irr_report": solved.report(),
+        "recommendation": np.array(RECOMMENDATIONS)[recommendation].tolist(),
+    }
@@ -1,45 +1,54 @@
 """
 Utility functions
 """
+import functools
+import math
+import os
+from typing import Any, Dict, List, Tuple
 
-from typing import List
-
+import numpy as np
 from prisma.models import Retailer
 
+from api.engine import ForecastResult
+
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", "256"))
+# far more than the sheet displays, but saves a third of the payload
+COMPACT_SIGNIFICANT_DIGITS = int(os.environ.get("COMPACT_SIGNIFICANT_DIGITS", "10"))
+
 
 def create_template_sheet(retailers: List[Retailer], num_years: int):
     """
     Creates a matrix that can be used as a template spreadsheet. This
     only includes the headings for rows/columns in the spreadsheet, as
-    data is later inserted by the `calc_output` function.
+    data is later inserted by the `calc_output` function. Templates are
+    memoized by (retailer names, num_years), so this only copies rows.
     """
-    output: List[List[str | float | int]] = [
-        ["" for _ in range(2 + num_years)]
-        for _ in range(len(retailers) * 20 + 100)  # we trim empty rows at the end
-    ]
+    template, offsets = _template_sheet(tuple(r.name for r in retailers), num_years)
+    output: List[List[str | float | int]] = [list(row) for row in template]
+    return output, offsets
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _template_sheet(retailer_names: Tuple[str, ...], num_years: int):
+    rows: List[Tuple[str, ...]] = []
+
+    def add_row(title="", cells=()):
+        rows.append((title, *cells) + ("",) * (1 + num_years - len(cells)))
 
     def place_header(header_title, include_retailers=False, include_total=False):
-        nonlocal row_num
-        output[row_num][0] = header_title
-        row_num += 1
-        offset = row_num if include_retailers else row_num - 1
+        add_row(header_title)
+        offset = len(rows) if include_retailers else len(rows) - 1
         if include_retailers:
-            for retailer in retailers:
-                output[row_num][0] = retailer.name
-                row_num += 1
+            for name in retailer_names:
+                add_row(name)
             if include_total:
-                output[row_num][0] = "TOTAL"
-                row_num += 1
-        row_num += 1
+                add_row("TOTAL")
+        add_row()
         return offset
 
     # Launch Year
-    row_num = 0
-    output[row_num][0] = "Launch Year:"
-    for i in range(num_years):
-        output[row_num][1 + i] = f"Year {i+1}"
-    output[row_num][num_years + 1] = "Total"
-    row_num += 2
+    add_row("Launch Year:", [f"Year {i+1}" for i in range(num_years)] + ["Total"])
+    add_row()
 
     # Volume
     volume_offset = place_header(
@@ -73,16 +82,11 @@ def create_template_sheet(retailers: List[Retailer], num_years: int):
     net_revenue_offset = place_header("Net Revenue")
 
     # Decision Output
-    output[row_num][0] = "DECISION OUTPUT"
-    row_num += 1
-    output[row_num][0] = "NPV Analysis"
-    row_num += 1
-    output[row_num][0] = "IRR Analysis"
-    row_num += 1
-    output[row_num][0] = "Recommendation"
-    row_num += 1
-
-    output = output[:row_num]
+    add_row("DECISION OUTPUT")
+    add_row("NPV Analysis")
+    add_row("IRR Analysis")
+    add_row("Recommendation")
+
     # pylint: disable=duplicate-code
     offsets = (
         volume_offset,
@@ -93,4 +97,91 @@ def create_template_sheet(retailers: List[Retailer], num_years: int):
         fixed_costs_offset,
         net_revenue_offset,
     )
-    return output, offsets
+    return tuple(rows), offsets
+
+
+def create_partial_sheet(retailer_names: List[str], num_years: int, reason: str):
+    """
+    A template spreadsheet whose decision output says why the forecast is
+    missing, for when it couldn't be computed in time.
+    """
+    template, offsets = _template_sheet(tuple(retailer_names), num_years)
+    output: List[List[str | float | int]] = [list(row) for row in template]
+    net_revenue_offset = offsets[-1]
+    output[net_revenue_offset + 3][1] = "Unavailable"
+    output[net_revenue_offset + 4][1] = "Unavailable"
+    output[net_revenue_offset + 5][1] = f"Partial result: {reason}"
+    return output
+
+
+def append_note(output: List[List[str | float | int]], note: str) -> None:
+    """Adds a row with a note below a spreadsheet"""
+    width = len(output[0]) if output else 2
+    output.append(["Note:", note] + [""] * (width - 2))
+
+
+def fill_template_sheet(output: List[List[str | float | int]], offsets, result: ForecastResult):
+    """
+    Fills the line items of a forecast into a template spreadsheet
+    created by `create_template_sheet`, one row slice at a time.
+    """
+    (
+        volume_offset,
+        retailer_price_offset,
+        retailer_sales_offset,
+        manufacturer_sales_offset,
+        manufacturer_gross_offset,
+        fixed_costs_offset,
+        net_revenue_offset,
+    ) = offsets
+
+    def place_rows(offset: int, item: np.ndarray, include_totals=True):
+        if include_totals:
+            # a total column for each retailer, and a TOTAL row below them
+            item = np.column_stack([item, item.sum(axis=1)])
+            item = np.vstack([item, item.sum(axis=0)])
+        for i, row in enumerate(item.tolist()):
+            output[offset + i][1 : 1 + len(row)] = row
+
+    place_rows(volume_offset, result.volume)
+    place_rows(retailer_price_offset, result.retailer_price, include_totals=False)
+    place_rows(retailer_sales_offset, result.retailer_sales_revenue)
+    place_rows(manufacturer_sales_offset, result.manufacturer_sales_revenue)
+    place_rows(manufacturer_gross_offset, result.manufacturer_gross_revenue)
+    place_rows(fixed_costs_offset, result.fixed_costs)
+    net_revenue = result.net_revenue.tolist()
+    output[net_revenue_offset][1 : 2 + len(net_revenue)] = net_revenue + [sum(net_revenue)]
+
+
+def compact_sheet(output: List[List[Any]]) -> Dict[str, Any]:
+    """
+    Encodes a spreadsheet column by column for the opt-in compact wire
+    format. Each column is a list of [first row, [numbers...]] runs of
+    consecutive numeric cells, rounded to COMPACT_SIGNIFICANT_DIGITS (NaN
+    and infinity are left empty). Text cells are listed as [row, column,
+    index into "strings"], so repeated headings are sent once. Empty cells
+    cost nothing. `script.gs` expands it back into rows.
+    """
+    num_columns = max((len(row) for row in output), default=0)
+    columns: List[List[Any]] = [[] for _ in range(num_columns)]
+    strings: Dict[str, int] = {}
+    text: List[Tuple[int, int, int]] = []
+    for j, runs in enumerate(columns):
+        run: List[Any] = []
+        for i, row in enumerate(output):
+            value = row[j] if j < len(row) else ""
+            if isinstance(value, (int, float)) and math.isfinite(value):
+                if not run:
+                    runs.append([i, run])
+                run.append(float(f"{value:.{COMPACT_SIGNIFICANT_DIGITS}g}") if isinstance(value, float) else value)
+                continue
+            if isinstance(value, str) and value:
+                text.append((i, j, strings.setdefault(value, len(strings))))
+            run = []
+    return {
+        "format": "columns",
+        "shape": [len(output), num_columns],
+        "columns": columns,
+        "strings": list(strings),
+        "text": text,
+    }
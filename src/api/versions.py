@@ -0,0 +1,60 @@
+"""
+The current data version (see scripts/seed.py), shared by everything that
+keeps database data in memory, so each of them can tell when an ingest
+has made it stale. Reading it costs a query, so it is re-read at most
+every DATA_VERSION_CHECK_SECONDS.
+
+In-memory data isn't reloaded the moment the version changes, so a
+computation records the versions of the data it actually read (see
+`record_read`), and results are only cached under those.
+"""
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional, Set
+
+from api.db import database
+from api.queries import fetch_data_version
+
+DATA_VERSION_CHECK_SECONDS = float(
+    os.environ.get(
+        "DATA_VERSION_CHECK_SECONDS", os.environ.get("RESULT_CACHE_VERSION_CHECK_SECONDS", "5")
+    )
+)
+
+_reads: ContextVar[Optional[Set[int]]] = ContextVar("data_version_reads", default=None)
+
+
+def start_reads() -> Set[int]:
+    """Starts recording the data versions read by the current computation"""
+    reads: Set[int] = set()
+    _reads.set(reads)
+    return reads
+
+
+def record_read(*versions: int) -> None:
+    """Records that the current computation read in-memory data at these versions"""
+    reads = _reads.get()
+    if reads is not None:
+        reads.update(versions)
+
+
+class DataVersion:
+    """The data version, re-read from the database at most every `check_interval` seconds"""
+
+    def __init__(self, check_interval: float = DATA_VERSION_CHECK_SECONDS):
+        self.check_interval = check_interval
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+
+    async def current(self) -> int:
+        """The data version, as of at most `check_interval` seconds ago"""
+        now = time.monotonic()
+        if self._version is None or now - self._checked_at >= self.check_interval:
+            async with database.session() as db:
+                version = await fetch_data_version(db)
+            self._version, self._checked_at = version, now
+        return self._version
+
+
+data_version = DataVersion()
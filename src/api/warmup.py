@@ -0,0 +1,186 @@
+"""
+Warms a worker up before it takes traffic: prefetches the average market
+price of every category in the Product catalogue, so the first request
+for a category doesn't wait on a whole PriceAPI job, and preloads every
+retailer and agreement into memory. Runs on startup and then on a schedule.
+The preload is only used at the data version it was loaded at; once an
+ingest bumps the version, it is reloaded in the background.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from prisma.models import Retailer, RetailerYear
+
+from api.db import database
+from api.prices import get_average_price
+from api.queries import fetch_all_agreements, fetch_categories, fetch_data_version
+from api.versions import data_version
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") == "1"
+WARMUP_CONCURRENCY = int(os.environ.get("WARMUP_CONCURRENCY", "4"))
+# readiness stops waiting on the first warm-up after this long
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT_SECONDS", "60"))
+WARMUP_INTERVAL = float(os.environ.get("WARMUP_INTERVAL_SECONDS", "600"))
+
+
+@dataclass
+class Preloaded:
+    """Every retailer and retailer agreement, at a given data version"""
+
+    retailers: Dict[str, Retailer]
+    agreements: Dict[Tuple[int, int], RetailerYear]
+    version: int
+    loaded_at: float
+
+    def lookup(
+        self, retailer_names: Sequence[str], num_years: int
+    ) -> Optional[Tuple[List[Retailer], Dict[Tuple[int, int], RetailerYear]]]:
+        """
+        Returns the named retailers (ordered by id, like the database does)
+        and their agreements for years 1..num_years, or None if any of
+        them weren't preloaded, e.g. because they were added since.
+        """
+        if any(name not in self.retailers for name in retailer_names):
+            return None
+        retailers = sorted((self.retailers[name] for name in set(retailer_names)), key=lambda r: r.id)
+        keys = [(r.id, y) for r in retailers for y in range(1, num_years + 1)]
+        if any(key not in self.agreements for key in keys):
+            return None
+        return retailers, {key: self.agreements[key] for key in keys}
+
+
+class Warmer:
+    """
+    Runs the warm-up in the background. `ready` turns true once the first
+    warm-up has finished or `timeout` has passed, whichever comes first;
+    a warm-up that times out keeps going in the background.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = WARMUP_ENABLED,
+        concurrency: int = WARMUP_CONCURRENCY,
+        timeout: float = WARMUP_TIMEOUT,
+        interval: float = WARMUP_INTERVAL,
+    ):
+        self.enabled = enabled
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.interval = interval
+        self.ready = not enabled
+        self.preloaded: Optional[Preloaded] = None
+        self.last_run: Dict[str, Any] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._reload: Optional[asyncio.Task] = None
+
+    async def preload(self) -> Preloaded:
+        """Loads every retailer and agreement into memory"""
+        async with database.session() as db:
+            version = await fetch_data_version(db)
+            retailers = await db.retailer.find_many()
+            agreements = await fetch_all_agreements(db)
+        self.preloaded = Preloaded(
+            retailers={r.name: r for r in retailers},
+            agreements=agreements,
+            version=version,
+            loaded_at=time.time(),
+        )
+        return self.preloaded
+
+    async def current_preload(self) -> Optional[Preloaded]:
+        """
+        The preloaded retailers and agreements, if they are at the current
+        data version. Otherwise returns None, and reloads them in the
+        background unless a reload is already running.
+        """
+        preloaded = self.preloaded
+        if preloaded is None:
+            return None
+        if preloaded.version == await data_version.current():
+            return preloaded
+        if self._reload is None or self._reload.done():
+            # in a fresh context, so the reload isn't bound by this request's deadline
+            self._reload = contextvars.Context().run(asyncio.create_task, self._preload_logged())
+        return None
+
+    async def _preload_logged(self) -> None:
+        try:
+            preloaded = await self.preload()
+            logger.info("reloaded retailers and agreements at data version %d", preloaded.version)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.exception(e)
+
+    async def warm(self) -> None:
+        """Preloads retailers and agreements, then prefetches every category's price"""
+        started = time.perf_counter()
+        preloaded = await self.preload()
+        retailers, agreements = preloaded.retailers, preloaded.agreements
+        async with database.session() as db:
+            categories = await fetch_categories(db)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def prefetch(category: str) -> bool:
+            async with semaphore:
+                return await get_average_price(category) > 0
+
+        prefetched = await asyncio.gather(*(prefetch(c) for c in categories))
+        self.last_run = {
+            "categories": len(categories),
+            "prices": sum(prefetched),
+            "retailers": len(retailers),
+            "agreements": len(agreements),
+            "seconds": time.perf_counter() - started,
+        }
+        logger.info(
+            "warm-up: %d/%d category prices, %d retailers, %d agreements in %.2fs",
+            sum(prefetched),
+            len(categories),
+            len(retailers),
+            len(agreements),
+            self.last_run["seconds"],
+        )
+
+    async def _warm_logged(self) -> None:
+        try:
+            await self.warm()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # requests fall back to querying the database and PriceAPI
+            logger.exception(e)
+
+    async def _warm_forever(self):
+        first = asyncio.create_task(self._warm_logged())
+        done, _ = await asyncio.wait({first}, timeout=self.timeout)
+        if not done:
+            logger.warning("warm-up didn't finish in %.0fs, reporting ready anyway", self.timeout)
+        self.ready = True
+        await first
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._warm_logged()
+
+    async def start(self):
+        """Starts warming up in the background, if enabled"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._warm_forever())
+
+    async def stop(self):
+        """Stops the background warm-up"""
+        for task in (self._task, self._reload):
+            if task is not None:
+                task.cancel()
+        self._task = self._reload = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Describes the last warm-up, e.g. for diagnostics"""
+        return {"enabled": self.enabled, "ready": self.ready, **self.last_run}
+
+
+warmer = Warmer()